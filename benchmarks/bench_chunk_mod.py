@@ -0,0 +1,18 @@
+import os
+import io
+import time
+from bkp_core import chunk_mod
+
+def test_chunk_mod_scan_benchmark(testdir,monkeypatch):
+    """ benchmark how fast large files are cut into chunks with and without numpy """
+    content = os.urandom(32*1024*1024)
+    for name in [ "numpy", "python" ]:
+        if name == "python":
+            monkeypatch.setattr(chunk_mod,"numpy",None)
+        elif not chunk_mod.numpy:
+            continue
+        start = time.time()
+        chunks = list(chunk_mod.chunks(io.BytesIO(content)))
+        elapsed = time.time() - start
+        assert(b"".join(chunks) == content)
+        print("%s scan %d chunks %.1f MB per second"%(name,len(chunks),len(content)/(1024.0*1024.0)/elapsed))
@@ -0,0 +1,35 @@
+import os
+import time
+from bkp_core import sync_mod
+from bkp_core.logger import Logger
+
+def test_queue_mod_shutdown_benchmark(testdir,monkeypatch):
+    """ benchmark how long the logger and the workers take to shut down and how many small sync jobs fit in a minute """
+    monkeypatch.setenv("HOME",str(testdir.tmpdir))
+
+    timings = []
+    for i in range(0,20):
+        log = Logger()
+        log.start_logger()
+        log.log("line")
+        start = time.time()
+        log.wait_for_logger()
+        timings.append(time.time() - start)
+    print("logger shutdown seconds worst %f"%max(timings))
+
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    target = "file://"+os.path.join(str(testdir.tmpdir),"target")
+    for d in range(0,3):
+        os.makedirs(os.path.join(local_path,"d%d"%d))
+        for f in range(0,5):
+            open(os.path.join(local_path,"d%d"%d,"f%d.txt"%f),"w").write("file %d %d"%(d,f))
+    os.makedirs(os.path.join(str(testdir.tmpdir),"target")+local_path)
+    sync_config = { "target" : target, "dirs" : [local_path], "exclude_files" : "", "exclude_dirs" : [], "threads" : "8" }
+
+    runs = 10
+    start = time.time()
+    for i in range(0,runs):
+        assert(not sync_mod.SyncJob( sync_config ).synchronize())
+    elapsed = time.time() - start
+    # with polling each job stalled for up to a second on each of the worker and logger shutdowns
+    print("sync jobs per minute %d, %f seconds per job"%(60*runs/elapsed,elapsed/runs))
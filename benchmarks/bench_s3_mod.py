@@ -0,0 +1,21 @@
+from bkp_test_util import s3_stub
+from bkp_core import s3_mod
+import time
+
+def test_s3_mod_parallel_list_benchmark(s3_stub,testdir):
+    """ benchmark the sharded parallel listing against a local s3 stand in with some latency per request """
+    for d in range(0,8):
+        for f in range(0,150):
+            s3_stub.objects[("bucket","tmp/d%02d/f%04d.txt"%(d,f))] = { "data" : b"x"*f, "attrs" : None, "time" : 1500000000 }
+    s3_stub.objects[("bucket","tmp/top.txt")] = { "data" : b"top", "attrs" : None, "time" : 1500000000 }
+    s3_stub.page_size = 25
+    s3_stub.latency = 0.02
+
+    timings = {}
+    for threads in [1,2,4,8]:
+        start = time.time()
+        entries = [ e for e in s3_mod.list_objects_parallel("s3://bucket/tmp/",threads) ]
+        timings[threads] = time.time() - start
+        assert(len(entries) == 1201)
+    for threads in timings:
+        print("parallel listing threads %d seconds %f speedup %.1f"%(threads,timings[threads],timings[1]/timings[threads]))
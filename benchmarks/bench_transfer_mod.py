@@ -0,0 +1,31 @@
+import time
+import threading
+from bkp_core import transfer_mod
+from bkp_core.stats_mod import JobStats
+from bkp_core.transfer_mod import TransferEngine, AimdController
+
+def test_transfer_mod_adaptive_benchmark(testdir,monkeypatch):
+    """ benchmark how a fixed number of threads and an adaptive engine do against a backend that slows down past 6 transfers at once """
+    monkeypatch.setattr(transfer_mod,"adapt_seconds",0.1)
+    running = [0]
+    lock = threading.Lock()
+    def transfer():
+        with lock:
+            running[0] += 1
+            n = running[0]
+        try:
+            time.sleep(0.005 * max(1.0,(n/6.0)**2))
+        finally:
+            with lock:
+                running[0] -= 1
+    for threads, controller in [ (1,None), (6,None), (32,None), (1,AimdController(1,1,32)) ]:
+        engine = TransferEngine(threads,0,{},controller).start()
+        start = time.time()
+        for i in range(0,1500):
+            engine.submit( transfer, size=1000 )
+        engine.join()
+        stats = JobStats()
+        engine.record_stats(stats)
+        print("%s threads %d seconds %f"%("adaptive" if controller else "fixed",threads,time.time()-start))
+        if controller:
+            print(stats.summary())
@@ -3,6 +3,15 @@
 import os
 import sys
 
+# settings that are optional in the config file, they are only saved if they are set
+optional_keys = [ "scan_threads", "queue_size", "dedup", "chunk_min_size", "compress", "pack_threshold", "pack_size", "cache_size", "s3_part_size", "s3_part_threads", "list_threads", "delete_threads", "ssh_exec", "ssh_connections", "checkpoint_seconds", "file_threads", "ssh_threads", "s3_threads", "adaptive_threads", "min_threads", "max_threads" ]
+
+def get_flag( bkp_config, key, default = False ):
+    """ return the value of a True/False setting in the config """
+    if key in bkp_config:
+        return str(bkp_config[key]).strip().lower() in [ "true", "yes", "1" ]
+    return default
+
 def save_config( bkp_config, config_file, for_restart = False ):
     """ save the configuration to the file object passed as a parameter """
     print("bucket =", bkp_config["bucket"], file=config_file)
@@ -14,6 +23,9 @@ def save_config( bkp_config, config_file, for_restart = False ):
     print("threads = ",bkp_config["threads"], file=config_file)
     print("ssh_username = ",bkp_config["ssh_username"], file=config_file)
     print("ssh_password = ",bkp_config["ssh_password"], file=config_file)
+    for key in optional_keys:
+        if key in bkp_config:
+            print(key,"= ",bkp_config[key], file=config_file)
     if for_restart:
         print("start_time = ",bkp_config["start_time"], file=config_file)
         print("end_time = ",bkp_config["end_time"], file=config_file)
@@ -4,8 +4,6 @@ import sys
 import os
 import re
 import traceback
-import queue
-import threading
 import platform
 import time
 import subprocess
@@ -15,15 +13,31 @@ import io
 import urllib.request, urllib.parse, urllib.error
 from bkp_core import fs_mod
 from bkp_core import bkp_conf
+from bkp_core import index_mod
+from bkp_core import dedup_mod
+from bkp_core import chunk_mod
+from bkp_core import compress_mod
+from bkp_core import pack_mod
+from bkp_core import manifest_mod
+from bkp_core import cache_mod
+from bkp_core import checkpoint_mod
 from bkp_core.util import get_contents, put_contents, mail_error, mail_log
-from bkp_core.logger import Logger
+from bkp_core.logger import Logger, LogWriter
+from bkp_core import transfer_mod
+from bkp_core.walk_mod import TreeWalker
+from bkp_core.exclude_mod import Matcher
+from bkp_core.stats_mod import JobStats
 
 class WorkerParams:
     """ worker params """
-    def __init__(self, from_path, to_path):
-        """ set up the copy from and to paths for the worker """
+    __slots__ = ( "from_path", "to_path", "mtime", "size" )
+
+    def __init__(self, from_path, to_path, mtime = None, size = None):
+        """ set up the copy from and to paths for the worker and the mtime and size the file had when it was scanned """
         self.from_path = from_path
         self.to_path = to_path
+        self.mtime = mtime
+        self.size = size
 
 
 def get_machines(base_path, config):
@@ -71,44 +85,133 @@ def get_backups( machine_path, config, verbose = False ):
             timestamp = os.path.split(os.path.split(m.group(2))[0])[1]
             backups.append(Backup(path,timestamp,timestamp2time(timestamp)))
 
+    # this listing is all we need to validate the local cache of backup file lists, backups don't change once they're done
+    cache = cache_mod.get_cache(config)
+    if cache:
+        cache.prune(machine_path.rstrip("/"),[ b.timestamp for b in backups ])
+
     return backups
 
+def log_entries( contents ):
+    """ generator that yields a tuple of ( local_path, remote_path, status, msg ) for each file line after the config in a backup log """
+    past_config = False
+    for l in io.StringIO(contents):
+        if not past_config:
+            if l.startswith("end_config"):
+                past_config = True
+        elif l.strip():
+            local_path,remote_path,status,msg = l.strip().split(";",3)
+            yield (local_path,remote_path,status,msg)
+
+def log_record( local_path, remote_path, status, msg ):
+    """ return the ( local_path, remote_path, status, msg, mtime, size, digest ) record for a log entry, the mtime and size the file had when it was scanned
+        are taken out of the scanned=mtime:size part of the msg, they are None for errors and logs that don't have them """
+    parts = msg.split(",")
+    scanned = [ p for p in parts if p.startswith("scanned=") ]
+    if status == "error" or not scanned:
+        return (local_path,remote_path,status,msg,None,None,manifest_mod.entry_hash(msg))
+    msg = ",".join([ p for p in parts if not p.startswith("scanned=") ])
+    mtime, size = scanned[-1][len("scanned="):].split(":")
+    return (local_path,remote_path,status,msg,float(mtime),int(size),manifest_mod.entry_hash(msg))
+
 def get_backedup_files( machine_path, config, verbose = False ):
     """ return a dict with all of the files we've backed up for this machine """
     backedup = {}
     backups = get_backups( machine_path, config, verbose )
     for bk in backups:
-        # fetch the contents of the backup log
-        contents = get_contents(machine_path,bk.timestamp+"/bkp/bkp."+bk.timestamp+".log",verbose, lambda: config)
+        for local_path in get_backup_files( bk, machine_path, config, verbose ):
+            if local_path in backedup:
+                backedup[local_path].append( bk.time )
+            else:
+                backedup[local_path] = [bk.time]
 
-        # collect the newest version
-        if contents:
+    return backedup
+
+def get_backup_entries( bk, machine_path, config, verbose = False ):
+    """ generator that yields a ( local_path, remote_path, status, msg, mtime, size, digest ) record for each file in a backup, mtime and size are None if they weren't recorded """
+    # finished backups don't change so use the local cache if we have them in it
+    cache = cache_mod.get_cache(config)
+    if cache:
+        records = cache.get(machine_path,bk.timestamp)
+        if records != None:
             if verbose:
-                print("Found log file and processing it", file=sys.stderr)
-
-            past_config = False
-            for l in io.StringIO(contents):
-                if not past_config:
-                    if l.startswith("end_config"):
-                        past_config = True
-                elif l.strip():
-                    local_path,remote_path,status,msg = l.strip().split(";",3)
-                    if local_path in backedup:
-                        backedup[local_path].append( bk.time )
-                    else:
-                        backedup[local_path] = [bk.time]
-        else:
-            # ok this is a screwed up one that doesn't have a log so recurse using ls and build the list off of that
-            for l in io.StringIO(fs_mod.fs_ls(bk.path,True,lambda: config)):
-                prefix,path = re.split(bk.timestamp,l)
-                path = path.strip()
-                local_path = urllib.request.url2pathname(path)
-                if local_path in backedup:
-                    backedup[local_path].append(bk.time)
-                else:
-                    backedup[local_path] = [bk.time]
+                print("Found cached file list and processing it", file=sys.stderr)
+            for r in records:
+                yield r
+            return
+
+    # newer backups have a manifest which is much quicker to read than the log
+    records = manifest_mod.get_manifest(machine_path,bk.timestamp,verbose,lambda: config)
+    if records != None:
+        if verbose:
+            print("Found manifest and processing it", file=sys.stderr)
+        if cache:
+            cache.put(machine_path,bk.timestamp,records)
+        for r in records:
+            yield r
+        return
 
-    return backedup
+    # fetch the contents of the backup log
+    contents = get_contents(machine_path,bk.timestamp+"/bkp/bkp."+bk.timestamp+".log",verbose, lambda: config)
+    if not contents:
+        # a backup that was interrupted may only have the checkpoint segments of its log
+        contents = checkpoint_mod.get_segments(machine_path+"/"+bk.timestamp+"/bkp/bkp."+bk.timestamp+".log",lambda: config,verbose)
+
+    if contents:
+        if verbose:
+            print("Found log file and processing it", file=sys.stderr)
+
+        records = [ log_record( *entry ) for entry in log_entries(contents) ]
+        if cache and cache_mod.cacheable_log(bk.time):
+            cache.put(machine_path,bk.timestamp,records)
+        for r in records:
+            yield r
+    else:
+        # ok this is a screwed up one that doesn't have a log so recurse using ls and build the list off of that
+        for l in io.StringIO(fs_mod.fs_ls(bk.path,True,lambda: config)):
+            prefix,path = re.split(bk.timestamp,l)
+            path = path.strip()
+            local_path = urllib.request.url2pathname(path)
+            yield (local_path,bk.path+path[1:],"transferred","na",None,None,"")
+
+def get_backup_files( bk, machine_path, config, verbose = False, with_status = False ):
+    """ generator that yields the local path of each file in a backup, or ( local_path, status ) if with_status is True """
+    for r in get_backup_entries( bk, machine_path, config, verbose ):
+        yield (r[0],r[2]) if with_status else r[0]
+
+def update_index( machine_path, config, file_index, verbose = False ):
+    """ bring the local index of backed up files up to date with the backups on the remote, only fetches logs for backups that are not in the index """
+    # read next first so that a backup that finishes while we are updating causes another update next time
+    next = get_contents( machine_path, "next", verbose, lambda: config )
+    backups = get_backups( machine_path, config, verbose )
+    indexed = file_index.get_timestamps()
+    for bk in backups:
+        if bk.timestamp in indexed:
+            indexed.remove(bk.timestamp)
+            continue
+        if verbose:
+            print("Indexing backup: ",bk.path, file=sys.stderr)
+        file_index.add_backup( bk.timestamp, bk.time, ((r[0],r[2],r[4],r[5]) for r in get_backup_entries( bk, machine_path, config, verbose )))
+    # anything left has been compacted away on the remote
+    for timestamp in indexed:
+        file_index.remove_backup(timestamp)
+    if next:
+        file_index.set_next(float(next))
+    else:
+        file_index.set_next(0.0)
+
+def rebuild_index( config, verbose = False ):
+    """ discard the local index of backed up files for this machine and rebuild it from the remote backup logs """
+    machine_path = config["bucket"]+"/bkp/"+platform.node()
+    file_index = index_mod.FileIndex(machine_path).open()
+    try:
+        file_index.clear()
+        file_index.clear_objects( dedup_mod.objects_prefix(config["bucket"]) )
+        file_index.clear_objects( chunk_mod.chunks_prefix(config["bucket"]) )
+        update_index( machine_path, config, file_index, verbose )
+    finally:
+        file_index.close()
+    return 0
 
 def list( config, verbose = False ):
     """ generate a listing of all of the files backed up for this machine with the dates available """
@@ -130,6 +233,7 @@ def compact( config, dryrun = False, verbose = False):
     base_path = config["bucket"]+"/bkp/"
 
     machines = get_machines(base_path,config)
+    empty_backups = []
     for m in machines:
         machine_path = base_path+m
         backups = get_backups(machine_path, config, verbose)
@@ -147,15 +251,25 @@ def compact( config, dryrun = False, verbose = False):
                         print("Found directory: ",m.group(2), file=sys.stderr)
                     if not m.group(2).endswith("/bkp/"):
                         empty = False
+            # deduplicated files are stored outside of the backup so check the log for them too
+            if empty:
+                for local_path,status in get_backup_files( b, machine_path, config, verbose, True ):
+                    if status != "error":
+                        if verbose:
+                            print("Found logged file: ",local_path, file=sys.stderr)
+                        empty = False
+                        break
             if empty:
-                if not dryrun:
-                    fs_mod.fs_del(backup_path,True,lambda: config)
+                empty_backups.append(backup_path)
                 if verbose:
-                    print("Removed empty backup: ",backup_path, file=sys.stderr)
+                    print("Removing empty backup: ",backup_path, file=sys.stderr)
             else:
                 if verbose:
                     print("Skipped removing non-empty backup: ",backup_path, file=sys.stderr)
 
+    # backends that can delete in batches remove all of the empty backups together, the rest remove them one at a time
+    if empty_backups and not dryrun:
+        fs_mod.fs_del_many(empty_backups,True,lambda: config)
     return 0
 
 def check_interrupted( verbose, config ):
@@ -184,13 +298,26 @@ class BackupJob:
         self.backup_path = ""
         self.remote_log_name = ""
         self.local_log_name = ""
-        self.errors_count = 0
-        self.worker_thread_pool = []
-        self.work_queue = queue.Queue()
-        self.worker_stop = False
+        # the transfer queue is bounded so the scan blocks instead of holding every pending file in memory
+        self.queue_size = int(config.get("queue_size",1000))
+        self.engine = None
         self.processed_files = {}
-        self.backedup_files = {}
-        self.logger = Logger()
+        self.file_index = None
+        self.timestamp = ""
+        self.walker = TreeWalker(int(config.get("scan_threads",4)))
+        self.matcher = Matcher(config["exclude_dirs"],config["exclude_files"])
+        self.stats = JobStats()
+        self.dedup = bkp_conf.get_flag(config,"dedup")
+        self.chunk_min_size = int(config.get("chunk_min_size",0))
+        self.compress = compress_mod.get_codec(config.get("compress",""))
+        self.pack_threshold = int(config.get("pack_threshold",0))
+        self.pack_size = int(config.get("pack_size",64*1024*1024))
+        self.packer = None
+        self.pack_scans = {}
+        self.logger = Logger(self.queue_size)
+        self.checkpointer = None
+        self.checkpoint_seconds = float(config.get("checkpoint_seconds",checkpoint_mod.default_checkpoint_seconds))
+        self.fs = None
 
     def get_config( self ):
         """ get the config for this backup job """
@@ -199,27 +326,43 @@ class BackupJob:
     def perform_logging( self ):
         """ perform the logging task loop reading the logging queue and write messages to output log file """
         start_time = time.time()
-        while not self.logger.stopped():
-            try:
-                line = self.logger.get()
-                if line:
+        writer = LogWriter(self.local_log_name)
+        checkpointed_lines = 0
+        try:
+            while not self.logger.stopped():
+                try:
+                    # sleep until a line comes in or the buffer or a checkpoint is due, closing the queue wakes us right away
+                    timeout = writer.wait_time()
+                    if writer.lines > checkpointed_lines:
+                        checkpoint_wait = max(0.0, self.checkpoint_seconds - (time.time() - start_time))
+                        timeout = checkpoint_wait if timeout is None else min(timeout, checkpoint_wait)
+                    line = self.logger.get(timeout)
+                    if line:
+                        try:
+                            writer.write(line)
+                            if self.verbose:
+                                print(line, file=sys.stderr)
+                        except:
+                            print("Invalid Log Line!", file=sys.stderr)
+                    if writer.due():
+                        writer.flush()
                     try:
-                        print(line, file=open(self.local_log_name,"a+"))
-                        if self.verbose:
-                            print(line, file=sys.stderr)
+                        # every checkpoint_seconds send what was added to the log file to the server for safe keeping
+                        if writer.lines > checkpointed_lines and time.time() - start_time >= self.checkpoint_seconds:
+                            start_time = time.time()
+                            checkpointed_lines = writer.lines
+                            writer.checkpoint()
+                            if not self.dryrun:
+                                self.checkpointer.checkpoint()
                     except:
-                        print("Invalid Log Line!", file=sys.stderr)
-                try:
-                    # every 5 minutes checkpoint the log file to the server for safe keeping
-                    if time.time() - start_time > 300:
-                        start_time = time.time()
-                        if not self.dryrun:
-                            fs_mod.fs_put(self.local_log_name,self.remote_log_name,lambda: self.config, verbose=self.verbose)
+                        print("Error checkpointing log file!", file=sys.stderr)
                 except:
-                    print("Error checkpointing log file!", file=sys.stderr)
-            except:
-                print("Exception while logging!", file=sys.stderr)
-                continue
+                    print("Exception while logging!", file=sys.stderr)
+                    continue
+        finally:
+            writer.close()
+            self.stats.set("log_lines", writer.lines)
+            self.stats.set("log_flushes", writer.flushes)
 
     def set_dryrun( self, dr ):
         """ set the dryrun flag to true to prevent real actions in s3 """
@@ -241,160 +384,264 @@ class BackupJob:
                 past_config = True
 
 
-    def log_success( self, from_path, to_path ):
-        """ write a log line that indicates the copy of a source path to a destination s3 path, columns are from, to, "transferred", and "na" because there was no error """
-        self.logger.log("%s;%s;transferred;na"%(from_path,to_path))
+    def backup_records( self ):
+        """ return the manifest records for the files logged by this backup with the mtime and size each file had when it was scanned, not what it has now
+            that it may have changed since it was copied """
+        records = {}
+        for entry in log_entries(open(self.local_log_name,"r").read()):
+            records[entry[0]] = log_record( *entry )
+        return [ r for r in records.values() ]
+
+    def finish_backup( self ):
+        """ store the manifest of this backup next to its log and add its files to the local index """
+        records = self.backup_records()
+        manifest_mod.put_manifest( self.machine_path, self.timestamp, records, lambda: self.config, self.verbose )
+        cache = cache_mod.get_cache(self.config)
+        if cache:
+            cache.put( self.machine_path, self.timestamp, records )
+        self.file_index.add_backup( self.timestamp, timestamp2time(self.timestamp), ((r[0],r[2],r[4],r[5]) for r in records) )
+
+    def log_success( self, from_path, to_path, status = "transferred", msg = "na", scanned = ( None, None ) ):
+        """ write a log line that indicates the copy of a source path to a destination s3 path, columns are from, to, "transferred", and "na" because there was no error,
+            scanned is the ( mtime, size ) the file had when it was scanned and is added to the msg for the manifest """
+        mtime, size = scanned
+        if mtime != None:
+            msg = "%s,scanned=%r:%d"%(msg,mtime,size)
+        self.logger.log("%s;%s;%s;%s"%(from_path,to_path,status,msg))
 
     def log_error( self, from_path, to_path, tb ):
         """ write a log line that indicates the copy of a source path to a destination s3 path, columns are from, to, "transferred", and "na" because there was no error """
         self.logger.log("%s;%s;error;%s"%(from_path,to_path,tb.replace("\n","/")))
-        self.errors_count = self.errors_count + 1
-
-    def process_backup( self ):
-        """ thread body for worker thread, loop processing the queue until killed """
+        self.stats.add("errors")
 
-        start_time = time.time()
-        while not self.worker_stop:
+    def put_file( self, params ):
+        """ store a file as its own remote file, compressing it on the way if compression is on and the file is worth compressing """
+        if self.compress and compress_mod.should_compress( params.from_path ):
+            t_file_name = compress_mod.compress_file( params.from_path, self.compress )
             try:
-                # every 5 minutes dump a stack trace if self.verbose
-                if time.time() - start_time > 300:
-                    start_time = time.time()
-                params = self.work_queue.get(True,1)
-                try:
-                    if not self.dryrun:
-                        fs_mod.fs_put( params.from_path, params.to_path, lambda: self.config, verbose=self.verbose )
-                    self.log_success( params.from_path, params.to_path )
-                    self.work_queue.task_done()
-                except:
-                    tb = traceback.format_exc()
-                    print(tb, file=sys.stderr)
-                    self.log_error( params.from_path, params.to_path, tb )
-                    self.work_queue.task_done()
-            except queue.Empty:
-                continue
-            except:
-                self.work_queue.task_done()
-                tb = traceback.format_exc()
-                print(tb, file=sys.stderr)
-                continue
+                self.fs.put( t_file_name, params.to_path, lambda: self.config, verbose=self.verbose )
+                self.stats.add("compressed_files")
+                self.stats.add("compressed_bytes_in",os.path.getsize(params.from_path))
+                self.stats.add("compressed_bytes_out",os.path.getsize(t_file_name))
+            finally:
+                os.remove(t_file_name)
+            self.log_success( params.from_path, params.to_path, "transferred", "compressed=%s"%self.compress, (params.mtime, params.size) )
+        else:
+            self.fs.put( params.from_path, params.to_path, lambda: self.config, verbose=self.verbose )
+            self.log_success( params.from_path, params.to_path, scanned = (params.mtime, params.size) )
+
+    def put_packed( self, params ):
+        """ add a small file to the current pack and store the pack if that filled it """
+        # the members are logged when their pack is stored
+        self.pack_scans[params.from_path] = (params.mtime, params.size)
+        full = self.packer.add( params.from_path )
+        if full:
+            self.store_pack( full )
+
+    def store_pack( self, pack ):
+        """ store a pack and log each file in it with the offset and length of its data in the pack """
+        try:
+            pack.store( lambda: self.config, self.verbose )
+        except:
+            tb = traceback.format_exc()
+            print(tb, file=sys.stderr)
+            for local_path, offset, length, codec in pack.members:
+                self.pack_scans.pop( local_path, None )
+                self.log_error( local_path, pack.remote_path, tb )
+            return
+        self.stats.add("packs_stored")
+        self.stats.add("packed_files",len(pack.members))
+        for local_path, offset, length, codec in pack.members:
+            self.log_success( local_path, pack.remote_path, "packed", "%d,%d"%(offset,length) + (",compressed=%s"%codec if codec else ""), self.pack_scans.pop( local_path, ( None, None ) ) )
+
+    def put_chunked( self, params ):
+        """ store a large file as content defined chunks shared across the bucket and log the chunk list as the file's remote path """
+        list_path = params.to_path + ".chunks"
+        digest = chunk_mod.put_chunked( params.from_path, list_path, self.config["bucket"], lambda: self.config, self.verbose, self.file_index, self.stats )
+        self.log_success( params.from_path, list_path, "chunked", "sha256=%s"%digest, (params.mtime, params.size) )
+
+    def put_deduped( self, params ):
+        """ store the content of a file once in the bucket under its hash and log the object path as the file's remote path """
+        digest = dedup_mod.file_hash( params.from_path )
+        object_path = dedup_mod.object_path( self.config["bucket"], digest )
+        status = "deduped"
+        # a worker backing up a file with the same content at the same time stores it and this one waits for it
+        claimed = object_path if self.file_index.claim_object( object_path ) else None
+        try:
+            if claimed:
+                # another machine sharing the bucket may already have stored it
+                mtime, size = self.fs.stat( object_path, lambda: self.config )
+                if size < 0 or size != os.stat(params.from_path).st_size:
+                    t_file_name, digest, size = dedup_mod.copy_and_hash( params.from_path )
+                    try:
+                        # the file may have changed since we hashed it, the copy always matches its hash
+                        object_path = dedup_mod.object_path( self.config["bucket"], digest )
+                        self.fs.put( t_file_name, object_path, lambda: self.config, verbose=self.verbose )
+                    finally:
+                        os.remove(t_file_name)
+                    status = "transferred"
+                    self.stats.add("dedup_bytes_stored", size)
+                self.file_index.add_object( object_path, size )
+        finally:
+            if claimed:
+                self.file_index.release_object( claimed )
+        if status == "deduped":
+            self.stats.add("dedup_files_skipped")
+        self.log_success( params.from_path, object_path, status, "sha256=%s"%digest, (params.mtime, params.size) )
+
+    def backup_file( self, params ):
+        """ transfer task that stores one file the way its size and the config call for """
+        if self.dryrun:
+            self.log_success( params.from_path, params.to_path, scanned = (params.mtime, params.size) )
+        elif self.chunk_min_size and os.stat(params.from_path).st_size >= self.chunk_min_size:
+            self.put_chunked( params )
+        # empty files are stored on their own, a member with no bytes can't be read back with a ranged get
+        elif self.packer and 0 < os.stat(params.from_path).st_size < self.pack_threshold:
+            self.put_packed( params )
+        elif self.dedup:
+            self.put_deduped( params )
+        else:
+            self.put_file( params )
+
+    def backup_done( self, future ):
+        """ called by the transfer engine when a file's transfer is done, logs it if it failed """
+        if future.traceback:
+            params = future.args[0]
+            self.pack_scans.pop( params.from_path, None )
+            print(future.traceback, file=sys.stderr)
+            self.log_error( params.from_path, params.to_path, future.traceback )
+
+    def flush_packs( self ):
+        """ store the partly filled pack left at the end of a backup """
+        if self.packer:
+            last = self.packer.close()
+            if last:
+                self.store_pack( last )
+
+    def discard_packs( self ):
+        """ throw away a pack that won't be stored because the backup failed """
+        if self.packer:
+            last = self.packer.close()
+            if last:
+                last.discard()
 
     def start_workers( self ):
-        """ start the workers in the pool """
-        num_threads = int(self.config["threads"])
+        """ start the transfer engine that runs the file transfers """
+        self.engine = transfer_mod.make_engine( self.config, self.queue_size, self.verbose_log if self.verbose else None ).start()
 
-        while num_threads:
-            t = threading.Thread(target=self.process_backup)
-            t.start()
-            self.worker_thread_pool.append(t)
-            num_threads = num_threads - 1
+    def queue_backup( self, local_path, remote_path, s ):
+        """ submit a file to the transfer engine to be backed up, s is the lstat it had when it was scanned """
+        self.engine.submit( self.backup_file, WorkerParams( local_path, remote_path, s.st_mtime, s.st_size ), backend=self.fs.scheme, size=s.st_size, callback=self.backup_done )
 
     def stop_workers( self ):
-        """ stop the workers """
-        self.worker_stop = True
+        """ cancel the transfers that haven't started, the running ones finish on their own """
+        if self.engine:
+            self.engine.cancel()
 
     def wait_for_workers( self ):
-        """ wait for the worker queue to be empty """
+        """ wait for the transfer engine to finish everything submitted to it and record its statistics """
         if self.verbose:
             print("waiting for workers to finish", file=sys.stderr)
-        if not self.work_queue.empty():
-            self.work_queue.join()
-        self.stop_workers()
-        for t in self.worker_thread_pool:
-            if t.is_alive():
-                t.join()
-        self.worker_thread_pool = []
-        self.worker_stop = False
-        self.work_queue = queue.Queue()
+        self.engine.join()
+        self.engine.record_stats( self.stats )
         if self.verbose:
             print("workers are done", file=sys.stderr)
 
     def backup_directory( self, path ):
         """ enqueue the files to be backed up for a given directory path, apply filters on datetime, pattern, non-hidden files only, recurse visible subdirs """
-        for (dirpath, dirnames, filenames) in os.walk(path):
+        # if the directory itself is excluded there is nothing to scan
+        e = self.matcher.exclude_dir( path )
+        if e:
             if self.verbose:
-                print("Scanning dirpath=",dirpath, file=sys.stderr)
-            # if exclude_dirs is contained in any of the paths then return
-            exclude_dir = False
-            for e in self.config["exclude_dirs"]:
-                if e and re.search(e,dirpath):
-                    exclude_dir = True
-                    break
-            if exclude_dir:
+                print("Excluding dirpath=",path,"because of e=",e, file=sys.stderr)
+            return
+        self.walker.walk( path, self.backup_entries )
+        return
+
+    def verbose_log( self, msg ):
+        """ print a message to stderr, used as a callback when verbose """
+        print(msg, file=sys.stderr)
+
+    def backup_entries( self, dirpath, dirnames, filenames ):
+        """ called by the tree walker for each directory, possibly from several threads, with lists of os.DirEntry for the subdirectories and files """
+        if self.verbose:
+            print("Scanning dirpath=",dirpath, file=sys.stderr)
+
+        # get rid of hidden directories
+        for d in [d for d in dirnames if d.name[0] == "."]:
+            if self.verbose:
+                print("Deleting hidden directory =",d.name, file=sys.stderr)
+            dirnames.remove(d)
+
+        # prune the excluded directories so the walker never descends into them
+        self.matcher.prune( dirpath, dirnames, self.verbose_log if self.verbose else None )
+
+        # process files in the directory enqueueing included files for backup
+        for entry in filenames:
+            f = entry.name
+            # if it is a hidden file skip it
+            if f[0] == ".":
                 if self.verbose:
-                    print("Excluding dirpath=",dirpath,"because of e=",e, file=sys.stderr)
+                    print("Skipping hidden file =",f, file=sys.stderr)
                 continue
 
-            # get rid of hidden directories
-            while True:
-                deleted = False
-                didx = 0
-                for d in dirnames:
-                    if d[0] == ".":
-                        if self.verbose:
-                            print("Deleting hidden directory =",d, file=sys.stderr)
-                        del dirnames[didx]
-                        deleted = True
-                        break
-                    didx = didx + 1
-                if not deleted:
-                    break
-
-            # process files in the directory enqueueing included files for backup
-            for f in filenames:
-                # if it is a hidden file skip it
-                if f[0] == ".":
-                    if self.verbose:
-                        print("Skipping hidden file =",f, file=sys.stderr)
-                    continue
-
-                # if it is excluded file skip it
-                if self.config["exclude_files"] and re.match(self.config["exclude_files"],f):
-                    if self.verbose:
-                        print("Excluding file =",f,"Because of pattern=",self.config["exclude_files"], file=sys.stderr)
-                    continue
+            # if it is excluded file skip it
+            e = self.matcher.exclude_file( dirpath, f )
+            if e:
+                if self.verbose:
+                    print("Excluding file =",f,"Because of pattern=",e, file=sys.stderr)
+                continue
 
-                # build the absolute path for the file and it's backup path
-                local_path = os.path.join(os.path.abspath(dirpath),f)
-                remote_path = self.backup_path + urllib.request.pathname2url(local_path)
+            # build the absolute path for the file and it's backup path
+            local_path = os.path.join(os.path.abspath(dirpath),f)
+            remote_path = self.backup_path + urllib.request.pathname2url(local_path)
 
-                # make sure local_path isn't in self.processed_files
-                if local_path in self.processed_files:
-                    if self.verbose:
-                        print("Excluding file = ",local_path,"Because in processed_files", file=sys.stderr)
-                    continue
+            # make sure local_path isn't in self.processed_files
+            if local_path in self.processed_files:
+                if self.verbose:
+                    print("Excluding file = ",local_path,"Because in processed_files", file=sys.stderr)
+                continue
 
-                # if the file is in the time range for this backup then queue it for backup
-                s = os.lstat(local_path)
-                if (s.st_mtime >= self.start_time and s.st_mtime < self.end_time):
-                    if self.verbose:
-                        print("Enqueuing copy work",local_path,remote_path, file=sys.stderr)
-                    self.work_queue.put(WorkerParams( local_path, remote_path ))
-                elif not (local_path in self.backedup_files):
-                    if self.verbose:
-                        print("Enqueuing copy work because not in backup",local_path,remote_path, file=sys.stderr)
-                    self.work_queue.put(WorkerParams( local_path, remote_path ))
-                else:
-                    if self.verbose:
-                        print("Not Enqueuing copy work for ", local_path, "because time is out of range and it is backed up", file=sys.stderr)
+            # if the file is in the time range for this backup then queue it for backup
+            # the walker's directory entry has the lstat of the file
+            s = entry.stat(follow_symlinks=False)
+            if (s.st_mtime >= self.start_time and s.st_mtime < self.end_time):
+                if self.verbose:
+                    print("Enqueuing copy work",local_path,remote_path, file=sys.stderr)
+                self.queue_backup( local_path, remote_path, s )
+            elif not (local_path in self.file_index):
+                if self.verbose:
+                    print("Enqueuing copy work because not in backup",local_path,remote_path, file=sys.stderr)
+                self.queue_backup( local_path, remote_path, s )
+            else:
+                if self.verbose:
+                    print("Not Enqueuing copy work for ", local_path, "because time is out of range and it is backed up", file=sys.stderr)
 
-        return
+    def record_scan_stats( self ):
+        """ record the statistics from scanning the directories in the job summary """
+        self.stats.set("dirs_scanned", self.walker.dirs_scanned)
+        self.stats.set("files_scanned", self.walker.files_scanned)
+        self.stats.set("scan_seconds", self.walker.scan_time)
+        self.stats.set("scan_files_per_sec", self.walker.scan_rate())
 
     def backup( self ):
         """ driver to perform backup """
 
+        # the job has backends of its own, closing them when it is done doesn't touch any other job's
+        self.backends = fs_mod.Backends().use()
         try:
             # reset our internal state for another run of backup
             self.init(self.config)
 
+            # the backend for the bucket is resolved once and shared by all of the workers
+            self.fs = fs_mod.get_backend(self.config["bucket"])
+
             # check for any aborted backups and send an e-mail about them
             check_interrupted(self.verbose,self.config)
 
             # the backups for a given machine will be in s3://bucket/bkp/machine_name
             self.machine_path = self.config["bucket"]+"/bkp/"+platform.node()
 
-            # get the backed up files for this machine
-            self.backedup_files = get_backedup_files(self.machine_path,self.config,self.verbose)
-
             # the start time for the next backup is in the "next" file in the root for that machine
             # if it is empty or doesn't exist then we start from the beginning of time
             # first thing we do is write the current time to the "next" file for the next backup
@@ -404,6 +651,13 @@ class BackupJob:
                 self.start_time = float(next)
             else:
                 self.start_time = 0.0
+
+            # open the local index of the backed up files for this machine, it only needs to be
+            # updated from the remote logs if some other backup has run since we last updated it
+            self.file_index = index_mod.FileIndex(self.machine_path).open()
+            if not self.file_index.is_built() or self.file_index.get_next() != self.start_time:
+                update_index(self.machine_path,self.config,self.file_index,self.verbose)
+
             self.end_time = time.time()
             put_contents( self.machine_path, "next", self.end_time, self.dryrun, lambda: self.config, self.verbose )
             end_time_t = time.localtime(self.end_time)
@@ -412,15 +666,22 @@ class BackupJob:
 
             # the backup root path is  s3://bucket/bkp/machine_name/datetime
             timestamp = "%04d.%02d.%02d.%02d.%02d.%02d"%(end_time_t.tm_year, end_time_t.tm_mon, end_time_t.tm_mday, end_time_t.tm_hour, end_time_t.tm_min, end_time_t.tm_sec)
+            self.timestamp = timestamp
             self.backup_path = self.machine_path + "/" + timestamp
 
+            # small files are packed together into pack files next to the log
+            if self.pack_threshold:
+                self.packer = pack_mod.PackWriter( self.backup_path + "/bkp/packs", self.pack_size, self.compress )
+
             # we log locally and snapshot the log to a remote version in the backup
             # directory
             self.remote_log_name = self.backup_path + "/bkp/bkp."+ timestamp + ".log"
             self.local_log_name = os.path.expanduser("~/.bkp/bkp."+timestamp+".log")
+            self.checkpointer = checkpoint_mod.LogCheckpointer(self.fs,self.local_log_name,self.remote_log_name,lambda: self.config,self.verbose)
 
             # write config and restart info to the start of the local log
-            bkp_conf.save_config(self.config,open(self.local_log_name,"a+"),True)
+            with open(self.local_log_name,"a+") as log_file:
+                bkp_conf.save_config(self.config,log_file,True)
 
             # start the logger thread
             self.logger.start_logger( self.perform_logging )
@@ -431,34 +692,62 @@ class BackupJob:
             # loop over the paths provided and add them to the work queue
             for d in self.config["dirs"]:
                 self.backup_directory( d )
+            self.record_scan_stats()
 
             # wait for queue to empty
             self.wait_for_workers()
 
+            # store the last pack
+            self.flush_packs()
+
             # wait for the logger to finish
             self.logger.wait_for_logger()
 
-            # snapshot the log
+            # finish the remote copy of the log
             if not self.dryrun:
-                fs_mod.fs_put(self.local_log_name,self.remote_log_name,lambda: self.config, verbose=self.verbose)
+                self.checkpointer.finish()
+                self.stats.set("log_bytes_uploaded", self.checkpointer.bytes_sent)
+
+            # store the manifest and record this backup in the local index, the index is now current as of our end time
+            if not self.dryrun:
+                self.finish_backup()
+                self.file_index.set_next(self.end_time)
+            self.file_index.close()
+            self.backends.done()
         except:
             self.stop_workers()
             self.logger.stop_logger()
+            self.discard_packs()
+            if self.file_index:
+                self.file_index.close()
+            self.backends.done()
             raise
 
         # send the log to the logging e-mail
-        if self.errors_count:
-            mail_error( None, open(self.local_log_name,"r"), self.verbose, lambda: self.config )
+        return self.finish()
+
+    def finish( self ):
+        """ send the log and the job summary to the logging e-mail, remove the local log and return the exit status """
+        self.stats.set("log_thread_cpu_seconds", self.logger.cpu_seconds)
+        self.stats.set("log_queue_peak", self.logger.peak_queue)
+        self.stats.record_peak_memory()
+        summary = self.stats.summary()
+        if self.verbose:
+            print(summary, file=sys.stderr)
+
+        if self.stats.get("errors"):
+            mail_error( summary, open(self.local_log_name,"r"), self.verbose, lambda: self.config )
             os.remove(self.local_log_name)
             return 1
         else:
-            mail_log( None, open(self.local_log_name,"r"), False, self.verbose, lambda: self.config )
+            mail_log( summary, open(self.local_log_name,"r"), False, self.verbose, lambda: self.config )
             os.remove(self.local_log_name)
             return 0
 
     def restart( self, restart_file ):
         """ restart a previously aborted backup from a backup log file """
 
+        self.backends = fs_mod.Backends().use()
         try:
             # load the saved config from the log file
             # restore the original start and end time
@@ -467,11 +756,16 @@ class BackupJob:
             # initialize our internal state for this run
             self.init(self.config)
 
+            # the backend for the bucket is resolved once and shared by all of the workers
+            self.fs = fs_mod.get_backend(self.config["bucket"])
+
             # the backups for a given machine will be in s3://bucket/bkp/machine_name
             self.machine_path = self.config["bucket"]+"/bkp/"+platform.node()
 
-            # get the backed up files for this machine
-            self.backedup_files = get_backedup_files(self.machine_path,self.config,self.verbose)
+            # open the local index of the backed up files for this machine, only build it from the remote if it is missing
+            self.file_index = index_mod.FileIndex(self.machine_path).open()
+            if not self.file_index.is_built():
+                update_index(self.machine_path,self.config,self.file_index,self.verbose)
 
             self.start_time = float(self.config["start_time"])
             self.end_time = float(self.config["end_time"])
@@ -482,13 +776,23 @@ class BackupJob:
 
             # the backup root path is  s3://bucket/bkp/machine_name/datetime
             timestamp = "%04d.%02d.%02d.%02d.%02d.%02d"%(end_time_t.tm_year, end_time_t.tm_mon, end_time_t.tm_mday, end_time_t.tm_hour, end_time_t.tm_min, end_time_t.tm_sec)
+            self.timestamp = timestamp
             self.backup_path = self.machine_path + "/" + timestamp
 
+            # small files are packed together into pack files next to the log
+            if self.pack_threshold:
+                self.packer = pack_mod.PackWriter( self.backup_path + "/bkp/packs", self.pack_size, self.compress )
+
             # we log locally and snapshot the log to a remote version in the backup
             # directory
             self.remote_log_name = self.backup_path + "/bkp/bkp."+ timestamp + ".log"
             self.local_log_name = os.path.expanduser("~/.bkp/bkp."+timestamp+".log")
 
+            # pick up the checkpoints of the log from where the interrupted backup left off
+            self.checkpointer = checkpoint_mod.LogCheckpointer(self.fs,self.local_log_name,self.remote_log_name,lambda: self.config,self.verbose)
+            if not self.dryrun:
+                self.checkpointer.resume()
+
             # start the logger thread
             self.logger.start_logger( self.perform_logging )
 
@@ -498,29 +802,35 @@ class BackupJob:
             # loop over the paths provided and add them to the work queue
             for d in self.config["dirs"]:
                 self.backup_directory( d )
+            self.record_scan_stats()
 
             # wait for queue to empty
             self.wait_for_workers()
 
+            # store the last pack
+            self.flush_packs()
+
             # wait for the logger to finish
             self.logger.wait_for_logger()
 
-            # snapshot the log
+            # finish the remote copy of the log
+            if not self.dryrun:
+                self.checkpointer.finish()
+                self.stats.set("log_bytes_uploaded", self.checkpointer.bytes_sent)
+
+            # store the manifest and record the restarted backup in the local index
             if not self.dryrun:
-                fs_mod.fs_put(self.local_log_name,self.remote_log_name,lambda: self.config, verbose=self.verbose)
+                self.finish_backup()
         finally:
             self.stop_workers()
             self.logger.stop_logger()
+            self.discard_packs()
+            if self.file_index:
+                self.file_index.close()
+            self.backends.done()
 
         if self.verbose:
             print("Exiting backup", file=sys.stderr)
 
         # send the log to the logging e-mail
-        if self.errors_count:
-            mail_error( None, open(self.local_log_name,"r"), self.verbose, lambda: self.config )
-            os.remove(self.local_log_name)
-            return 1
-        else:
-            mail_log( None, open(self.local_log_name,"r"), False, self.verbose, lambda: self.config )
-            os.remove(self.local_log_name)
-            return 0
+        return self.finish()
@@ -0,0 +1,121 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement a local cache of the file lists of finished backups so they aren't fetched from the remote on every run of the bkp tools """
+import os
+import time
+import hashlib
+import tempfile
+import threading
+from bkp_core import manifest_mod
+
+# a backup whose list came from its log is only cached once it is this old, a log is snapshotted to the remote while a backup
+# is running and a backup without a manifest might still be running or be restarted, a manifest is only stored at the end
+log_cache_age = 7*24*60*60
+
+caches = {}
+caches_lock = threading.Lock()
+
+class CatalogCache:
+    """ size bounded least recently used cache in ~/.bkp/cache of backup file lists keyed by machine path and backup timestamp """
+    def __init__( self, max_size, cache_dir = "~/.bkp/cache" ):
+        """ constructor takes the most bytes the cache may use and the directory to keep it in """
+        self.max_size = max_size
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.cache_lock = threading.Lock()
+        # the total size of the cache is only scanned for once and then kept up to date as we add to it
+        self.total = None
+
+    def machine_dir( self, machine_path ):
+        """ return the local directory for the cached backups of a machine path """
+        return os.path.join(self.cache_dir,hashlib.sha1(machine_path.encode("utf-8")).hexdigest()[:16])
+
+    def cache_file( self, machine_path, timestamp ):
+        """ return the local file that caches one backup """
+        return os.path.join(self.machine_dir(machine_path),timestamp+".manifest")
+
+    def get( self, machine_path, timestamp ):
+        """ return the cached list of ( local_path, remote_path, status, msg, mtime, size, digest ) records for a backup or None """
+        path = self.cache_file( machine_path, timestamp )
+        try:
+            with open(path,"rb") as f:
+                records = [ r for r in manifest_mod.read_manifest(f) ]
+            # the modified time of a cache file is its last use
+            os.utime(path,None)
+            return records
+        except Exception:
+            return None
+
+    def put( self, machine_path, timestamp, records ):
+        """ cache the records for a backup and evict the least recently used backups if the cache is over its size """
+        d = self.machine_dir( machine_path )
+        os.makedirs(d,exist_ok=True)
+        # write to a temporary file and rename it so other bkp processes never see part of a file
+        t_file_fh, t_file_name = tempfile.mkstemp(dir=d)
+        try:
+            with os.fdopen(t_file_fh,"wb") as f:
+                manifest_mod.write_manifest( f, records )
+            size = os.path.getsize(t_file_name)
+            os.replace(t_file_name,self.cache_file( machine_path, timestamp ))
+        except:
+            os.remove(t_file_name)
+            raise
+        with self.cache_lock:
+            if self.total != None:
+                self.total += size
+        if self.total == None or self.total > self.max_size:
+            self.evict()
+
+    def remove( self, machine_path, timestamp ):
+        """ drop a backup from the cache """
+        try:
+            os.remove(self.cache_file( machine_path, timestamp ))
+        except OSError:
+            pass
+
+    def prune( self, machine_path, timestamps ):
+        """ drop the cached backups for a machine path that aren't in timestamps any more because they were compacted away """
+        d = self.machine_dir( machine_path )
+        if not os.path.isdir(d):
+            return
+        timestamps = set(timestamps)
+        for name in os.listdir(d):
+            if name.endswith(".manifest") and name[:-len(".manifest")] not in timestamps:
+                self.remove( machine_path, name[:-len(".manifest")] )
+
+    def evict( self ):
+        """ remove the least recently used backups until the cache fits in its size """
+        with self.cache_lock:
+            files = []
+            total = 0
+            for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+                for name in filenames:
+                    try:
+                        s = os.stat(os.path.join(dirpath,name))
+                    except OSError:
+                        continue
+                    files.append( (s.st_mtime, s.st_size, os.path.join(dirpath,name)) )
+                    total += s.st_size
+            files.sort()
+            for mtime, size, path in files:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+            self.total = total
+
+def get_cache( config ):
+    """ return the catalog cache for the config or None if the cache_size config is 0 """
+    max_size = int(config.get("cache_size",256*1024*1024))
+    if not max_size:
+        return None
+    cache_dir = os.path.expanduser("~/.bkp/cache")
+    with caches_lock:
+        if (cache_dir,max_size) not in caches:
+            caches[(cache_dir,max_size)] = CatalogCache( max_size, cache_dir )
+        return caches[(cache_dir,max_size)]
+
+def cacheable_log( timestamp_time ):
+    """ return True if a backup at timestamp_time is old enough that a list that came from its log can be cached """
+    return time.time() - timestamp_time > log_cache_age
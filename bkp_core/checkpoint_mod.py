@@ -0,0 +1,105 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement incremental checkpoints of a growing backup log to the remote for the bkp tool """
+import os
+import re
+import io
+import tempfile
+from bkp_core import fs_mod
+
+# a checkpoint only sends what was added to the log since the last one, backends that can append add it to the end of the
+# remote log, the others get it as numbered segments next to where the log will be which are replaced by the whole log at the end
+default_checkpoint_seconds = 300
+segment_format = "%s.%06d"
+
+def segment_paths( remote_log, get_config = lambda: {} ):
+    """ return a list of ( number, path, size ) for the checkpoint segments of remote_log in order """
+    base = os.path.basename(remote_log)
+    segments = []
+    try:
+        listing = fs_mod.fs_ls( remote_log[:remote_log.rindex("/")+1], False, get_config )
+    except:
+        return segments
+    for l in io.StringIO(listing):
+        parts = l.split()
+        if len(parts) < 4 or parts[-2] == "DIR":
+            continue
+        m = re.match(re.escape(base)+r"\.(\d{6})$", os.path.basename(parts[-1]))
+        if m:
+            segments.append(( int(m.group(1)), parts[-1], int(parts[-2]) ))
+    segments.sort()
+    return segments
+
+def get_segments( remote_log, get_config = lambda: {}, verbose = False ):
+    """ return the contents of the checkpoint segments of a log that was never finished stitched together, "" if there aren't any """
+    contents = []
+    for number, path, size in segment_paths( remote_log, get_config ):
+        t_file_fh, t_file_name = tempfile.mkstemp()
+        os.close(t_file_fh)
+        try:
+            fs_mod.fs_get( path, t_file_name, get_config )
+            contents.append(open(t_file_name,"r").read())
+        finally:
+            os.remove(t_file_name)
+    return "".join(contents)
+
+class LogCheckpointer:
+    """ uploads the part of a local log that was added since the last checkpoint """
+    def __init__( self, fs, local_log, remote_log, get_config = lambda: {}, verbose = False ):
+        """ takes the backend for the remote log, the local log path and the remote log path """
+        self.fs = fs
+        self.local_log = local_log
+        self.remote_log = remote_log
+        self.get_config = get_config
+        self.verbose = verbose
+        self.append = fs.has( fs_mod.APPEND )
+        self.offset = 0
+        self.segment = 0
+        self.bytes_sent = 0
+
+    def resume( self ):
+        """ find out how much of the log a restarted backup already checkpointed, returns self """
+        if self.append:
+            mtime, size = self.fs.stat( self.remote_log, self.get_config )
+            self.offset = max(size,0)
+        else:
+            segments = segment_paths( self.remote_log, self.get_config )
+            self.offset = sum([ s[2] for s in segments ])
+            self.segment = segments[-1][0]+1 if segments else 0
+        return self
+
+    def checkpoint( self ):
+        """ send what was added to the local log since the last checkpoint """
+        size = os.path.getsize(self.local_log)
+        if size <= self.offset:
+            return
+        t_file_fh, t_file_name = tempfile.mkstemp()
+        try:
+            with open(self.local_log,"rb") as f, os.fdopen(t_file_fh,"wb") as out:
+                f.seek(self.offset)
+                remaining = size - self.offset
+                while remaining:
+                    block = f.read(min(remaining,1024*1024))
+                    if not block:
+                        break
+                    out.write(block)
+                    remaining -= len(block)
+            if self.append:
+                self.fs.append( t_file_name, self.remote_log, self.get_config )
+            else:
+                self.fs.put( t_file_name, segment_format%(self.remote_log,self.segment), self.get_config, verbose=self.verbose )
+                self.segment += 1
+        finally:
+            os.remove(t_file_name)
+        self.bytes_sent += size - self.offset
+        self.offset = size
+
+    def finish( self ):
+        """ make the remote log complete, backends without append get the whole log once and the segments are removed """
+        if self.append:
+            self.checkpoint()
+            return
+        self.fs.put( self.local_log, self.remote_log, self.get_config, verbose=self.verbose )
+        self.bytes_sent += os.path.getsize(self.local_log)
+        segments = [ s[1] for s in segment_paths( self.remote_log, self.get_config ) ]
+        if segments:
+            self.fs.delete_many( segments, False, self.get_config )
@@ -0,0 +1,189 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement content defined chunking of large files so only the changed parts of them are stored for the bkp tool """
+import os
+import hashlib
+import tempfile
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from bkp_core import fs_mod
+from bkp_core.file_mod import safe_path
+
+# chunk boundaries are content defined, a gear hash rolls over every byte and a chunk ends where the top boundary_bits
+# bits of the hash are all zero, each byte shifts the hash left one bit so the top bits depend on the last 64 bytes and
+# inserting or removing data only changes the chunks around the edit, the first min_chunk_size bytes of a chunk are
+# skipped since it can't end there so on average a chunk is min_chunk_size plus 2**boundary_bits bytes
+min_chunk_size = 256*1024
+max_chunk_size = 4*1024*1024
+boundary_bits = 20
+boundary_mask = ((1 << boundary_bits) - 1) << (64 - boundary_bits)
+window_size = 64
+read_size = 8*1024*1024
+# with numpy the hashes are computed with array operations this many bytes at a time, a boundary is usually found in the first few blocks
+scan_size = 64*1024
+
+# the gear table maps each byte value to a fixed pseudo random 64 bit number, it has to be the same everywhere so the same data is cut the same way
+gear = [ int.from_bytes( hashlib.sha256( b"bkp gear %d"%i ).digest()[:8], "big" ) for i in range(0,256) ]
+gear_array = numpy.array( gear, dtype=numpy.uint64 ) if numpy else None
+
+chunk_list_header = "bkp-chunks 1"
+
+def find_boundary( buf, start, end ):
+    """ return the offset in buf just past the first chunk boundary between start and end or -1 if there isn't one, buf is a memoryview so nothing is copied """
+    if numpy:
+        return find_boundary_numpy( buf, start, end )
+    return find_boundary_python( buf, start, end )
+
+def find_boundary_numpy( buf, start, end ):
+    """ find_boundary with array operations, the hash at each byte is the sum of the gear values of the 64 bytes ending there each shifted left by
+        its distance from the end, which is built up by doubling the number of bytes summed six times instead of rolling over each byte """
+    mask = numpy.uint64(boundary_mask)
+    while start < end:
+        stop = min(end,start+scan_size)
+        lo = max(0,start-window_size)
+        h = gear_array[ numpy.frombuffer( buf[lo:stop], dtype=numpy.uint8 ) ]
+        m = 1
+        while m < window_size:
+            h[m:] += h[:-m] << numpy.uint64(m)
+            m *= 2
+        hits = numpy.flatnonzero( (h[start-lo:] & mask) == 0 )
+        if hits.size:
+            return start + int(hits[0]) + 1
+        start = stop
+    return -1
+
+def find_boundary_python( buf, start, end ):
+    """ find_boundary rolling the hash over one byte at a time, used when numpy isn't installed """
+    table = gear
+    mask = boundary_mask
+    h = 0
+    for b in buf[max(0,start-window_size):start]:
+        h = ((h << 1) + table[b]) & 0xffffffffffffffff
+    for i, b in enumerate(buf[start:end], start+1):
+        h = ((h << 1) + table[b]) & 0xffffffffffffffff
+        if not (h & mask):
+            return i
+    return -1
+
+def chunks( f ):
+    """ generator that reads the file object f and yields its content defined chunks as bytes """
+    # the buffer is a bytearray so reads are appended in place and each chunk is dropped from its front without copying the rest
+    buf = bytearray()
+    eof = False
+    while True:
+        # keep at least a max chunk in the buffer so every boundary can be found
+        while not eof and len(buf) < max_chunk_size:
+            block = f.read(read_size)
+            if not block:
+                eof = True
+            else:
+                buf += block
+        if not buf:
+            return
+        if len(buf) <= min_chunk_size:
+            if eof:
+                yield bytes(buf)
+                return
+        end = min(len(buf),max_chunk_size)
+        with memoryview(buf) as view:
+            cut = find_boundary( view, min_chunk_size, end )
+            if cut < 0:
+                cut = end
+            chunk = bytes(view[:cut])
+        del buf[:cut]
+        yield chunk
+
+def chunk_path( bucket, digest ):
+    """ return the path in the bucket of the chunk with the hex digest, chunks are shared by all machines that back up to the bucket """
+    return bucket + "/chunks/" + digest[:2] + "/" + digest
+
+def chunks_prefix( bucket ):
+    """ return the prefix of all of the chunk paths in the bucket """
+    return bucket + "/chunks/"
+
+def put_chunked( local_path, list_path, bucket, get_config = lambda: {}, verbose = False, file_index = None, stats = None ):
+    """ split the file at local_path into chunks, store the chunks that aren't already in the bucket and put the list of chunks at list_path, returns the sha256 hex digest of the whole file """
+    file_hash = hashlib.sha256()
+    size = 0
+    chunk_list = []
+    with open(local_path,"rb") as f:
+        for chunk in chunks( f ):
+            file_hash.update(chunk)
+            size += len(chunk)
+            digest = hashlib.sha256(chunk).hexdigest()
+            chunk_list.append("%s %d"%(digest,len(chunk)))
+            put_chunk( chunk, chunk_path( bucket, digest ), get_config, verbose, file_index, stats )
+
+    t_file_fh, t_file_name = tempfile.mkstemp()
+    try:
+        with os.fdopen(t_file_fh,"w") as t:
+            print(chunk_list_header, file=t)
+            print("size %d"%size, file=t)
+            print("sha256 %s"%file_hash.hexdigest(), file=t)
+            for c in chunk_list:
+                print(c, file=t)
+        fs_mod.fs_put( t_file_name, list_path, get_config, verbose )
+    finally:
+        os.remove(t_file_name)
+    return file_hash.hexdigest()
+
+def put_chunk( chunk, path, get_config = lambda: {}, verbose = False, file_index = None, stats = None ):
+    """ put one chunk at path unless it is already known to be stored there """
+    if stats:
+        stats.add("chunks")
+    # a file backed up at the same time that shares the chunk stores it and this one waits for it
+    if file_index and not file_index.claim_object( path ):
+        return
+    try:
+        mtime, size = fs_mod.fs_stat( path, get_config )
+        if size != len(chunk):
+            t_file_fh, t_file_name = tempfile.mkstemp()
+            try:
+                with os.fdopen(t_file_fh,"wb") as t:
+                    t.write(chunk)
+                fs_mod.fs_put( t_file_name, path, get_config, verbose )
+            finally:
+                os.remove(t_file_name)
+            if stats:
+                stats.add("chunks_stored")
+                stats.add("chunk_bytes_stored",len(chunk))
+        if file_index:
+            file_index.add_object( path, len(chunk) )
+    finally:
+        if file_index:
+            file_index.release_object( path )
+
+def get_chunked( list_path, local_path, bucket, get_config = lambda: {} ):
+    """ fetch the chunk list at list_path and reassemble the file it describes at local_path """
+    t_file_fh, t_file_name = tempfile.mkstemp()
+    os.close(t_file_fh)
+    try:
+        fs_mod.fs_get( list_path, t_file_name, get_config )
+        lines = [l.strip() for l in open(t_file_name,"r") if l.strip()]
+    finally:
+        os.remove(t_file_name)
+
+    if not lines or lines[0] != chunk_list_header:
+        raise Exception("get_chunked: Not a chunk list",list_path)
+    size = int(lines[1].split()[1])
+    expected_hash = lines[2].split()[1]
+
+    file_hash = hashlib.sha256()
+    t_file_fh, t_file_name = tempfile.mkstemp()
+    os.close(t_file_fh)
+    try:
+        with open(safe_path(local_path),"wb") as out:
+            for l in lines[3:]:
+                digest, length = l.split()
+                fs_mod.fs_get( chunk_path( bucket, digest ), t_file_name, get_config )
+                chunk = open(t_file_name,"rb").read()
+                if len(chunk) != int(length) or hashlib.sha256(chunk).hexdigest() != digest:
+                    raise Exception("get_chunked: Corrupt chunk",chunk_path( bucket, digest ))
+                file_hash.update(chunk)
+                out.write(chunk)
+    finally:
+        os.remove(t_file_name)
+
+    if file_hash.hexdigest() != expected_hash or os.path.getsize(local_path) != size:
+        raise Exception("get_chunked: Reassembled file does not match",list_path,local_path)
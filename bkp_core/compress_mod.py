@@ -0,0 +1,145 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement the optional compression of files before they are stored and their transparent decompression for the bkp tool """
+import os
+import math
+import zlib
+import shutil
+import tempfile
+import collections
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# compressed files start with this marker followed by one byte naming the codec, the log entry of a compressed file says
+# compressed=codec and only files logged that way are decompressed, any other file is restored as it was stored whatever it starts with
+magic = b"\x89BKZ\r\n\x1a\n"
+codec_ids = { "gzip" : b"g", "zstd" : b"z" }
+
+block_size = 1024*1024
+sample_size = 64*1024
+min_size = 1024
+max_entropy = 7.5
+
+skip_extensions = set([ ".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".mp4", ".m4a", ".m4v", ".mov", ".avi",
+                        ".mkv", ".webm", ".ogg", ".flac", ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".7z", ".rar",
+                        ".jar", ".whl", ".docx", ".xlsx", ".pptx", ".pdf", ".dmg", ".iso" ])
+
+def zstd_available():
+    """ return True if one of the zstd modules can be imported """
+    return bool(zstd or zstandard)
+
+def get_codec( name ):
+    """ map the compress config value to a codec name or None if compression is off, zstd falls back to gzip if it isn't available """
+    if not name or name in [ "False", "false", "none", "0" ]:
+        return None
+    if name in [ "zstd", "True", "true", "1" ]:
+        return "zstd" if zstd_available() else "gzip"
+    if name == "gzip":
+        return name
+    raise Exception("get_codec: Unknown compression",name)
+
+def compressor( codec ):
+    """ return a streaming compressor object with compress() and flush() methods for the codec """
+    if codec == "gzip":
+        return zlib.compressobj(6,zlib.DEFLATED,31)
+    elif zstd:
+        c = zstd.ZstdCompressor()
+        class ZstdStream:
+            def compress( self, data ):
+                return c.compress(data)
+            def flush( self ):
+                return c.flush(zstd.ZstdCompressor.FLUSH_FRAME)
+        return ZstdStream()
+    else:
+        return zstandard.ZstdCompressor().compressobj()
+
+def decompressor( codec ):
+    """ return a streaming decompressor object with a decompress() method for the codec """
+    if codec == "gzip":
+        return zlib.decompressobj(31)
+    elif zstd:
+        return zstd.ZstdDecompressor()
+    elif zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise Exception("decompressor: zstd is not available to decompress this file")
+
+def entropy( data ):
+    """ return the shannon entropy of data in bits per byte """
+    if not data:
+        return 0.0
+    total = float(len(data))
+    return -sum( (c/total)*math.log(c/total,2) for c in collections.Counter(data).values() )
+
+def should_compress( path ):
+    """ return True if the file at path is worth compressing, small files, files with compressed extensions and files whose content looks random are skipped """
+    if os.path.splitext(path)[1].lower() in skip_extensions:
+        return False
+    size = os.path.getsize(path)
+    if size < min_size:
+        return False
+    with open(path,"rb") as f:
+        sample = f.read(sample_size//2)
+        if size > sample_size:
+            f.seek(size//2)
+            sample += f.read(sample_size//2)
+    return entropy(sample) < max_entropy
+
+def compress_file( path, codec ):
+    """ stream the file at path through the codec into a temporary file with the marker, returns the path of the temporary file """
+    c = compressor( codec )
+    t_file_fh, t_file_name = tempfile.mkstemp()
+    try:
+        with open(path,"rb") as f, os.fdopen(t_file_fh,"wb") as t:
+            t.write(magic + codec_ids[codec])
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                t.write(c.compress(block))
+            t.write(c.flush())
+    except:
+        os.remove(t_file_name)
+        raise
+    return t_file_name
+
+def is_compressed( path ):
+    """ return the codec name if the file at path starts with the compression marker, otherwise None """
+    with open(path,"rb") as f:
+        header = f.read(len(magic)+1)
+    if header.startswith(magic):
+        for codec, id in codec_ids.items():
+            if header[len(magic):] == id:
+                return codec
+    return None
+
+def logged_codec( msg ):
+    """ return the codec named by compressed=codec in the message column of a log entry, None if the file was stored as is """
+    for part in msg.split(","):
+        if part.startswith("compressed="):
+            return part[len("compressed="):]
+    return None
+
+def decompress_file( path, codec ):
+    """ replace the file at path that was compressed with codec with its decompressed content """
+    if is_compressed( path ) != codec:
+        raise Exception("decompress_file: File was not compressed with",codec,path)
+    d = decompressor( codec )
+    t_file_fh, t_file_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with open(path,"rb") as f, os.fdopen(t_file_fh,"wb") as t:
+            f.seek(len(magic)+1)
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                t.write(d.decompress(block))
+        shutil.copystat(path,t_file_name)
+        os.replace(t_file_name,path)
+    except:
+        os.remove(t_file_name)
+        raise
@@ -0,0 +1,45 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement content addressed storage so identical files are only stored once per bucket for the bkp tool """
+import os
+import hashlib
+import tempfile
+
+block_size = 1024*1024
+
+def file_hash( path ):
+    """ return the sha256 hex digest of the contents of the file at path """
+    h = hashlib.sha256()
+    with open(path,"rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def copy_and_hash( path ):
+    """ copy the file at path to a temporary file while hashing it so the content we store always matches its hash, returns ( temp_path, digest, size ) """
+    h = hashlib.sha256()
+    size = 0
+    t_file_fh, t_file_name = tempfile.mkstemp()
+    try:
+        with open(path,"rb") as f, os.fdopen(t_file_fh,"wb") as t:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                h.update(block)
+                t.write(block)
+                size += len(block)
+    except:
+        os.remove(t_file_name)
+        raise
+    return ( t_file_name, h.hexdigest(), size )
+
+def object_path( bucket, digest ):
+    """ return the path in the bucket of the object that holds the content with the hex digest, objects are shared by all machines that back up to the bucket """
+    return bucket + "/objects/" + digest[:2] + "/" + digest
+
+def objects_prefix( bucket ):
+    """ return the prefix of all of the object paths in the bucket """
+    return bucket + "/objects/"
@@ -0,0 +1,91 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement the exclusion rules shared by the bkp, sync and rstr tools """
+import os
+import re
+import threading
+
+def compile_patterns( patterns ):
+    """ compile a list of python regular expressions once, empty patterns are dropped, returns a list of ( pattern, compiled ) """
+    return [ (p, re.compile(p)) for p in patterns if p ]
+
+def match_any( compiled_patterns, path ):
+    """ return the first pattern from compile_patterns that matches the start of path or None """
+    for p, c in compiled_patterns:
+        if c.match(path):
+            return p
+    return None
+
+def search_any( compiled_patterns, path ):
+    """ return the first pattern from compile_patterns that is found anywhere in path or None """
+    for p, c in compiled_patterns:
+        if c.search(path):
+            return p
+    return None
+
+class Matcher:
+    """ compiled exclude_dirs and exclude_files rules plus the rules from .bkpignore files, a .bkpignore holds one python regular expression per line that is matched against the names of files and directories in its directory and all of its subdirectories """
+    def __init__( self, exclude_dirs = [], exclude_files = "", ignore_file = ".bkpignore" ):
+        """ constructor takes the list of exclude_dirs patterns, the exclude_files pattern and the name of the per directory ignore file """
+        self.dir_patterns = compile_patterns( exclude_dirs )
+        self.file_patterns = compile_patterns( [exclude_files] )
+        self.ignore_file = ignore_file
+        self.cache_lock = threading.Lock()
+        self.ignore_cache = {}
+        self.dir_cache = {}
+
+    def ignore_rules( self, dirpath ):
+        """ return the compiled rules from the .bkpignore files in dirpath and its parent directories """
+        with self.cache_lock:
+            if dirpath in self.ignore_cache:
+                return self.ignore_cache[dirpath]
+
+        parent = os.path.dirname(dirpath)
+        if parent and parent != dirpath:
+            rules = self.ignore_rules( parent )
+        else:
+            rules = []
+
+        ignore_path = os.path.join(dirpath,self.ignore_file)
+        if self.ignore_file and os.path.isfile(ignore_path):
+            try:
+                patterns = [l.strip() for l in open(ignore_path,"r") if l.strip() and not l.strip().startswith("#")]
+                rules = rules + compile_patterns( patterns )
+            except (OSError, re.error):
+                pass
+
+        with self.cache_lock:
+            self.ignore_cache[dirpath] = rules
+        return rules
+
+    def exclude_dir( self, dirpath ):
+        """ return the exclude_dirs pattern or .bkpignore rule that excludes the directory at dirpath or None """
+        with self.cache_lock:
+            if dirpath in self.dir_cache:
+                return self.dir_cache[dirpath]
+
+        e = search_any( self.dir_patterns, dirpath )
+        if not e:
+            parent, name = os.path.split(dirpath)
+            if name:
+                e = match_any( self.ignore_rules( parent ), name )
+
+        with self.cache_lock:
+            self.dir_cache[dirpath] = e
+        return e
+
+    def exclude_file( self, dirpath, name ):
+        """ return the exclude_files pattern or .bkpignore rule that excludes the file name in dirpath or None """
+        e = match_any( self.file_patterns, name )
+        if not e:
+            e = match_any( self.ignore_rules( dirpath ), name )
+        return e
+
+    def prune( self, dirpath, dirnames, verbose_log = None ):
+        """ remove the excluded subdirectories of dirpath from the list dirnames in place so they are never scanned, entries may be names or os.DirEntry """
+        for d in [d for d in dirnames]:
+            name = getattr(d,"name",d)
+            e = self.exclude_dir( os.path.join(dirpath,name) )
+            if e:
+                if verbose_log:
+                    verbose_log("Excluding dirpath= %s because of e= %s"%(os.path.join(dirpath,name),e))
+                dirnames.remove(d)
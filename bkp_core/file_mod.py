@@ -9,8 +9,6 @@ import threading
 import sys
 import math
 
-file_safe_path_lock = threading.Lock()
-
 def strip_protocol( path ):
     """ strip off file:// from start of path """
     if path.startswith("file://"):
@@ -18,17 +16,74 @@ def strip_protocol( path ):
     else:
         return path
 
-def safe_path( path ):
-    """ make sure that the target path exists """
-    try:
-        file_safe_path_lock.acquire()
-        d = os.path.dirname(path)
-        if not os.path.exists(d):
-            os.makedirs(d)
-    finally:
-        file_safe_path_lock.release()
+class DirCache:
+    """ thread safe set of the directories that are known to exist, only one thread at a time checks or makes a given directory and the others wait for it, checks of different directories don't wait for each other """
+    def __init__( self ):
+        self.known = set()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def ensure( self, path, make, parent = os.path.dirname ):
+        """ make sure the directory path exists, make( path ) is called to check or create it unless it is already known to exist, once it has succeeded path and all of its parents are known to exist """
+        while path not in self.known:
+            with self.lock:
+                if path in self.known:
+                    return
+                event = self.pending.get(path)
+                if event == None:
+                    event = threading.Event()
+                    self.pending[path] = event
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                # if the other thread failed we try it ourselves
+                event.wait()
+                continue
+            try:
+                make( path )
+                with self.lock:
+                    p = path
+                    while p not in self.known:
+                        self.known.add(p)
+                        up = parent(p)
+                        if up == p:
+                            break
+                        p = up
+            finally:
+                with self.lock:
+                    del self.pending[path]
+                event.set()
+
+    def forget( self, path ):
+        """ forget path and everything under it after it has been removed """
+        with self.lock:
+            self.known = set([ p for p in self.known if p != path and not p.startswith(path.rstrip("/")+"/") ])
+
+    def clear( self ):
+        """ forget all of the directories """
+        with self.lock:
+            self.known = set()
+
+def safe_path( path, dir_cache = None ):
+    """ make sure that the directory of the target path exists, with a dir_cache the directories it knows exist aren't checked again """
+    d = os.path.dirname(os.path.abspath(path))
+    if dir_cache:
+        dir_cache.ensure( d, lambda d: os.makedirs(d, exist_ok=True) )
+    else:
+        os.makedirs(d, exist_ok=True)
     return path
 
+def cached_write( path, dir_cache, write ):
+    """ return write( path ) once the directory of path exists, if dir_cache thought it existed but it was removed behind its back it is forgotten and write is tried once more """
+    try:
+        return write( safe_path( path, dir_cache ) )
+    except FileNotFoundError:
+        if not dir_cache:
+            raise
+        dir_cache.forget( os.path.dirname(os.path.abspath(path)) )
+        return write( safe_path( path, dir_cache ) )
+
 def file_utime( remote_path, times ):
     """ set the file time on the target to the times specified """
     os.utime(strip_protocol(remote_path), times )
@@ -37,9 +92,31 @@ def file_get( remote_path, local_path ):
     """ copy from remote_path to local_path """
     shutil.copy2(strip_protocol(remote_path),safe_path(local_path))
 
-def file_put( local_path, remote_path ):
+def file_get_range( remote_path, local_path, offset, length ):
+    """ copy length bytes starting at offset in remote_path to local_path """
+    with open(strip_protocol(remote_path),"rb") as f, open(safe_path(local_path),"wb") as out:
+        f.seek(offset)
+        while length:
+            block = f.read(min(length,1024*1024))
+            if not block:
+                raise Exception("file_get_range: File is truncated",remote_path)
+            out.write(block)
+            length -= len(block)
+
+def file_put( local_path, remote_path, dir_cache = None ):
     """ copy from local_path to remote_path """
-    shutil.copy2(local_path,safe_path(strip_protocol(remote_path)))
+    cached_write( strip_protocol(remote_path), dir_cache, lambda path: shutil.copy2(local_path,path) )
+
+def file_copy( from_path, to_path, dir_cache = None ):
+    """ copy one remote file to another """
+    cached_write( strip_protocol(to_path), dir_cache, lambda path: shutil.copy2(strip_protocol(from_path),path) )
+
+def file_append( local_path, remote_path, dir_cache = None ):
+    """ append the contents of local_path to the end of remote_path creating it if it doesn't exist """
+    def append( path ):
+        with open(local_path,"rb") as f, open(path,"ab") as out:
+            shutil.copyfileobj(f,out)
+    cached_write( strip_protocol(remote_path), dir_cache, append )
 
 def file_ls( remote_path, recurse=False ):
     """ perform ls on the path, recurse to subdirectories if recurse is true """
@@ -71,10 +148,12 @@ def file_ls( remote_path, recurse=False ):
     return output
 
 
-def file_del( remote_path, recurse=False ):
+def file_del( remote_path, recurse=False, dir_cache = None ):
     """ perform del on path, recurse and delete subdirectory contents if recurse is true """
     remote_path = strip_protocol(remote_path)
     if os.path.isdir(remote_path):
+        if dir_cache:
+            dir_cache.forget(os.path.abspath(remote_path))
         for root,dirs,files in os.walk(remote_path, not recurse):
             for f in files:
                 os.remove(os.path.join(os.path.abspath(root),f))
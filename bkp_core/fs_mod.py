@@ -4,98 +4,376 @@ from bkp_core import s3_mod
 from bkp_core import ssh_mod
 from bkp_core import file_mod
 from bkp_core import bkp_conf
+from bkp_core import compress_mod
+from bkp_core import dedup_mod
+import threading
+import contextvars
 import re
+import os
 
-def fs_utime( remote_path, times, get_config = lambda: {} ):
-    """ use the appropriate function to set the access and modified times on a file """
-    if remote_path.startswith("ssh://"):
-        return ssh_mod.ssh_utime( remote_path, times, get_config )
-    elif remote_path.startswith("s3://"):
+# capabilities a backend can advertise with has()
+BATCH_STAT = "batch_stat"
+RANGED_READ = "ranged_read"
+SERVER_COPY = "server_copy"
+APPEND = "append"
+BATCH_DELETE = "batch_delete"
+REMOTE_HASH = "remote_hash"
+
+class Backend:
+    """ base class for the backend for one kind of remote file system, a job's Backends has one open backend object per scheme that is shared by all of the threads of the job so it can keep connections and other state between calls """
+    scheme = ""
+    capabilities = frozenset()
+
+    def __init__( self ):
+        self.is_open = False
+
+    def open( self ):
+        """ get the backend ready for use, returns self """
+        self.is_open = True
+        return self
+
+    def close( self ):
+        """ release anything the backend is holding on to """
+        self.is_open = False
+
+    def release_thread( self ):
+        """ release anything the backend is holding on to for the calling thread, called by worker threads when they are done """
+        pass
+
+    def has( self, capability ):
+        """ return True if the backend supports the capability """
+        return capability in self.capabilities
+
+    def get( self, remote_path, local_path, get_config = lambda: {}, codec = None ):
+        """ copy a file from the remote_path to the local_path, codec is the one its log entry says it was compressed with so it is decompressed, None copies it as it is stored """
+        ret = self.get_file( remote_path, local_path, get_config )
+        if codec:
+            compress_mod.decompress_file( local_path, codec )
+        return ret
+
+    def get_file( self, remote_path, local_path, get_config = lambda: {} ):
+        """ copy a file from the remote_path to the local_path as it is stored """
+        raise Exception("get: Copying from the file system is not supported",remote_path)
+
+    def put( self, local_path, remote_path, get_config = lambda: {}, verbose = False ):
+        """ copy a file from the local_path to the remote_path """
+        raise Exception("put: Copying to the file system is not supported",remote_path)
+
+    def ls( self, remote_path, recurse = False, get_config = lambda: {} ):
+        """ return a listing of the path in the common ls format """
+        raise Exception("ls: Listing is not supported",remote_path)
+
+    def delete( self, remote_path, recurse = False, get_config = lambda: {} ):
+        """ delete a file or directory at the path """
+        raise Exception("delete: Deleting is not supported",remote_path)
+
+    def delete_many( self, remote_paths, recurse = False, get_config = lambda: {} ):
+        """ delete many files or directories, backends with BATCH_DELETE delete them together otherwise they are deleted one at a time """
+        return "".join([ self.delete( p, recurse, get_config ) or "" for p in remote_paths ])
+
+    def stat( self, remote_path, get_config = lambda: {} ):
+        """ return tuple ( mtime, size ) for a path to a file, returns (-1,-1) if doesn't exist resolution of mtime is seconds """
+        raise Exception("stat: Stat is not supported",remote_path)
+
+    def stat_many( self, remote_paths, get_config = lambda: {}, exact_mtime = lambda path, mtime, size: True ):
+        """ return a dict of path to ( mtime, size ) for many paths, backends with BATCH_STAT answer them together and may return a later mtime than the real one where exact_mtime( path, mtime, size ) is False """
+        return dict([ (p,self.stat( p, get_config )) for p in remote_paths ])
+
+    def hash_many( self, remote_paths, get_config = lambda: {} ):
+        """ return a dict of path to sha256 hex digest for the paths that exist, computed where the files are, needs REMOTE_HASH """
+        raise Exception("hash_many: Remote hashing is not supported",remote_paths[0])
+
+    def utime( self, remote_path, times, get_config = lambda: {} ):
+        """ set the access and modified times on a file """
+        raise Exception("utime: Setting file times is not supported",remote_path)
+
+    def test( self, remote_path, verbose = False, get_config = lambda: {} ):
+        """ test if the file system is accessable, does NOT mean the path exists """
+        return True
+
+    def get_range( self, remote_path, local_path, offset, length, get_config = lambda: {} ):
+        """ copy length bytes starting at offset in the file at remote_path to the local_path, needs RANGED_READ """
+        raise Exception("get_range: Ranged reads are not supported",remote_path)
+
+    def copy( self, from_path, to_path, get_config = lambda: {} ):
+        """ copy one remote file to another on the server, needs SERVER_COPY """
+        raise Exception("copy: Server side copy is not supported",from_path)
+
+    def append( self, local_path, remote_path, get_config = lambda: {} ):
+        """ append the contents of local_path to remote_path, needs APPEND """
+        raise Exception("append: Append is not supported",remote_path)
+
+class FileBackend(Backend):
+    """ backend for file:// paths and plain local paths, it remembers the directories it has made for files it writes until it is closed """
+    scheme = "file"
+    capabilities = frozenset([ RANGED_READ, SERVER_COPY, APPEND, REMOTE_HASH ])
+
+    def __init__( self ):
+        Backend.__init__( self )
+        self.dir_cache = file_mod.DirCache()
+
+    def close( self ):
+        self.dir_cache.clear()
+        Backend.close( self )
+
+    def get_file( self, remote_path, local_path, get_config = lambda: {} ):
+        return file_mod.file_get( remote_path, local_path )
+
+    def put( self, local_path, remote_path, get_config = lambda: {}, verbose = False ):
+        return file_mod.file_put( local_path, remote_path, self.dir_cache )
+
+    def ls( self, remote_path, recurse = False, get_config = lambda: {} ):
+        return file_mod.file_ls( remote_path, recurse )
+
+    def delete( self, remote_path, recurse = False, get_config = lambda: {} ):
+        return file_mod.file_del( remote_path, recurse, self.dir_cache )
+
+    def stat( self, remote_path, get_config = lambda: {} ):
+        return file_mod.file_stat( remote_path )
+
+    def hash_many( self, remote_paths, get_config = lambda: {} ):
+        return dict([ (p,dedup_mod.file_hash( file_mod.strip_protocol(p) )) for p in remote_paths if os.path.isfile(file_mod.strip_protocol(p)) ])
+
+    def utime( self, remote_path, times, get_config = lambda: {} ):
+        return file_mod.file_utime( remote_path, times )
+
+    def get_range( self, remote_path, local_path, offset, length, get_config = lambda: {} ):
+        return file_mod.file_get_range( remote_path, local_path, offset, length )
+
+    def copy( self, from_path, to_path, get_config = lambda: {} ):
+        return file_mod.file_copy( from_path, to_path, self.dir_cache )
+
+    def append( self, local_path, remote_path, get_config = lambda: {} ):
+        return file_mod.file_append( local_path, remote_path, self.dir_cache )
+
+class SshBackend(Backend):
+    """ backend for ssh:// paths using sftp, the threads share ssh_connections connections to each host and each keeps its own sftp channel on them open between calls, hosts that allow exec list, stat and hash many files with one command,
+        the connections, channels and what is known about the hosts are this backend's own """
+    scheme = "ssh"
+    capabilities = frozenset([ BATCH_STAT, RANGED_READ, APPEND, REMOTE_HASH ])
+
+    def __init__( self ):
+        Backend.__init__( self )
+        self.sessions = ssh_mod.SshSessions()
+
+    def close( self ):
+        ssh_mod.close_sessions( self.sessions )
+        Backend.close( self )
+
+    def release_thread( self ):
+        ssh_mod.release_thread( self.sessions )
+
+    def get_file( self, remote_path, local_path, get_config = lambda: {} ):
+        return ssh_mod.ssh_get( remote_path, local_path, get_config, sessions = self.sessions )
+
+    def put( self, local_path, remote_path, get_config = lambda: {}, verbose = False ):
+        return ssh_mod.ssh_put( local_path, remote_path, get_config, verbose, sessions = self.sessions )
+
+    def ls( self, remote_path, recurse = False, get_config = lambda: {} ):
+        return ssh_mod.ssh_ls( remote_path, recurse, get_config, sessions = self.sessions )
+
+    def delete( self, remote_path, recurse = False, get_config = lambda: {} ):
+        return ssh_mod.ssh_del( remote_path, recurse, get_config, sessions = self.sessions )
+
+    def stat( self, remote_path, get_config = lambda: {} ):
+        return ssh_mod.ssh_stat( remote_path, get_config, sessions = self.sessions )
+
+    def stat_many( self, remote_paths, get_config = lambda: {}, exact_mtime = lambda path, mtime, size: True ):
+        return ssh_mod.ssh_stat_many( remote_paths, get_config, sessions = self.sessions )
+
+    def hash_many( self, remote_paths, get_config = lambda: {} ):
+        return ssh_mod.ssh_hash_many( remote_paths, get_config, sessions = self.sessions )
+
+    def utime( self, remote_path, times, get_config = lambda: {} ):
+        return ssh_mod.ssh_utime( remote_path, times, get_config, sessions = self.sessions )
+
+    def test( self, remote_path, verbose = False, get_config = lambda: {} ):
+        return ssh_mod.ssh_test( remote_path, verbose, get_config )
+
+    def get_range( self, remote_path, local_path, offset, length, get_config = lambda: {} ):
+        return ssh_mod.ssh_get_range( remote_path, local_path, offset, length, get_config, sessions = self.sessions )
+
+    def append( self, local_path, remote_path, get_config = lambda: {} ):
+        return ssh_mod.ssh_append( local_path, remote_path, get_config, sessions = self.sessions )
+
+class S3Backend(Backend):
+    """ backend for s3:// paths, the threads of every job share one pool of keep alive connections, closing a job's backend leaves it open for the others """
+    scheme = "s3"
+    capabilities = frozenset([ BATCH_STAT, BATCH_DELETE, RANGED_READ, SERVER_COPY ])
+
+    def get_file( self, remote_path, local_path, get_config = lambda: {} ):
+        return s3_mod.s3_get( remote_path, local_path, get_config )
+
+    def put( self, local_path, remote_path, get_config = lambda: {}, verbose = False ):
+        return s3_mod.s3_put( local_path, remote_path, get_config )
+
+    def ls( self, remote_path, recurse = False, get_config = lambda: {} ):
+        return s3_mod.s3_ls( remote_path, recurse, get_config )
+
+    def delete( self, remote_path, recurse = False, get_config = lambda: {} ):
+        return s3_mod.s3_del( remote_path, recurse, get_config )
+
+    def delete_many( self, remote_paths, recurse = False, get_config = lambda: {} ):
+        return s3_mod.s3_del_many( remote_paths, recurse, get_config )
+
+    def stat( self, remote_path, get_config = lambda: {} ):
+        return s3_mod.s3_stat( remote_path )
+
+    def stat_many( self, remote_paths, get_config = lambda: {}, exact_mtime = lambda path, mtime, size: True ):
+        return s3_mod.s3_stat_many( remote_paths, exact_mtime )
+
+    def utime( self, remote_path, times, get_config = lambda: {} ):
         # Not implemented for s3, however s3 defaults to copying all
         # file attributes so we don't have to do it for our use cases
         return
-    elif remote_path.startswith("file://"):
-        return file_mod.file_utime( remote_path, times )
-    elif re.match(r"\w*://.*",remote_path):
-        raise Exception("fs_utime: Unknown remote file system",remote_path)
-    else:
-        return file_mod.file_utime( remote_path, times )
 
+    def test( self, remote_path, verbose = False, get_config = lambda: {} ):
+        return s3_mod.s3_test( remote_path, verbose )
 
-def fs_get( remote_path, local_path, get_config = lambda: {} ):
-    """ use the appropriate function to copy a file from the remote_path to the local_path """
-    if remote_path.startswith("ssh://"):
-        return ssh_mod.ssh_get( remote_path, local_path, get_config )
-    elif remote_path.startswith("s3://"):
-        return s3_mod.s3_get( remote_path, local_path )
-    elif remote_path.startswith("file://"):
-        return file_mod.file_get( remote_path, local_path )
-    elif re.match(r"\w*://.*",remote_path):
-        raise Exception("fs_get: Unknown remote file system",remote_path)
-    else:
-        return file_mod.file_get( remote_path, local_path )
+    def get_range( self, remote_path, local_path, offset, length, get_config = lambda: {} ):
+        return s3_mod.s3_get_range( remote_path, local_path, offset, length )
+
+    def copy( self, from_path, to_path, get_config = lambda: {} ):
+        return s3_mod.s3_copy( from_path, to_path )
+
+backend_classes = { "file" : FileBackend, "ssh" : SshBackend, "s3" : S3Backend }
+
+class Backends:
+    """ the open backends of one job, one per scheme, all of the threads of the job share them and they are closed together when the job is done without touching the backends of any other job """
+    def __init__( self ):
+        self.backends = {}
+        self.lock = threading.Lock()
+        self.token = None
+
+    def use( self ):
+        """ make these the backends the fs_ functions use in the calling thread and the threads it starts with thread() until done is called, returns self """
+        self.token = current_backends.set( self )
+        return self
+
+    def done( self ):
+        """ close the backends and go back to the ones the calling thread used before use was called """
+        self.close()
+        if self.token:
+            current_backends.reset( self.token )
+            self.token = None
+
+    def get( self, remote_path ):
+        """ return the open backend for the file system of remote_path, it is created and opened the first time it is asked for """
+        scheme = get_scheme( remote_path )
+        backend = self.backends.get(scheme)
+        if backend:
+            return backend
+        with self.lock:
+            if scheme not in self.backends:
+                if scheme not in backend_classes:
+                    raise Exception("get_backend: Unknown remote file system",remote_path)
+                self.backends[scheme] = backend_classes[scheme]().open()
+            return self.backends[scheme]
+
+    def drop( self, scheme ):
+        """ close and forget the backend for scheme if one is open """
+        with self.lock:
+            old = self.backends.pop(scheme,None)
+        if old:
+            old.close()
+
+    def release_thread( self ):
+        """ let each open backend release what it is holding for the calling thread, the backends stay open for the other threads """
+        with self.lock:
+            open_backends = [ b for b in self.backends.values() ]
+        for b in open_backends:
+            b.release_thread()
+
+    def close( self ):
+        """ close all of the open backends, they are opened again if they are used after this """
+        with self.lock:
+            closing = [ b for b in self.backends.values() ]
+            self.backends.clear()
+        for b in closing:
+            b.close()
+
+# the backends of the calls made outside of a job, a job uses Backends of its own in its thread and the threads it starts with thread()
+default_backends = Backends()
+current_backends = contextvars.ContextVar( "current_backends", default = default_backends )
+
+def thread( target, *args ):
+    """ return a threading.Thread that runs target( *args ) with the backends of the calling thread """
+    return threading.Thread( target = contextvars.copy_context().run, args = ( target, )+args )
+
+def register_backend( scheme, backend_class ):
+    """ register the Backend subclass that handles paths starting with scheme:// """
+    backend_classes[scheme] = backend_class
+    default_backends.drop( scheme )
+
+def get_scheme( remote_path ):
+    """ return the scheme of a path, paths without one are local files """
+    idx = remote_path.find("://")
+    if idx < 0 or not re.match(r"\w*$",remote_path[:idx]):
+        return "file"
+    return remote_path[:idx]
+
+def get_backend( remote_path ):
+    """ return the open backend for the file system of remote_path from the backends the calling thread uses """
+    return current_backends.get().get( remote_path )
+
+def close_backends():
+    """ close the backends the calling thread uses, they are opened again if they are used after this """
+    current_backends.get().close()
+
+def release_thread():
+    """ let each of the backends the calling thread uses release what it is holding for it, the backends stay open for the other threads """
+    current_backends.get().release_thread()
+
+def fs_utime( remote_path, times, get_config = lambda: {} ):
+    """ use the appropriate function to set the access and modified times on a file """
+    return get_backend( remote_path ).utime( remote_path, times, get_config )
+
+def fs_get( remote_path, local_path, get_config = lambda: {}, codec = None ):
+    """ use the appropriate function to copy a file from the remote_path to the local_path, decompressing it if codec names the codec it was stored with """
+    return get_backend( remote_path ).get( remote_path, local_path, get_config, codec )
 
 def fs_put( local_path, remote_path, get_config = lambda: {}, verbose = False  ):
     """ use the appropriate function to copy a file from the local_path to the remote_path """
-    if remote_path.startswith("ssh://"):
-        return ssh_mod.ssh_put( local_path, remote_path, get_config, verbose)
-    elif remote_path.startswith("s3://"):
-        return s3_mod.s3_put( local_path, remote_path)
-    elif remote_path.startswith("file://"):
-        return file_mod.file_put( local_path, remote_path )
-    elif re.match(r"\w*://.*",remote_path):
-        raise Exception("fs_put: Unknown remote file system",remote_path)
-    else:
-        return file_mod.file_put( local_path, remote_path )
+    return get_backend( remote_path ).put( local_path, remote_path, get_config, verbose )
+
+def fs_has_range( remote_path ):
+    """ return True if fs_get_range can read part of a file on the file system of the remote_path """
+    return get_backend( remote_path ).has( RANGED_READ )
 
+def fs_get_range( remote_path, local_path, offset, length, get_config = lambda: {} ):
+    """ use the appropriate function to copy length bytes starting at offset in the file at remote_path to the local_path """
+    return get_backend( remote_path ).get_range( remote_path, local_path, offset, length, get_config )
 
 def fs_ls( remote_path, recurse=False, get_config = lambda: {} ):
     """ use the appropriate function to get a file listing of the path """
-    if remote_path.startswith("ssh://"):
-        return ssh_mod.ssh_ls( remote_path, recurse, get_config)
-    elif remote_path.startswith("s3://"):
-        return s3_mod.s3_ls( remote_path, recurse)
-    elif remote_path.startswith("file://"):
-        return file_mod.file_ls( remote_path, recurse )
-    elif re.match(r"\w*://.*",remote_path):
-        raise Exception("fs_ls: Unknown remote file system",remote_path)
-    else:
-        return file_mod.file_ls( remote_path, recurse )
-
+    return get_backend( remote_path ).ls( remote_path, recurse, get_config )
 
 def fs_del( remote_path, recurse=False, get_config = lambda: {} ):
     """ use the appropriate function to delete a file or directory at the path """
-    if remote_path.startswith("ssh://"):
-        return ssh_mod.ssh_del( remote_path, recurse, get_config)
-    elif remote_path.startswith("s3://"):
-        return s3_mod.s3_del( remote_path, recurse)
-    elif remote_path.startswith("file://"):
-        return file_mod.file_del( remote_path, recurse )
-    elif re.match(r"\w*://.*",remote_path):
-        raise Exception("fs_del: Unknown remote file system",remote_path)
-    else:
-        return file_mod.file_del( remote_path, recurse )
+    return get_backend( remote_path ).delete( remote_path, recurse, get_config )
 
+def fs_del_many( remote_paths, recurse=False, get_config = lambda: {} ):
+    """ delete files or directories at paths that are all on one file system, see Backend.delete_many """
+    if not remote_paths:
+        return ""
+    return get_backend( remote_paths[0] ).delete_many( remote_paths, recurse, get_config )
 
 def fs_stat( remote_path, get_config = lambda: {} ):
     """ return tuple ( mtime, size ) for a path to a file, returns (-1,-1) if doesn't exist resolution of mtime is seconds """
-    if remote_path.startswith("ssh://"):
-        return ssh_mod.ssh_stat( remote_path, get_config )
-    elif remote_path.startswith("file://"):
-        return file_mod.file_stat( remote_path )
-    elif remote_path.startswith("s3://"):
-        return s3_mod.s3_stat( remote_path )
-    elif re.match(r"\w*://.*",remote_path):
-        raise Exception("fs_stat: Unknown remote file system", remote_path )
-    else:
-        return file_mod.file_stat( remote_path )
+    return get_backend( remote_path ).stat( remote_path, get_config )
+
+def fs_stat_many( remote_paths, get_config = lambda: {}, exact_mtime = lambda path, mtime, size: True ):
+    """ return a dict of path to ( mtime, size ) for paths that are all on one file system, see Backend.stat_many """
+    if not remote_paths:
+        return {}
+    return get_backend( remote_paths[0] ).stat_many( remote_paths, get_config, exact_mtime )
+
+def fs_hash_many( remote_paths, get_config = lambda: {} ):
+    """ return a dict of path to sha256 hex digest for paths that are all on one file system, see Backend.hash_many """
+    if not remote_paths:
+        return {}
+    return get_backend( remote_paths[0] ).hash_many( remote_paths, get_config )
 
 def fs_test( remote_path, verbose = False, get_config = lambda: {} ):
     """ use the appropriate function to test if file system is accessable, does NOT mean the path exists just that a host is listening  """
-    if remote_path.startswith("ssh://"):
-        return ssh_mod.ssh_test( remote_path, verbose, get_config)
-    elif remote_path.startswith("s3://"):
-        return s3_mod.s3_test( remote_path, verbose )
-    else:
-        # We assume the filesystem is always available
-        return True
+    return get_backend( remote_path ).test( remote_path, verbose, get_config )
@@ -0,0 +1,193 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement a local index of the files backed up for a machine so bkp doesn't have to replay every remote backup log """
+import os
+import sqlite3
+import threading
+
+class FileIndex:
+    """ sqlite index in ~/.bkp that maps each backed up path for a machine to the times, mtimes and sizes of its backed up versions """
+    def __init__( self, machine_path, index_file = "~/.bkp/bkp_index.db" ):
+        """ constructor takes the machine path in the bucket and the path of the index database """
+        self.machine_path = machine_path
+        self.index_file = os.path.expanduser(index_file)
+        self.index_lock = threading.Lock()
+        # objects a worker is storing right now, others with the same content wait on its event instead of storing it again
+        self.storing = {}
+        self.db = None
+
+    def open( self ):
+        """ open the index database creating it if it doesn't exist, returns self """
+        index_dir = os.path.dirname(self.index_file)
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self.db = sqlite3.connect(self.index_file, check_same_thread=False)
+        # the index can always be rebuilt from the remote so we don't need to sync on every commit
+        self.db.execute("pragma journal_mode = wal")
+        self.db.execute("pragma synchronous = normal")
+        self.db.executescript("""
+            create table if not exists machines ( machine_path text primary key, next real );
+            create table if not exists backups ( machine_path text, timestamp text, time real, primary key ( machine_path, timestamp ) );
+            create table if not exists files ( machine_path text, local_path text, time real, mtime real, size integer, primary key ( machine_path, local_path, time ) );
+            create table if not exists objects ( object_path text primary key, size integer );
+            """)
+        self.db.commit()
+        return self
+
+    def close( self ):
+        """ close the index database """
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def query( self, sql, args = () ):
+        """ run a query against the index and return all of the rows """
+        with self.index_lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def is_built( self ):
+        """ return True if the index has been built for this machine path """
+        return bool(self.query("select 1 from machines where machine_path = ?", (self.machine_path,)))
+
+    def get_next( self ):
+        """ return the contents of the remote "next" file the last time the index was brought up to date or None """
+        rows = self.query("select next from machines where machine_path = ?", (self.machine_path,))
+        if rows:
+            return rows[0][0]
+        return None
+
+    def set_next( self, next ):
+        """ record the contents of the remote "next" file that the index is now up to date with """
+        with self.index_lock:
+            self.db.execute("insert or replace into machines ( machine_path, next ) values ( ?, ? )", (self.machine_path, next))
+            self.db.commit()
+
+    def get_timestamps( self ):
+        """ return the set of backup timestamps that are in the index """
+        return set([ r[0] for r in self.query("select timestamp from backups where machine_path = ?", (self.machine_path,)) ])
+
+    def add_backup( self, timestamp, time, entries ):
+        """ add or replace the files for a backup, entries is an iterable of ( local_path, status, mtime, size ) tuples, errors are not recorded """
+        with self.index_lock:
+            self.db.execute("delete from files where machine_path = ? and time = ?", (self.machine_path, time))
+            self.db.execute("insert or replace into backups ( machine_path, timestamp, time ) values ( ?, ?, ? )", (self.machine_path, timestamp, time))
+            self.db.executemany("insert or replace into files ( machine_path, local_path, time, mtime, size ) values ( ?, ?, ?, ?, ? )",
+                ((self.machine_path, local_path, time, mtime, size) for local_path, status, mtime, size in entries if status != "error"))
+            self.db.commit()
+
+    def remove_backup( self, timestamp ):
+        """ remove a backup and its files from the index """
+        with self.index_lock:
+            for (time,) in self.db.execute("select time from backups where machine_path = ? and timestamp = ?", (self.machine_path, timestamp)).fetchall():
+                self.db.execute("delete from files where machine_path = ? and time = ?", (self.machine_path, time))
+            self.db.execute("delete from backups where machine_path = ? and timestamp = ?", (self.machine_path, timestamp))
+            self.db.commit()
+
+    def clear( self ):
+        """ remove everything in the index for this machine path """
+        with self.index_lock:
+            self.db.execute("delete from files where machine_path = ?", (self.machine_path,))
+            self.db.execute("delete from backups where machine_path = ?", (self.machine_path,))
+            self.db.execute("delete from machines where machine_path = ?", (self.machine_path,))
+            self.db.commit()
+
+    def add_object( self, object_path, size ):
+        """ record that the content addressed object at object_path is stored in the bucket """
+        with self.index_lock:
+            self.db.execute("insert or replace into objects ( object_path, size ) values ( ?, ? )", (object_path, size))
+            self.db.commit()
+
+    def claim_object( self, object_path ):
+        """ return True if the caller should store the object at object_path and then call release_object, False once it is known to be stored,
+            waits while another thread is storing it """
+        while True:
+            with self.index_lock:
+                storing = self.storing.get(object_path)
+                if not storing:
+                    if self.db.execute("select 1 from objects where object_path = ?", (object_path,)).fetchone():
+                        return False
+                    self.storing[object_path] = threading.Event()
+                    return True
+            storing.wait()
+
+    def release_object( self, object_path ):
+        """ let the threads waiting in claim_object for object_path go, if it wasn't added the next one stores it """
+        with self.index_lock:
+            storing = self.storing.pop(object_path,None)
+        if storing:
+            storing.set()
+
+    def clear_objects( self, prefix ):
+        """ forget all of the content addressed objects with paths starting with prefix """
+        with self.index_lock:
+            self.db.execute("delete from objects where substr(object_path,1,?) = ?", (len(prefix), prefix))
+            self.db.commit()
+
+    def __contains__( self, local_path ):
+        """ test to see if there is any backed up version of local_path """
+        return bool(self.query("select 1 from files where machine_path = ? and local_path = ? limit 1", (self.machine_path, local_path)))
+
+    def get_versions( self, local_path ):
+        """ return a list of ( time, mtime, size ) for each backed up version of local_path oldest first """
+        return self.query("select time, mtime, size from files where machine_path = ? and local_path = ? order by time", (self.machine_path, local_path))
+
+    def get_backedup_files( self ):
+        """ return a dict with all of the files in the index mapped to a list of backup times like bkp_mod.get_backedup_files """
+        backedup = {}
+        for local_path, time in self.query("select local_path, time from files where machine_path = ? order by time", (self.machine_path,)):
+            if local_path in backedup:
+                backedup[local_path].append(time)
+            else:
+                backedup[local_path] = [time]
+        return backedup
+
+class PathSet:
+    """ set of paths kept in a private temporary sqlite database that spills to disk, for jobs that have to remember every file they have seen without holding them all in memory """
+    def __init__( self, paths = () ):
+        """ constructor takes paths to start the set with """
+        # an empty name is a temporary database that sqlite deletes when it is closed, it is never synced
+        self.db = sqlite3.connect("", check_same_thread=False, isolation_level=None)
+        self.db.execute("pragma synchronous = off")
+        self.db.execute("create table paths ( path text primary key )")
+        self.lock = threading.Lock()
+        self.count = 0
+        for p in paths:
+            self.add( p )
+
+    def add( self, path ):
+        """ add path to the set, returns True if it wasn't already in it """
+        with self.lock:
+            added = self.db.execute("insert or ignore into paths ( path ) values ( ? )", (path,)).rowcount == 1
+            if added:
+                self.count += 1
+            return added
+
+    def __contains__( self, path ):
+        """ test to see if path is in the set """
+        with self.lock:
+            return bool(self.db.execute("select 1 from paths where path = ?", (path,)).fetchone())
+
+    def __len__( self ):
+        """ return the number of paths in the set """
+        return self.count
+
+    def __iter__( self ):
+        """ generator that yields the paths in the set in sorted order a batch at a time """
+        last = None
+        while True:
+            with self.lock:
+                if last == None:
+                    rows = self.db.execute("select path from paths order by path limit 1000").fetchall()
+                else:
+                    rows = self.db.execute("select path from paths where path > ? order by path limit 1000", (last,)).fetchall()
+            if not rows:
+                return
+            for (path,) in rows:
+                yield path
+            last = rows[-1][0]
+
+    def close( self ):
+        """ close the set and remove its database """
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
@@ -4,12 +4,80 @@ import os
 import traceback
 import queue
 import threading
+import contextvars
+import time
+from bkp_core.queue_mod import WorkQueue, Closed
+
+# log files are written through a buffer that is flushed when it has this many bytes or its oldest line is this many seconds old
+flush_bytes = 64*1024
+flush_seconds = 1.0
+
+class LogWriter:
+    """ keeps a log file open for appending and buffers the lines written to it, only the logger thread writes to it """
+    def __init__( self, path ):
+        self.path = path
+        self.file = None
+        self.buffer = []
+        self.buffered = 0
+        self.oldest = 0.0
+        self.lines = 0
+        self.flushes = 0
+        self.syncs = 0
+
+    def write( self, line ):
+        """ add a line to the log, the buffer is flushed if it is full """
+        if not self.buffer:
+            self.oldest = time.time()
+        self.buffer.append(line+"\n")
+        self.buffered += len(line)+1
+        self.lines += 1
+        if self.buffered >= flush_bytes:
+            self.flush()
+
+    def due( self ):
+        """ return True if the oldest buffered line has waited long enough to be written """
+        return bool(self.buffer) and time.time() - self.oldest >= flush_seconds
+
+    def wait_time( self ):
+        """ return the seconds until the buffer is due to be written, None if there is nothing buffered """
+        if not self.buffer:
+            return None
+        return max(0.0, flush_seconds - (time.time() - self.oldest))
+
+    def flush( self ):
+        """ write the buffered lines to the file """
+        if not self.buffer:
+            return
+        if not self.file:
+            self.file = open(self.path,"a")
+        self.file.write("".join(self.buffer))
+        self.file.flush()
+        self.buffer = []
+        self.buffered = 0
+        self.flushes += 1
+
+    def checkpoint( self ):
+        """ flush the buffer and make sure the file is on disk so it is a usable restart file if we crash """
+        self.flush()
+        if self.file:
+            os.fsync(self.file.fileno())
+            self.syncs += 1
+
+    def close( self ):
+        """ write everything out and close the file """
+        self.checkpoint()
+        if self.file:
+            self.file.close()
+            self.file = None
 
 class Logger:
-    def __init__( self ):
+    def __init__( self, queue_size = 0 ):
         self.logger_thread = None
         self.logger_stop = False
-        self.logger_queue = queue.Queue()
+        self.queue_size = queue_size
+        self.logger_queue = WorkQueue(self.queue_size)
+        self.cpu_seconds = 0.0
+        self.peak_queue = 0
 
     def perform_log( self ):
         """ read from the restore logging queue and print messages to stderr """
@@ -25,38 +93,49 @@ class Logger:
         """ start the restore logger thread """
         if not action:
             action = self.perform_log
-        self.logger_thread = threading.Thread(target=action)
+        def run():
+            start = time.thread_time()
+            try:
+                action()
+            finally:
+                self.cpu_seconds += time.thread_time() - start
+        # the logger thread runs with a copy of the caller's context so what it writes goes through the job's backends
+        self.logger_thread = threading.Thread(target=contextvars.copy_context().run,args=(run,))
         self.logger_thread.start()
 
     def stop_logger( self ):
-        """ stop the restore logger """
+        """ stop the restore logger without writing what is still queued, wakes the logger thread right away """
         self.logger_stop = True
+        self.logger_queue.close()
 
     def wait_for_logger( self ):
-        """ wait until the restore log queue is empty """
-
-        if not self.logger_queue.empty():
-            self.logger_queue.join()
-        self.stop_logger()
-        if self.logger_thread and self.logger_thread.is_alive():
+        """ close the log queue and wait for the logger thread to write everything in it and exit """
+        self.logger_queue.close()
+        if self.logger_thread:
             self.logger_thread.join()
         self.logger_thread = None
         self.logger_stop = False
-        self.logger_queue = queue.Queue()
+        self.logger_queue = WorkQueue(self.queue_size)
 
     def log( self, msg ):
-        """ log a message to the restore logger """
-        self.logger_queue.put(msg)
+        """ log a message to the restore logger, once the logger is stopped the message is dropped since nothing will read it """
+        try:
+            self.logger_queue.put(msg)
+        except Closed:
+            return
+        depth = self.logger_queue.qsize()
+        if depth > self.peak_queue:
+            self.peak_queue = depth
 
-    def get( self ):
-        """ get a message off the queue """
+    def get( self, timeout = None ):
+        """ get a message off the queue, blocks until there is one or the queue is closed, returns None if it is closed or timeout seconds pass """
         try:
-            line = self.logger_queue.get(True,1)
+            line = self.logger_queue.get(True,timeout)
             self.logger_queue.task_done()
-        except queue.Empty:
+        except (queue.Empty, Closed):
             line = None
         return line
 
     def stopped( self ):
-        """ test to see if we need to stop """
-        return self.logger_stop
+        """ test to see if we need to stop, either we were told to or the queue was closed and everything in it has been read """
+        return self.logger_stop or (self.logger_queue.closed and self.logger_queue.empty())
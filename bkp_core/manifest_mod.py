@@ -0,0 +1,162 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement the compact binary manifest of the files in a backup that is stored next to the backup log for the bkp tool """
+import os
+import sys
+import zlib
+import math
+import struct
+import bisect
+import heapq
+import tempfile
+import traceback
+from bkp_core import fs_mod
+
+# a manifest is the magic followed by blocks of records sorted by local path, each block is a 4 byte big endian length and that
+# many bytes of zlib compressed records, a zero length ends the blocks, then comes a compressed block index of the first path,
+# offset and record count of every block followed by the 8 byte offset of the block index and the index magic, so a manifest
+# can be read as a stream from the start or searched from the end
+magic = b"BKPMAN1\n"
+index_magic = b"BKPMANIX"
+block_records = 1024
+
+record_header = struct.Struct(">qd")
+length_format = struct.Struct(">I")
+offset_format = struct.Struct(">Q")
+
+def manifest_name( timestamp ):
+    """ return the path of the manifest of the backup with timestamp relative to the machine path """
+    return timestamp+"/bkp/bkp."+timestamp+".manifest"
+
+def entry_hash( msg ):
+    """ return the sha256 hex digest recorded in a log message or "" if there isn't one """
+    if msg.startswith("sha256="):
+        return msg[7:]
+    return ""
+
+def pack_string( s ):
+    """ encode a string as a length prefixed utf-8 byte string """
+    b = s.encode("utf-8","surrogateescape")
+    return length_format.pack(len(b)) + b
+
+def unpack_string( buf, pos ):
+    """ decode a length prefixed string at pos in buf, returns ( string, next pos ) """
+    length, = length_format.unpack_from(buf,pos)
+    pos += length_format.size
+    return ( buf[pos:pos+length].decode("utf-8","surrogateescape"), pos+length )
+
+def pack_record( record ):
+    """ encode one ( local_path, remote_path, status, msg, mtime, size, digest ) record, a missing mtime or size is stored as nan or -1 """
+    local_path, remote_path, status, msg, mtime, size, digest = record
+    return (record_header.pack( -1 if size == None else size, float("nan") if mtime == None else mtime ) +
+            pack_string(local_path) + pack_string(remote_path) + pack_string(status) + pack_string(msg) + pack_string(digest))
+
+def unpack_records( buf ):
+    """ generator that decodes all of the records in an uncompressed block """
+    pos = 0
+    while pos < len(buf):
+        size, mtime = record_header.unpack_from(buf,pos)
+        pos += record_header.size
+        local_path, pos = unpack_string(buf,pos)
+        remote_path, pos = unpack_string(buf,pos)
+        status, pos = unpack_string(buf,pos)
+        msg, pos = unpack_string(buf,pos)
+        digest, pos = unpack_string(buf,pos)
+        yield ( local_path, remote_path, status, msg, None if math.isnan(mtime) else mtime, None if size < 0 else size, digest )
+
+def write_manifest( f, records ):
+    """ write the records to the binary file object f as a manifest sorted by local path, error tracebacks are left in the log """
+    records = sorted( records, key=lambda r: r[0] )
+    f.write(magic)
+    offset = len(magic)
+    index = []
+    for start in range(0,len(records),block_records):
+        block = records[start:start+block_records]
+        data = zlib.compress(b"".join([ pack_record(r if r[2] != "error" else r[:3]+("",)+r[4:]) for r in block ]))
+        index.append( (block[0][0], offset, len(block)) )
+        f.write(length_format.pack(len(data)))
+        f.write(data)
+        offset += length_format.size + len(data)
+    f.write(length_format.pack(0))
+    index_offset = offset + length_format.size
+    f.write(zlib.compress(b"".join([ pack_string(path) + offset_format.pack(block_offset) + length_format.pack(count) for path, block_offset, count in index ])))
+    f.write(offset_format.pack(index_offset))
+    f.write(index_magic)
+
+def read_manifest( f ):
+    """ generator that reads the manifest from the start of the binary file object f and yields its records in local path order """
+    if f.read(len(magic)) != magic:
+        raise Exception("read_manifest: Not a backup manifest")
+    while True:
+        length, = length_format.unpack(f.read(length_format.size))
+        if not length:
+            return
+        for r in unpack_records(zlib.decompress(f.read(length))):
+            yield r
+
+def read_index( f ):
+    """ read the block index from the end of the seekable binary file object f, returns a list of ( first path, offset, count ) """
+    f.seek(-(offset_format.size+len(index_magic)),os.SEEK_END)
+    end = f.tell()
+    index_offset, = offset_format.unpack(f.read(offset_format.size))
+    if f.read(len(index_magic)) != index_magic:
+        raise Exception("read_index: Not a backup manifest")
+    f.seek(index_offset)
+    buf = zlib.decompress(f.read(end-index_offset))
+    index = []
+    pos = 0
+    while pos < len(buf):
+        path, pos = unpack_string(buf,pos)
+        block_offset, = offset_format.unpack_from(buf,pos)
+        pos += offset_format.size
+        count, = length_format.unpack_from(buf,pos)
+        pos += length_format.size
+        index.append( (path, block_offset, count) )
+    return index
+
+def find( f, local_path, index = None ):
+    """ binary search the seekable manifest file object f for local_path and return its record or None, pass the index from read_index to reuse it """
+    if index == None:
+        index = read_index( f )
+    b = bisect.bisect_right( [ i[0] for i in index ], local_path ) - 1
+    if b < 0:
+        return None
+    f.seek(index[b][1])
+    length, = length_format.unpack(f.read(length_format.size))
+    for r in unpack_records(zlib.decompress(f.read(length))):
+        if r[0] == local_path:
+            return r
+        if r[0] > local_path:
+            break
+    return None
+
+def merge( manifests ):
+    """ merge the record iterators of several manifests into one iterator in local path order """
+    return heapq.merge( *manifests, key=lambda r: r[0] )
+
+def get_manifest( machine_path, timestamp, verbose = False, get_config = lambda: {} ):
+    """ fetch the manifest of a backup and return a list of its records or None if the backup doesn't have one """
+    t_file_fh, t_file_name = tempfile.mkstemp()
+    os.close(t_file_fh)
+    try:
+        try:
+            fs_mod.fs_get( machine_path+"/"+manifest_name(timestamp), t_file_name, get_config, False )
+        except:
+            if verbose:
+                print("get_manifest exception:",traceback.format_exc(), file=sys.stderr)
+            return None
+        if not os.path.getsize(t_file_name):
+            return None
+        with open(t_file_name,"rb") as f:
+            return [ r for r in read_manifest(f) ]
+    finally:
+        os.remove(t_file_name)
+
+def put_manifest( machine_path, timestamp, records, get_config = lambda: {}, verbose = False ):
+    """ write the records as the manifest of a backup and store it next to the backup log """
+    t_file_fh, t_file_name = tempfile.mkstemp()
+    try:
+        with os.fdopen(t_file_fh,"wb") as f:
+            write_manifest( f, records )
+        fs_mod.fs_put( t_file_name, machine_path+"/"+manifest_name(timestamp), get_config, verbose )
+    finally:
+        os.remove(t_file_name)
@@ -0,0 +1,153 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement packing of small files into larger pack files so each small file doesn't cost a remote file of its own for the bkp tool """
+import os
+import uuid
+import shutil
+import tempfile
+import threading
+from bkp_core import fs_mod
+from bkp_core import compress_mod
+from bkp_core.file_mod import safe_path
+
+block_size = 1024*1024
+
+class Pack:
+    """ one pack file being filled locally, members is a list of ( local_path, offset, length, codec ) for the files in it, codec is None for members stored as is """
+    def __init__( self, remote_path ):
+        """ constructor takes the remote path the pack will be stored at """
+        self.remote_path = remote_path
+        t_file_fh, self.local_path = tempfile.mkstemp()
+        self.file = os.fdopen(t_file_fh,"wb")
+        self.size = 0
+        self.members = []
+
+    def add( self, local_path, data, codec = None ):
+        """ append data, the contents of the file at local_path as read by read_member, to the pack """
+        try:
+            self.file.write(data)
+        except:
+            # drop a partly written member so the offsets of the members stay right
+            self.file.seek(self.size)
+            self.file.truncate()
+            raise
+        self.members.append( (local_path, self.size, len(data), codec) )
+        self.size += len(data)
+
+    def store( self, get_config = lambda: {}, verbose = False ):
+        """ put the pack at its remote path and remove the local copy """
+        try:
+            self.file.close()
+            fs_mod.fs_put( self.local_path, self.remote_path, get_config, verbose )
+        finally:
+            self.discard()
+
+    def discard( self ):
+        """ remove the local copy of the pack """
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.local_path):
+            os.remove(self.local_path)
+
+def read_member( local_path, compress = None ):
+    """ return ( data, codec ) for the file at local_path to go in a pack, compressed first if compress names a codec and it is worth it, members are
+        smaller than the pack threshold so they are read whole """
+    codec = None
+    path = local_path
+    if compress and compress_mod.should_compress( local_path ):
+        codec = compress
+        path = compress_mod.compress_file( local_path, compress )
+    try:
+        with open(path,"rb") as f:
+            return ( f.read(), codec )
+    finally:
+        if path != local_path:
+            os.remove(path)
+
+class PackWriter:
+    """ thread safe writer that fills packs under pack_dir and hands back each pack when it reaches pack_size """
+    def __init__( self, pack_dir, pack_size, compress = None ):
+        """ constructor takes the remote directory for the packs, the size a pack is stored at and the codec to compress members with """
+        self.pack_dir = pack_dir
+        self.pack_size = pack_size
+        self.compress = compress
+        # packs from a restarted backup go in the same directory so each run gets its own prefix
+        self.prefix = uuid.uuid4().hex[:12]
+        self.count = 0
+        self.pack = None
+        self.pack_lock = threading.Lock()
+
+    def new_pack( self ):
+        """ start the next pack """
+        self.count += 1
+        self.pack = Pack( "%s/pack.%s.%05d"%(self.pack_dir,self.prefix,self.count) )
+
+    def add( self, local_path ):
+        """ add the file at local_path to the current pack, returns the pack if it is now full and must be stored otherwise None """
+        # the threads read and compress their files at the same time and only take turns appending them
+        data, codec = read_member( local_path, self.compress )
+        with self.pack_lock:
+            if not self.pack:
+                self.new_pack()
+            self.pack.add( local_path, data, codec )
+            if self.pack.size < self.pack_size:
+                return None
+            full = self.pack
+            self.pack = None
+            return full
+
+    def close( self ):
+        """ return the last partly filled pack if there is one so it can be stored, otherwise None """
+        with self.pack_lock:
+            last = self.pack
+            self.pack = None
+            return last
+
+class PackReader:
+    """ thread safe reader for members of packs that uses ranged reads where the file system supports them and otherwise caches whole packs locally """
+    def __init__( self, get_config = lambda: {} ):
+        """ constructor takes the function that returns the config for the remote file system """
+        self.get_config = get_config
+        self.cache_dir = None
+        self.cached = {}
+        self.cache_lock = threading.Lock()
+
+    def cached_pack( self, pack_path ):
+        """ return the local path of a cached copy of the whole pack, fetching it the first time it's needed """
+        with self.cache_lock:
+            if not self.cache_dir:
+                self.cache_dir = tempfile.mkdtemp()
+            if pack_path not in self.cached:
+                self.cached[pack_path] = ( threading.Lock(), os.path.join(self.cache_dir,"pack.%d"%len(self.cached)) )
+            pack_lock, local_pack = self.cached[pack_path]
+        with pack_lock:
+            if not os.path.exists(local_pack):
+                fs_mod.fs_get( pack_path, local_pack+".part", self.get_config )
+                os.rename( local_pack+".part", local_pack )
+        return local_pack
+
+    def get( self, pack_path, local_path, offset, length, codec = None ):
+        """ copy the member of the pack at offset and length to local_path, decompressing it if codec names the codec it was compressed with """
+        if not length:
+            # an empty member needs no read, S3 refuses a range with no bytes in it
+            open(safe_path(local_path),"wb").close()
+        elif fs_mod.fs_has_range( pack_path ):
+            fs_mod.fs_get_range( pack_path, local_path, offset, length, self.get_config )
+        else:
+            with open(self.cached_pack( pack_path ),"rb") as f, open(safe_path(local_path),"wb") as out:
+                f.seek(offset)
+                while length:
+                    block = f.read(min(length,block_size))
+                    if not block:
+                        raise Exception("PackReader.get: Pack is truncated",pack_path)
+                    out.write(block)
+                    length -= len(block)
+        if codec:
+            compress_mod.decompress_file( local_path, codec )
+
+    def close( self ):
+        """ remove any cached packs """
+        with self.cache_lock:
+            if self.cache_dir:
+                shutil.rmtree(self.cache_dir,True)
+            self.cache_dir = None
+            self.cached = {}
@@ -0,0 +1,79 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement a work queue that can be closed to wake up and stop the threads reading it for the bkp tool """
+import queue
+import time
+
+class Closed(Exception):
+    """ raised by get on a closed queue that has nothing left in it and by put on a closed queue """
+    pass
+
+class Stopped(Exception):
+    """ raised by get when the stop function it was given returns True """
+    pass
+
+class WorkQueue(queue.Queue):
+    """ a queue.Queue that can be closed, closing wakes every thread blocked in get right away instead of waiting for it to poll a stop flag """
+    def __init__( self, maxsize = 0 ):
+        queue.Queue.__init__( self, maxsize )
+        self.closed = False
+
+    def close( self ):
+        """ close the queue, readers get what is left in it and then Closed, writers get Closed right away even if they are blocked on a full queue """
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def wake( self ):
+        """ wake every thread blocked in get so they check their stop functions again """
+        with self.mutex:
+            self.not_empty.notify_all()
+
+    def put( self, item, block = True, timeout = None ):
+        """ same as queue.Queue.put except it raises Closed instead of adding the item once the queue is closed, the readers may be gone by then """
+        with self.not_full:
+            if timeout is not None:
+                end = time.monotonic() + timeout
+            while True:
+                if self.closed:
+                    raise Closed()
+                if self.maxsize <= 0 or self._qsize() < self.maxsize:
+                    break
+                if not block:
+                    raise queue.Full()
+                if timeout is None:
+                    self.not_full.wait()
+                else:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Full()
+                    self.not_full.wait(remaining)
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def get( self, block = True, timeout = None, stop = None ):
+        """ same as queue.Queue.get except it raises Closed once the queue is closed and empty, stop is a function called before taking anything and
+            each time the reader wakes up, once it returns True get raises Stopped """
+        with self.not_empty:
+            if timeout is not None:
+                end = time.monotonic() + timeout
+            while True:
+                if stop and stop():
+                    raise Stopped()
+                if self._qsize():
+                    break
+                if self.closed:
+                    raise Closed()
+                if not block:
+                    raise queue.Empty()
+                if timeout is None:
+                    self.not_empty.wait()
+                else:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty()
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
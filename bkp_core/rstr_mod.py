@@ -2,32 +2,34 @@
 """ module to implement shared functions for the rstr tool """
 import sys
 import os
-import tempfile
-import re
 import traceback
-import queue
-import threading
 import platform
 import time
 import subprocess
 import datetime
-import urllib.request, urllib.parse, urllib.error
-import io
 from bkp_core import bkp_mod
-from bkp_core import bkp_conf
-from bkp_core.util import get_contents
-from bkp_core.fs_mod import fs_get,fs_put,fs_ls
+from bkp_core import chunk_mod
+from bkp_core import compress_mod
+from bkp_core.pack_mod import PackReader
+from bkp_core import fs_mod
 from bkp_core.logger import Logger
+from bkp_core import transfer_mod
+from bkp_core.exclude_mod import compile_patterns, match_any
+from bkp_core.stats_mod import JobStats
+from bkp_core.index_mod import PathSet
 
 class Restore:
     """ class to represent parameters about a restore candidate """
+    __slots__ = ( "remote_path", "original_path", "local_path", "time", "status", "msg" )
 
-    def __init__(self, r_path, l_path, t_path, time ):
-        """ constructor takes remote path, orignal local path, target local path, and the for the file as a float """
+    def __init__(self, r_path, l_path, t_path, time, status = "transferred", msg = "na" ):
+        """ constructor takes remote path, orignal local path, target local path, the time for the file as a float and the status and message it was logged with """
         self.remote_path = r_path
         self.original_path = l_path
         self.local_path = t_path
         self.time = time
+        self.status = status
+        self.msg = msg
 
 class RestoreJob:
     def __init__( self, config):
@@ -38,10 +40,13 @@ class RestoreJob:
     def init( self, config ):
         """ initialize the internal state for another run """
         self.config = config
-        self.restore_worker_thread_pool = []
-        self.restore_work_queue = queue.Queue()
-        self.restore_workers_stop = False
-        self.logger = Logger()
+        # the transfer queue is bounded so queued restores don't hold another copy of the restore list in memory
+        self.queue_size = int(config.get("queue_size",1000))
+        self.engine = None
+        self.stats = JobStats()
+        self.packs = PackReader(lambda: self.config)
+        self.fs = None
+        self.logger = Logger(self.queue_size)
 
     def set_dryrun( self, dr ):
         """ set the dryrun flag to true to have it just log all the actions but not perform them """
@@ -51,57 +56,62 @@ class RestoreJob:
         """ set the verbose flag to log a lot more detail about the process """
         self.verbose = vb
 
-    def perform_restore( self ):
-        """ worker thread body that pulls restore actions off the queue and performs them """
-        while not self.restore_workers_stop:
-            try:
-                params = self.restore_work_queue.get(True,1)
-                try:
-                    if not self.dryrun:
-                        fs_get( params.remote_path, params.local_path, lambda: self.config )
-                        os.utime( params.local_path, (params.time, params.time))
-                    self.logger.log( "Restored %s to %s"%(params.remote_path,params.local_path))
-                    self.restore_work_queue.task_done()
-                except:
-                    tb = traceback.format_exc()
-                    self.logger.log( tb )
-                    self.restore_work_queue.task_done()
-            except queue.Empty:
-                continue
+    def restore_file( self, params ):
+        """ transfer task that restores one file from wherever the backup stored it and gives it its modified time """
+        if not self.dryrun:
+            if params.status == "chunked":
+                chunk_mod.get_chunked( params.remote_path, params.local_path, self.config["bucket"], lambda: self.config )
+            elif params.status == "packed":
+                offset, length = params.msg.split(",")[:2]
+                self.packs.get( params.remote_path, params.local_path, int(offset), int(length), compress_mod.logged_codec( params.msg ) )
+            else:
+                self.fs.get( params.remote_path, params.local_path, lambda: self.config, compress_mod.logged_codec( params.msg ) )
+            os.utime( params.local_path, (params.time, params.time))
+
+    def restored_size( self, params ):
+        """ return the size of a file once it has been restored """
+        if self.dryrun:
+            return 0
+        return os.path.getsize( params.local_path )
+
+    def restore_done( self, future ):
+        """ called by the transfer engine when a file's restore is done to log how it went """
+        params = future.args[0]
+        if future.traceback:
+            self.logger.log( future.traceback )
+            self.stats.add("errors")
+        else:
+            self.logger.log( "Restored %s to %s"%(params.remote_path,params.local_path))
 
     def start_restore_workers(self):
-        """ start the right number of restore worker threads to perform the restoring """
-        num_threads = int(self.config["threads"])
+        """ start the transfer engine that runs the restores """
+        self.engine = transfer_mod.make_engine( self.config, self.queue_size, self.logger.log ).start()
 
-        while num_threads:
-            t = threading.Thread(target=self.perform_restore)
-            t.start()
-            self.restore_worker_thread_pool.append(t)
-            num_threads = num_threads - 1
+    def queue_restore( self, params ):
+        """ submit a file to the transfer engine to be restored """
+        self.engine.submit( self.restore_file, params, backend=self.fs.scheme, size=lambda: self.restored_size( params ), callback=self.restore_done )
 
     def stop_restore_workers(self):
-        """ set a flag that causes all of the restore workers to exit """
-        self.restore_workers_stop = True
+        """ cancel the restores that haven't started, the running ones finish on their own """
+        if self.engine:
+            self.engine.cancel()
 
     def wait_for_restore_workers(self):
-        """ wait until the restore queue clears """
-
-        if not self.restore_work_queue.empty():
-            self.restore_work_queue.join()
-        self.stop_restore_workers()
-        for r in self.restore_worker_thread_pool:
-            if r.is_alive():
-                r.join()
-        self.restore_worker_thread_pool = []
-        self.restore_worker_stop = False
-        self.restore_work_queue = queue.Queue()
+        """ wait for the transfer engine to finish every restore submitted to it and record its statistics """
+        self.engine.join()
+        self.engine.record_stats( self.stats )
 
     def restore( self, machine=platform.node(), restore_path = "", exclude_pats = [], asof = "", restore_pats = [] ):
         """ main restore driver, will loop over all backups for this server and restore all files to the restore path that match the restore_pats and are not excluded by the exlcude patterns up to the asof date """
+        # the job has backends of its own, closing them when it is done doesn't touch any other job's
+        self.backends = fs_mod.Backends().use()
         try:
             # initialize our internal state to begin a new run
             self.init(self.config)
 
+            # the backend for the bucket is resolved once and shared by all of the workers
+            self.fs = fs_mod.get_backend(self.config["bucket"])
+
             # start the logger
             self.logger.start_logger()
 
@@ -116,16 +126,22 @@ class RestoreJob:
             # get asof as a time value
             asof_time = bkp_mod.timestamp2time( asof )
 
+            # compile the exclude and restore patterns once for all of the files
+            exclude_res = compile_patterns(exclude_pats)
+            restore_res = compile_patterns(restore_pats)
+
             # the backups for a given machine will be in s3://bucket/bkp/machine_name
             machine_path = self.config["bucket"]+"/bkp/"+machine
 
+            # the backups are read newest first so the first entry for a path that passes the filters is the version to restore, it is queued
+            # right away and only the paths already queued are remembered, in a set on disk instead of a map of every file in memory
+            restored = PathSet()
+            self.start_restore_workers()
             try:
                 # get backup paths and timestamps returns Backup objects with  (time, timestamp, path)
                 backups = bkp_mod.get_backups( machine_path, self.config, self.verbose )
 
-                # loop over the backups, process the log files and collect the correct versions of matching files
-                restore_map = {}
-                for bk in backups:
+                for bk in sorted( backups, key = lambda bk: bk.time, reverse = True ):
                     if self.verbose:
                         self.logger.log("Examining backup: %s"%(bk.path))
 
@@ -135,110 +151,55 @@ class RestoreJob:
                             self.logger.log("Skipping because it is newer than asof backup: %s"%(bk.path))
                         continue
 
-                    # fetch the contents of the backup log
-                    contents = get_contents(machine_path,bk.timestamp+"/bkp/bkp."+bk.timestamp+".log",self.verbose, lambda: self.config)
-
-                    # collect the newest version less than the asof time and apply all the filters
-                    # if there's a backup log then we do this the easy way
-                    if contents:
-                        if self.verbose:
-                            self.logger.log("Found log file and processing it")
-
-                        past_config = False
-                        for l in io.StringIO(contents):
-                            if not past_config:
-                                if l.startswith("end_config"):
-                                    past_config = True
-                            else:
-                                local_path,remote_path,status,msg = l.split(";",3)
-                                if status == "error":
-                                    if self.verbose:
-                                        self.logger.log("Skipping because of error: %s"%(local_path))
-                                    continue
-                                if local_path in restore_map and restore_map[local_path].time > bk.time:
-                                    if self.verbose:
-                                        self.logger.log("Skipping because we already have a newer one: %s"%(local_path))
-                                    continue
-                                exclude = False
-                                for ex in exclude_pats:
-                                    if re.match(ex,local_path):
-                                        exclude = True
-                                        break
-                                if exclude:
-                                    if self.verbose:
-                                        self.logger.log("Skipping because of exclude %s %s"%(ex,local_path))
-                                    continue
-                                restore = False
-                                for rs in restore_pats:
-                                    if re.match(rs,local_path):
-                                        restore = True
-                                        break
-                                if not restore:
-                                    if self.verbose:
-                                        self.logger.log("Skipping because not included: %s"%(local_path))
-                                    continue
-                                if self.verbose:
-                                    self.logger.log("Including: %s"%(local_path))
-
-                                restore_map[local_path] = Restore(remote_path,local_path,os.path.join(restore_path,local_path[1:]),bk.time)
-                    else:
-                        if self.verbose:
-                            self.logger.log("No log file doing a recursive ls of %s"%bk.path)
-                        # ok this is a screwed up one that doesn't have a log so recurse using ls and build the list off of that
-                        for l in io.StringIO(fs_ls(bk.path,True, lambda: self.config)):
-                            prefix,path = re.split(bk.timestamp,l)
-                            path = path.strip()
-                            local_path = urllib.request.url2pathname(path)
-                            remote_path = bk.path + path[1:]
-                            if local_path in restore_map:
-                                if self.verbose:
-                                    self.logger.log( "Found in map: %s"%(local_path))
-                                if restore_map[local_path].time > bk.time:
-                                    if self.verbose:
-                                        self.logger.log("Skipping because we already have a newer one %s"%(local_path))
-                                    continue
-                            exclude = False
-                            for ex in exclude_pats:
-                                if re.match(ex,local_path):
-                                    exclude = True
-                                    break
-                            if exclude:
-                                if self.verbose:
-                                    self.logger.log("Skipping because of exclude %s %s"%(ex,local_path))
-                                continue
-                            restore = False
-                            for rs in restore_pats:
-                                if re.match(rs,local_path):
-                                    restore = True
-                                    break
-                            if not restore:
-                                if self.verbose:
-                                    self.logger.log("Skipping because not included %s"%(local_path))
-                                continue
+                    # restore the newest version less than the asof time that passes all the filters, the entries
+                    # come from the backup's manifest, or its log, or a recursive ls if it doesn't have either
+                    for local_path,remote_path,status,msg,mtime,size,digest in bkp_mod.get_backup_entries( bk, machine_path, self.config, self.verbose ):
+                        if status == "error":
                             if self.verbose:
-                                self.logger.log("Including: %s"%(local_path))
-                            restore_map[local_path] = Restore(remote_path,local_path,os.path.join(restore_path,local_path[1:]),bk.time)
+                                self.logger.log("Skipping because of error: %s"%(local_path))
+                            continue
+                        if local_path in restored:
+                            if self.verbose:
+                                self.logger.log("Skipping because we already have a newer one: %s"%(local_path))
+                            continue
+                        ex = match_any(exclude_res,local_path)
+                        if ex:
+                            if self.verbose:
+                                self.logger.log("Skipping because of exclude %s %s"%(ex,local_path))
+                            continue
+                        if not match_any(restore_res,local_path):
+                            if self.verbose:
+                                self.logger.log("Skipping because not included: %s"%(local_path))
+                            continue
+                        if self.verbose:
+                            self.logger.log("Including: %s"%(local_path))
+
+                        restored.add(local_path)
+                        self.queue_restore( Restore(remote_path,local_path,os.path.join(restore_path,local_path[1:]),bk.time,status,msg) )
             except:
                 self.logger.log("Exception while processing: "+traceback.format_exc())
 
-            # if we have things to restore then go for it
-            if restore_map:
-                # start up the restore workers
-                self.start_restore_workers()
+            # wait for the restore workers
+            self.wait_for_restore_workers()
 
-                # enqueue all of the restore tasks
-                for rest in restore_map.values():
-                    self.restore_work_queue.put(rest)
+            # remove any packs we had to cache to get files out of them
+            self.packs.close()
 
-                # wait for the restore workers
-                self.wait_for_restore_workers()
+            # log the job summary
+            self.stats.set("files_restored", len(restored))
+            restored.close()
+            self.stats.record_peak_memory()
+            self.logger.log(self.stats.summary())
 
             # wait for logging to complete
             self.logger.wait_for_logger()
+            self.backends.done()
         except:
             # stop the restore workers
             self.stop_restore_workers()
 
             # stop the restore logger
             self.logger.stop_logger()
+            self.packs.close()
+            self.backends.done()
             raise
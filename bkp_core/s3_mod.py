@@ -1,121 +1,631 @@
 # Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
 """ module to implement shared functions for amazon s3 for the bkp/rstr tool """
-import subprocess
-import socket
-import re
 from io import StringIO
 import copy
 import os
 import sys
+import atexit
 import time
+import calendar
+import hmac
+import hashlib
+import base64
+import threading
+import queue
+import heapq
 import traceback
+import configparser
+import http.client
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+import xml.sax.saxutils
 from datetime import datetime
+from bkp_core.file_mod import safe_path
 
-def s3_get( remote_path, local_path ):
-    """ use s3cmd to copy a file to the local machine """
-    cmd = "s3cmd -p --no-encrypt -f get \"%s\" \"%s\""%(remote_path, local_path)
-    p = subprocess.Popen(cmd,
-                   shell=True,
-                   bufsize=1024,
-                   encoding="utf-8",
-                   stdout=subprocess.PIPE,
-                   stderr=subprocess.STDOUT)
-    output = p.stdout.read()
-    result = p.wait()
-    if result:
-        raise Exception(cmd,output,result)
+# we talk to s3 directly using the settings in the same ~/.s3cfg that s3cmd uses so existing setups keep working,
+# objects get the same x-amz-meta-s3cmd-attrs metadata that s3cmd -p writes so buckets written by either are readable by both
+block_size = 1024*1024
+max_idle_connections = 32
+request_timeout = 60
+
+# objects bigger than a part are uploaded as multipart uploads and downloaded with ranged gets, both with several parts in flight,
+# s3 won't take parts under 5MB or more than 10000 parts, the state of unfinished uploads is kept so a restarted backup can resume them
+default_part_size = 16*1024*1024
+default_part_threads = 4
+min_part_size = 5*1024*1024
+max_parts = 10000
+multipart_dir = "~/.bkp/multipart"
+
+# recursive listings split the keyspace into shards at the common prefixes and list the shards on several threads, prefixes
+# are split breadth first until there are enough shards to keep the threads busy or the shards are this many levels deep
+default_list_threads = 8
+shards_per_thread = 4
+max_shard_depth = 3
+
+# deletes of many objects are sent as multi-object delete requests of up to this many keys with several requests in flight
+max_delete_keys = 1000
+default_delete_threads = 4
+
+clients = {}
+clients_lock = threading.Lock()
+
+def split_bucketkey( remote_path ):
+    """ split an s3://bucket/key path into ( bucket, key ) """
+    if not remote_path.startswith("s3://"):
+        raise Exception("split_bucketkey: Missing protocol prefix.",remote_path)
+    parts = remote_path[5:].split("/",1)
+    if len(parts) < 2:
+        return (parts[0],"")
+    return (parts[0],parts[1])
+
+def quote( s, safe = "-_.~" ):
+    """ uri encode a string the way aws signature version 4 wants it """
+    return urllib.parse.quote( s, safe=safe )
+
+def sign( method, path, query, headers, payload_hash, access_key, secret_key, region, amz_date ):
+    """ return the aws signature version 4 authorization header for a request, headers must already include everything that is sent except authorization """
+    datestamp = amz_date[:8]
+    canonical_query = "&".join([ "%s=%s"%(quote(k),quote(v)) for k,v in sorted(query.items()) ])
+    names = sorted([ k.lower() for k in headers.keys() ])
+    values = dict([ (k.lower()," ".join(str(v).strip().split())) for k,v in headers.items() ])
+    canonical_headers = "".join([ "%s:%s\n"%(n,values[n]) for n in names ])
+    signed_headers = ";".join(names)
+    canonical_request = "\n".join([ method, quote(path,"/-_.~"), canonical_query, canonical_headers, signed_headers, payload_hash ])
+    scope = "%s/%s/s3/aws4_request"%(datestamp,region)
+    string_to_sign = "\n".join([ "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode("utf-8")).hexdigest() ])
+    key = ("AWS4"+secret_key).encode("utf-8")
+    for part in [ datestamp, region, "s3", "aws4_request" ]:
+        key = hmac.new( key, part.encode("utf-8"), hashlib.sha256 ).digest()
+    signature = hmac.new( key, string_to_sign.encode("utf-8"), hashlib.sha256 ).hexdigest()
+    return "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s"%(access_key,scope,signed_headers,signature)
+
+def load_s3cfg( cfg_path = "~/.s3cfg" ):
+    """ read the s3cmd config file and return a dict of the settings we use, the AWS_* environment variables override it """
+    settings = { "access_key" : "", "secret_key" : "", "host_base" : "s3.amazonaws.com", "host_bucket" : "%(bucket)s.s3.amazonaws.com",
+                 "use_https" : "True", "bucket_location" : "US" }
+    parser = configparser.RawConfigParser()
+    parser.read(os.path.expanduser(cfg_path))
+    if parser.has_section("default"):
+        for k in settings.keys():
+            if parser.has_option("default",k) and parser.get("default",k).strip():
+                settings[k] = parser.get("default",k).strip()
+    settings["access_key"] = os.environ.get("AWS_ACCESS_KEY_ID",settings["access_key"])
+    settings["secret_key"] = os.environ.get("AWS_SECRET_ACCESS_KEY",settings["secret_key"])
+    region = settings["bucket_location"]
+    if region in [ "US", "" ]:
+        region = "us-east-1"
+    elif region == "EU":
+        region = "eu-west-1"
+    settings["region"] = os.environ.get("AWS_DEFAULT_REGION",region)
+    return settings
+
+class S3Response:
+    """ the parts of a response we care about, the body is only read if there isn't a file to stream it to """
+    def __init__( self, status, reason, headers, body ):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+class S3Client:
+    """ thread safe s3 client with a pool of keep alive connections per host that is shared by all of the worker threads """
+    def __init__( self, settings ):
+        """ constructor takes the settings from load_s3cfg """
+        self.settings = settings
+        self.https = settings["use_https"].lower() in [ "true", "yes", "on", "1" ]
+        self.pool = {}
+        self.pool_lock = threading.Lock()
+        self.connections_opened = 0
+
+    def endpoint( self, bucket, key ):
+        """ return ( host, path ) for an object, buckets are virtual hosts if host_bucket has a %(bucket)s in it otherwise the bucket is in the path """
+        if bucket and "%(bucket)s" in self.settings["host_bucket"]:
+            return ( self.settings["host_bucket"]%{ "bucket" : bucket }, "/"+key )
+        elif bucket:
+            return ( self.settings["host_base"], "/"+bucket+"/"+key )
+        return ( self.settings["host_base"], "/" )
+
+    def get_connection( self, host ):
+        """ take an idle connection to host out of the pool or make a new one, returns ( connection, reused ) """
+        with self.pool_lock:
+            idle = self.pool.get(host)
+            if idle:
+                return ( idle.pop(), True )
+            self.connections_opened += 1
+        if self.https:
+            return ( http.client.HTTPSConnection( host, timeout=request_timeout ), False )
+        return ( http.client.HTTPConnection( host, timeout=request_timeout ), False )
+
+    def release_connection( self, host, conn ):
+        """ put a connection whose response has been completely read back in the pool """
+        with self.pool_lock:
+            idle = self.pool.setdefault(host,[])
+            if len(idle) < max_idle_connections:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close( self ):
+        """ close all of the idle connections """
+        with self.pool_lock:
+            pool = self.pool
+            self.pool = {}
+        for idle in pool.values():
+            for conn in idle:
+                conn.close()
+
+    def request( self, method, bucket, key, query = {}, headers = {}, body = None, out_file = None ):
+        """ make a signed request and return an S3Response, the body is written to out_file if there is one and the response is 200 or 206, a request on a reused connection that the server has closed is retried once on a new one """
+        host, path = self.endpoint( bucket, key )
+        url = quote(path,"/-_.~")
+        if query:
+            url += "?" + "&".join([ "%s=%s"%(quote(k),quote(v)) if v != "" else quote(k) for k,v in sorted(query.items()) ])
+        body_pos = body.tell() if hasattr(body,"tell") else None
+
+        for attempt in range(2):
+            conn, reused = self.get_connection( host )
+            send_headers = dict(headers)
+            send_headers["Host"] = host
+            send_headers["x-amz-date"] = time.strftime("%Y%m%dT%H%M%SZ",time.gmtime())
+            send_headers["x-amz-content-sha256"] = "UNSIGNED-PAYLOAD"
+            if isinstance(body,bytes):
+                send_headers["x-amz-content-sha256"] = hashlib.sha256(body).hexdigest()
+            elif body == None:
+                send_headers["x-amz-content-sha256"] = hashlib.sha256(b"").hexdigest()
+            send_headers["Authorization"] = sign( method, path, query, send_headers, send_headers["x-amz-content-sha256"],
+                                                  self.settings["access_key"], self.settings["secret_key"], self.settings["region"], send_headers["x-amz-date"] )
+            try:
+                conn.request( method, url, body=body, headers=send_headers )
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError, BrokenPipeError):
+                conn.close()
+                if reused and attempt == 0:
+                    if body_pos != None:
+                        body.seek(body_pos)
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+            try:
+                if out_file and resp.status in [ 200, 206 ]:
+                    while True:
+                        block = resp.read(block_size)
+                        if not block:
+                            break
+                        out_file.write(block)
+                    data = b""
+                else:
+                    data = resp.read()
+            except:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self.release_connection( host, conn )
+            return S3Response( resp.status, resp.reason, dict([ (k.lower(),v) for k,v in resp.getheaders() ]), data )
+
+def get_client( cfg_path = "~/.s3cfg" ):
+    """ return the shared client for the s3cmd config file, a new one is made if the config file has changed """
+    cfg_path = os.path.expanduser(cfg_path)
+    try:
+        mtime = os.stat(cfg_path).st_mtime
+    except OSError:
+        mtime = None
+    with clients_lock:
+        client = clients.get(cfg_path)
+        if not client or client[0] != mtime:
+            if client:
+                client[1].close()
+            client = ( mtime, S3Client( load_s3cfg(cfg_path) ) )
+            clients[cfg_path] = client
+        return client[1]
+
+def close_clients():
+    """ close the idle connections of all of the clients """
+    with clients_lock:
+        for mtime, client in clients.values():
+            client.close()
+
+# the clients are shared by every job in the process so they stay open until it exits
+atexit.register( close_clients )
+
+def check_response( resp, what, remote_path, ok = ( 200, ) ):
+    """ raise an exception with the details of a failed request """
+    if resp.status not in ok:
+        raise Exception(what,remote_path,resp.status,resp.reason,resp.body.decode("utf-8","replace"))
+
+def s3cmd_attrs( local_path ):
+    """ return the x-amz-meta-s3cmd-attrs value s3cmd -p would store for a local file """
+    s = os.stat(local_path)
+    return "atime:%d/ctime:%d/gid:%d/mode:%d/mtime:%d/uid:%d"%(s.st_atime,s.st_ctime,s.st_gid,s.st_mode,s.st_mtime,s.st_uid)
+
+def parse_attrs( value ):
+    """ parse an x-amz-meta-s3cmd-attrs value into a dict """
+    attrs = {}
+    for p in value.split("/"):
+        if ":" in p:
+            key,v = p.split(":",1)
+            attrs[key] = v
+    return attrs
+
+def part_settings( get_config ):
+    """ return ( part size, parts in flight per file ) from the s3_part_size and s3_part_threads config """
+    config = get_config()
+    return ( max(int(config.get("s3_part_size",default_part_size)),min_part_size), max(int(config.get("s3_part_threads",default_part_threads)),1) )
+
+def run_parts( work, threads ):
+    """ call the functions in work on up to threads threads and wait for them, raises the first exception that any of them raised """
+    work_queue = queue.Queue()
+    for w in work:
+        work_queue.put(w)
+    errors = []
+    def worker():
+        while not errors:
+            try:
+                w = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                w()
+            except Exception as e:
+                errors.append(e)
+    workers = [ threading.Thread(target=worker) for i in range(min(threads,len(work))) ]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if errors:
+        raise errors[0]
+
+def get_range_into( bucket, key, remote_path, f, offset, length ):
+    """ write length bytes starting at offset in an object to the file object f at its current position """
+    start = f.tell()
+    resp = get_client().request( "GET", bucket, key, headers={ "Range" : "bytes=%d-%d"%(offset,offset+length-1) }, out_file=f )
+    check_response( resp, "s3_get_range", remote_path, ( 206, ) )
+    if f.tell() - start != length:
+        raise Exception("s3_get_range: Short read",remote_path,offset,length)
+
+def s3_get( remote_path, local_path, get_config = lambda: {} ):
+    """ copy an object to the local machine and give it the modified time s3cmd -p stored with it, objects bigger than a part are fetched with ranged gets in parallel into a preallocated file """
+    bucket, key = split_bucketkey( remote_path )
+    part_size, threads = part_settings( get_config )
+    with open(safe_path(local_path),"wb") as f:
+        resp = get_client().request( "GET", bucket, key, headers={ "Range" : "bytes=0-%d"%(part_size-1) }, out_file=f )
+        if resp.status == 416:
+            # an empty object has no range to get
+            resp = get_client().request( "GET", bucket, key, out_file=f )
+    check_response( resp, "s3_get", remote_path, ( 200, 206 ) )
+    if resp.status == 206:
+        size = int(resp.headers.get("content-range","/0").split("/")[-1])
+        if size > part_size:
+            with open(local_path,"r+b") as f:
+                f.truncate(size)
+            def get_part( offset ):
+                with open(local_path,"r+b") as f:
+                    f.seek(offset)
+                    get_range_into( bucket, key, remote_path, f, offset, min(part_size,size-offset) )
+            run_parts( [ (lambda offset=offset: get_part(offset)) for offset in range(part_size,size,part_size) ], threads )
+    attrs = parse_attrs( resp.headers.get("x-amz-meta-s3cmd-attrs","") )
+    if "mtime" in attrs:
+        os.utime( local_path, (int(attrs.get("atime",attrs["mtime"])),int(attrs["mtime"])) )
+    if "mode" in attrs:
+        os.chmod( local_path, int(attrs["mode"]) & 0o7777 )
     return
 
-def s3_put( local_path, remote_path ):
-    """ use s3cmd to copy a file from local machine to s3 """
-    cmd = "s3cmd -p --no-encrypt put \"%s\" \"%s\""%(local_path, remote_path)
-    p = subprocess.Popen(cmd,
-                   shell=True,
-                   bufsize=1024,
-                   encoding="utf-8",
-                   stdout=subprocess.PIPE,
-                   stderr=subprocess.STDOUT)
-    output = p.stdout.read()
-    result = p.wait()
-    if result:
-        raise Exception(cmd,output,result)
+def s3_get_range( remote_path, local_path, offset, length ):
+    """ copy length bytes starting at offset in the object at remote_path to local_path """
+    bucket, key = split_bucketkey( remote_path )
+    with open(safe_path(local_path),"wb") as f:
+        get_range_into( bucket, key, remote_path, f, offset, length )
     return
 
-def s3_ls( path, recurse=False ):
-    """ perform an ls of the s3 path specified and return the output """
-    r_opt = ""
-    if recurse:
-        r_opt = "-r"
-    cmd = "s3cmd %s ls \"%s\""%(r_opt, path)
-    p = subprocess.Popen(cmd,
-                   shell=True,
-                   bufsize=1024,
-                   encoding="utf-8",
-                   stdout=subprocess.PIPE,
-                   stderr=subprocess.STDOUT)
-    output = p.stdout.read()
-    result = p.wait()
-    if result:
-        raise Exception(cmd,output,result)
-    dirs = []
-    files = []
+def s3_put( local_path, remote_path, get_config = lambda: {} ):
+    """ copy a file from local machine to s3 with the s3cmd -p attributes, files bigger than a part are sent as a multipart upload """
+    bucket, key = split_bucketkey( remote_path )
+    size = os.path.getsize(local_path)
+    part_size, threads = part_settings( get_config )
+    if size > part_size:
+        return put_multipart( local_path, remote_path, size, max(part_size,-(-size//max_parts)), threads )
+    headers = { "Content-Length" : str(size), "Content-Type" : "application/octet-stream",
+                "x-amz-meta-s3cmd-attrs" : s3cmd_attrs(local_path) }
+    with open(local_path,"rb") as f:
+        resp = get_client().request( "PUT", bucket, key, headers=headers, body=f )
+    check_response( resp, "s3_put", remote_path )
+    return
+
+def upload_state_file( remote_path ):
+    """ return the local file that keeps the state of an unfinished multipart upload to remote_path """
+    return os.path.join(os.path.expanduser(multipart_dir),hashlib.sha1(remote_path.encode("utf-8")).hexdigest())
+
+def read_upload_state( remote_path ):
+    """ return ( upload id, size, part size, mtime ) of an unfinished upload to remote_path or None """
+    try:
+        with open(upload_state_file( remote_path ),"r") as f:
+            upload_id, size, part_size, mtime = f.read().split()
+        return ( upload_id, int(size), int(part_size), int(mtime) )
+    except Exception:
+        return None
+
+def write_upload_state( remote_path, upload_id, size, part_size, mtime ):
+    """ remember an upload to remote_path until it is finished """
+    os.makedirs(os.path.expanduser(multipart_dir),exist_ok=True)
+    with open(upload_state_file( remote_path ),"w") as f:
+        f.write("%s %d %d %d\n"%(upload_id,size,part_size,mtime))
+
+def remove_upload_state( remote_path ):
+    """ forget an upload to remote_path """
+    try:
+        os.remove(upload_state_file( remote_path ))
+    except OSError:
+        pass
+
+def xml_values( body, name ):
+    """ return the text of all of the elements called name in an xml response body """
+    return [ e.text or "" for e in ElementTree.fromstring(body).iter() if e.tag.split("}")[-1] == name ]
+
+def list_parts( bucket, key, upload_id, remote_path ):
+    """ return a dict of part number to etag for the parts of an upload that s3 already has, or None if the upload is gone """
+    parts = {}
+    query = { "uploadId" : upload_id }
+    while True:
+        resp = get_client().request( "GET", bucket, key, query=query )
+        if resp.status == 404:
+            return None
+        check_response( resp, "s3_put", remote_path )
+        root = ElementTree.fromstring(resp.body)
+        for e in root.iter():
+            if e.tag.split("}")[-1] == "Part":
+                fields = dict([ (c.tag.split("}")[-1],c.text) for c in e ])
+                parts[int(fields["PartNumber"])] = fields["ETag"].strip('"')
+        if xml_values( resp.body, "IsTruncated" ) != [ "true" ]:
+            return parts
+        query["part-number-marker"] = xml_values( resp.body, "NextPartNumberMarker" )[0]
+
+def put_multipart( local_path, remote_path, size, part_size, threads ):
+    """ upload a file in parts with threads parts in flight, an upload of the same file that was interrupted is resumed and only the parts s3 doesn't have are sent """
+    bucket, key = split_bucketkey( remote_path )
+    mtime = int(os.stat(local_path).st_mtime)
+    uploaded = None
+    state = read_upload_state( remote_path )
+    if state and state[1:] == ( size, part_size, mtime ):
+        upload_id = state[0]
+        uploaded = list_parts( bucket, key, upload_id, remote_path )
+    elif state:
+        get_client().request( "DELETE", bucket, key, query={ "uploadId" : state[0] } )
+    if uploaded == None:
+        resp = get_client().request( "POST", bucket, key, query={ "uploads" : "" },
+                                     headers={ "Content-Type" : "application/octet-stream", "x-amz-meta-s3cmd-attrs" : s3cmd_attrs(local_path) } )
+        check_response( resp, "s3_put", remote_path )
+        upload_id = xml_values( resp.body, "UploadId" )[0]
+        write_upload_state( remote_path, upload_id, size, part_size, mtime )
+        uploaded = {}
+
+    etags = {}
+    def put_part( number, offset ):
+        with open(local_path,"rb") as f:
+            f.seek(offset)
+            data = f.read(min(part_size,size-offset))
+        etag = hashlib.md5(data).hexdigest()
+        if uploaded.get(number) != etag:
+            resp = get_client().request( "PUT", bucket, key, query={ "partNumber" : str(number), "uploadId" : upload_id },
+                                         headers={ "Content-Length" : str(len(data)) }, body=data )
+            check_response( resp, "s3_put", remote_path )
+            etag = resp.headers.get("etag","").strip('"')
+        etags[number] = etag
+    # an interrupted upload is left on s3 with its state so the next try can pick it up
+    run_parts( [ (lambda number=number, offset=offset: put_part(number,offset)) for number, offset in enumerate(range(0,size,part_size),1) ], threads )
+
+    body = "<CompleteMultipartUpload>%s</CompleteMultipartUpload>"%"".join([ "<Part><PartNumber>%d</PartNumber><ETag>\"%s\"</ETag></Part>"%(n,etags[n]) for n in sorted(etags.keys()) ])
+    resp = get_client().request( "POST", bucket, key, query={ "uploadId" : upload_id }, body=body.encode("utf-8") )
+    check_response( resp, "s3_put", remote_path )
+    # s3 can report a failed completion in the body of a 200
+    if xml_values( resp.body, "Code" ):
+        raise Exception("s3_put",remote_path,resp.body.decode("utf-8","replace"))
+    remove_upload_state( remote_path )
+    return
+
+def s3_copy( from_path, to_path ):
+    """ copy one object to another on the server keeping its metadata """
+    from_bucket, from_key = split_bucketkey( from_path )
+    bucket, key = split_bucketkey( to_path )
+    headers = { "x-amz-copy-source" : quote("/"+from_bucket+"/"+from_key,"/-_.~"), "x-amz-metadata-directive" : "COPY" }
+    resp = get_client().request( "PUT", bucket, key, headers=headers )
+    check_response( resp, "s3_copy", to_path )
+    return
+
+def parse_last_modified( value ):
+    """ return the seconds since the epoch for a LastModified from a listing """
+    return calendar.timegm(time.strptime(value[:19],"%Y-%m-%dT%H:%M:%S"))
+
+def list_objects( path, recurse = False ):
+    """ generator that lists the objects under path a page at a time yielding ( "DIR", prefix_path ) for common prefixes if not recursive and ( key_path, size, last_modified ) for objects """
+    bucket, prefix = split_bucketkey( path )
+    query = { "list-type" : "2", "prefix" : prefix }
+    if not recurse:
+        query["delimiter"] = "/"
+    while True:
+        resp = get_client().request( "GET", bucket, "", query=query )
+        check_response( resp, "s3_ls", path )
+        root = ElementTree.fromstring(resp.body)
+        token = None
+        truncated = False
+        for child in root:
+            tag = child.tag.split("}")[-1]
+            if tag == "CommonPrefixes":
+                for c in child:
+                    if c.tag.split("}")[-1] == "Prefix":
+                        yield ( "DIR", "s3://%s/%s"%(bucket,c.text) )
+            elif tag == "Contents":
+                fields = dict([ (c.tag.split("}")[-1],c.text) for c in child ])
+                yield ( "s3://%s/%s"%(bucket,fields["Key"]), int(fields["Size"]), parse_last_modified(fields["LastModified"]) )
+            elif tag == "IsTruncated":
+                truncated = (child.text == "true")
+            elif tag == "NextContinuationToken":
+                token = child.text
+        if not truncated or not token:
+            return
+        query["continuation-token"] = token
+
+def list_shards( path, threads ):
+    """ find the prefixes under path to list in parallel, returns ( objects that are above the shards, shard prefix paths ) """
+    objects = []
+    shards = [ path ]
+    for depth in range(max_shard_depth):
+        if len(shards) >= threads*shards_per_thread:
+            break
+        listings = [ None ] * len(shards)
+        def list_level( i ):
+            listings[i] = [ e for e in list_objects( shards[i] ) ]
+        run_parts( [ (lambda i=i: list_level(i)) for i in range(len(shards)) ], threads )
+        shards = []
+        for listing in listings:
+            for e in listing:
+                if e[0] == "DIR":
+                    shards.append(e[1])
+                else:
+                    objects.append(e)
+    return ( objects, shards )
+
+def list_objects_parallel( path, threads = default_list_threads ):
+    """ generator that yields ( key_path, size, last_modified ) for all of the objects under path in key order like list_objects( path, True ) but lists the shards of the keyspace on threads threads """
+    if threads <= 1:
+        for e in list_objects( path, True ):
+            yield e
+        return
+
+    objects, shards = list_shards( path, threads )
+    results = [ queue.Queue() for s in shards ]
+    work_queue = queue.Queue()
+    for i in range(len(shards)):
+        work_queue.put(i)
+    stopped = []
+    def worker():
+        while not stopped:
+            try:
+                i = work_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                for e in list_objects( shards[i], True ):
+                    if stopped:
+                        return
+                    results[i].put(e)
+                results[i].put(None)
+            except Exception as e:
+                results[i].put(e)
+    def shard_entries( q ):
+        while True:
+            e = q.get()
+            if e == None:
+                return
+            if isinstance(e,Exception):
+                raise e
+            yield e
+
+    workers = [ threading.Thread(target=worker,daemon=True) for i in range(min(threads,len(shards))) ]
+    for t in workers:
+        t.start()
+    try:
+        # the shards are disjoint ranges of keys so the merge mostly just takes them in turn
+        for e in heapq.merge( sorted(objects), *[ shard_entries(q) for q in results ] ):
+            yield e
+    finally:
+        stopped.append(True)
+
+def s3_ls( path, recurse=False, get_config = lambda: {} ):
+    """ perform an ls of the s3 path specified and return the output, the times are when the objects were stored which is never before their s3cmd-attrs mtime, recursive listings are done in parallel on list_threads threads """
     final_output = StringIO()
-    for l in StringIO(output):
-        l = l.strip()
-        parts = re.split(r'\s+',l,3)
-        if parts[0] == "DIR":
-            dirs.append(parts[-1])
-        else:
-            files.append(parts[-1])
-    for d in dirs:
-        print("                           DIR %s"%(d), file=final_output)
-    metas = s3_info(files)
-    for m in metas:
-        if 'error' in m:
-            raise Exception(cmd,output,result)
-        if 'mtime' in m:
-            mtime = datetime.fromtimestamp(float(m['mtime']))
+    files = StringIO()
+    if recurse:
+        entries = list_objects_parallel( path, int(get_config().get("list_threads",default_list_threads)) )
+    else:
+        entries = list_objects( path )
+    for entry in entries:
+        if entry[0] == "DIR":
+            print("                           DIR %s"%(entry[1]), file=final_output)
         else:
-            last_mod = datetime.strptime(m['Last mod'],"%a, %d %b %Y %H:%M:%S %Z")
-            last_mod = last_mod.astimezone(tz=None)
-            mtime = last_mod
-        size = int(m['File size'])
-        print("%04d-%02d-%02d %02d:%02d %9d   %s"%(mtime.year,mtime.month,mtime.day,mtime.hour,mtime.minute,size,m["s3_object_name"]), file=final_output)
+            mtime = datetime.fromtimestamp(entry[2])
+            print("%04d-%02d-%02d %02d:%02d %9d   %s"%(mtime.year,mtime.month,mtime.day,mtime.hour,mtime.minute,entry[1],entry[0]), file=files)
 
-    output = final_output.getvalue()
+    output = final_output.getvalue() + files.getvalue()
     final_output.close()
+    files.close()
     return output
 
-def s3_del( path, recurse=False ):
-    """ perform an del of the s3 path specified and return the output """
-    r_opt = ""
+def s3_stat_many( remote_paths, exact_mtime = lambda path, mtime, size: True ):
+    """ return a dict of ( mtime, size ) for each of remote_paths answered from one listing per directory, missing objects are (-1,-1), the s3cmd-attrs mtime is only fetched with a HEAD for objects where exact_mtime( path, stored time, size ) is True otherwise the time the object was stored is returned """
+    stats = dict([ (p,(-1,-1)) for p in remote_paths ])
+    dirs = {}
+    for p in remote_paths:
+        dirs.setdefault(p[:p.rindex("/")+1],set()).add(p)
+    for d, paths in dirs.items():
+        for entry in list_objects( d ):
+            if entry[0] in paths:
+                path, size, last_modified = entry
+                if exact_mtime( path, last_modified, size ):
+                    stats[path] = s3_stat( path )
+                else:
+                    stats[path] = ( last_modified, size )
+    return stats
+
+def delete_batch( bucket, keys ):
+    """ delete up to max_delete_keys keys in bucket with one multi-object delete request, raises an exception if any of them couldn't be deleted """
+    body = "<Delete><Quiet>true</Quiet>%s</Delete>"%"".join([ "<Object><Key>%s</Key></Object>"%xml.sax.saxutils.escape(k) for k in keys ])
+    body = body.encode("utf-8")
+    headers = { "Content-MD5" : base64.b64encode(hashlib.md5(body).digest()).decode("ascii"), "Content-Type" : "application/xml" }
+    resp = get_client().request( "POST", bucket, "", query={ "delete" : "" }, headers=headers, body=body )
+    check_response( resp, "s3_del", "s3://%s/"%bucket )
+    # quiet mode only reports the keys that failed
+    failed = xml_values( resp.body, "Key" )
+    if failed:
+        raise Exception("s3_del: Failed to delete",[ "s3://%s/%s"%(bucket,k) for k in failed ],xml_values( resp.body, "Message" ))
+
+def s3_del_many( paths, recurse=False, get_config = lambda: {} ):
+    """ delete the objects at paths, or everything under them if recurse is True, with multi-object delete requests of up to max_delete_keys keys sent on delete_threads threads, returns the same output as s3_del """
+    config = get_config()
     if recurse:
-        r_opt = "-r"
-    cmd = "s3cmd %s del \"%s\""%(r_opt, path)
-    p = subprocess.Popen(cmd,
-                   shell=True,
-                   bufsize=1024,
-                   encoding="utf-8",
-                   stdout=subprocess.PIPE,
-                   stderr=subprocess.STDOUT)
-    output = p.stdout.read()
-    result = p.wait()
-    if result:
-        raise Exception(cmd,output,result)
-    return output
+        list_threads = int(config.get("list_threads",default_list_threads))
+        objects = []
+        for path in paths:
+            objects.extend([ entry[0] for entry in list_objects_parallel( path, list_threads ) ])
+    else:
+        objects = paths
+
+    buckets = {}
+    for p in objects:
+        bucket, key = split_bucketkey( p )
+        buckets.setdefault(bucket,[]).append(key)
+    batches = []
+    for bucket, keys in buckets.items():
+        for i in range(0,len(keys),max_delete_keys):
+            batches.append(( bucket, keys[i:i+max_delete_keys] ))
+    run_parts( [ (lambda bucket=bucket, keys=keys: delete_batch( bucket, keys )) for bucket, keys in batches ], max(int(config.get("delete_threads",default_delete_threads)),1) )
+
+    output = StringIO()
+    for p in objects:
+        print("delete: '%s'"%p, file=output)
+    return output.getvalue()
+
+def s3_del( path, recurse=False, get_config = lambda: {} ):
+    """ perform an del of the s3 path specified and return the output, everything under the path is deleted with batched deletes if recurse is True """
+    if recurse:
+        return s3_del_many( [ path ], True, get_config )
+    bucket, key = split_bucketkey( path )
+    resp = get_client().request( "DELETE", bucket, key )
+    check_response( resp, "s3_del", path, ( 200, 204 ) )
+    return "delete: '%s'\n"%path
 
 def s3_test( remote_path, verbose = False ):
     """ test to make sure that we can access the remote path """
 
     try:
-        host, port, path = ("s3.amazonaws.com",80,"")
-
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((host,port))
-        data = s.recv(1024)
+        bucket, key = split_bucketkey( remote_path )
+        resp = get_client().request( "HEAD", bucket, "" )
         if verbose:
-            print("s3_test: ", data, file=sys.stderr)
-        s.close()
+            print("s3_test: ", resp.status, resp.reason, file=sys.stderr)
         return True
     except:
         if verbose:
@@ -126,11 +636,6 @@ def s3_info( remote_path ):
     """ remote_path can be either a single full path name or a list of path names a single path name will return a map of the metadata for the object, a list will return a list of metadatas one per object """
     paths = []
     is_list = False
-    if 'SC_ARG_MAX' in os.sysconf_names:
-        arg_max = os.sysconf('SC_ARG_MAX')
-    else:
-        arg_max = 8191
-
     if isinstance(remote_path,str):
         paths.append(remote_path)
     elif isinstance(remote_path,list):
@@ -138,75 +643,20 @@ def s3_info( remote_path ):
         is_list = True
 
     metas = []
-    cmd_paths = []
-    cmd_base = "s3cmd info "
-    cmd = cmd_base
-
-    def run_cmd():
-        p = subprocess.Popen(cmd,
-                       shell=True,
-                       bufsize=1024,
-                       encoding="utf-8",
-                       stdout=subprocess.PIPE,
-                       stderr=subprocess.STDOUT)
-        output = p.stdout.read()
-        result = p.wait()
-
-        meta = {}
-        cmd_idx = 0
-        for l in StringIO(output):
-            l = l.strip()
-            if l.startswith("s3://") and l.endswith(" (object):"):
-                if meta:
-                    metas.append(meta)
-                    cmd_idx += 1
-                meta = { "s3_object_name":l[:-len(" (object):")] }
-            elif l.startswith("s3://") and l.endswith(" (bucket):"):
-                if meta:
-                    metas.append(meta)
-                    cmd_idx += 1
-                meta = { "s3_bucket_name":l[:-len(" (bucket):")] }
-            elif l.startswith("ERROR:"):
-                if l == "ERROR: S3 error: 404 (Not Found)":
-                    meta = { "s3_object_name":cmd_paths[cmd_idx], "mtime": "-1", "File size": "-1", "error" : l }
-                    metas.append(meta)
-                    cmd_idx += 1
-                    continue
-                else:
-                    raise Exception(cmd,output,result)
-            else:
-                name, value = l.split(":",1)
-                name = name.strip()
-                value = value.strip()
-                if name == 'x-amz-meta-s3cmd-attrs':
-                    parts = value.split('/')
-                    for p in parts:
-                        key,value = p.split(":",1)
-                        meta[key] = value
-                elif name in meta:
-                    if isinstance(meta[name],list):
-                        meta[name].append(value)
-                    else:
-                        meta[name] = [ meta[name], value ]
-                else:
-                    meta[name] = value
-        if meta:
-            metas.append(meta)
-
-    while paths:
-        r_path = paths.pop(0)
-        if len(cmd+' "%s"'%r_path) > arg_max:
-            paths.insert(0,r_path)
-            run_cmd()
-            cmd = cmd_base
-            cmd_paths = []
-        else:
-            cmd += ' "%s"'%r_path
-            cmd_paths.append(r_path)
-
-        if not paths:
-            run_cmd()
-            cmd_paths = []
+    for r_path in paths:
+        bucket, key = split_bucketkey( r_path )
+        resp = get_client().request( "HEAD", bucket, key )
+        if resp.status == 404:
+            metas.append({ "s3_object_name":r_path, "mtime": "-1", "File size": "-1", "error" : "ERROR: S3 error: 404 (Not Found)" })
+            continue
+        check_response( resp, "s3_info", r_path )
+        meta = { "s3_object_name":r_path,
+                 "File size":resp.headers.get("content-length","0"),
+                 "Last mod":resp.headers.get("last-modified",""),
+                 "MIME type":resp.headers.get("content-type",""),
+                 "MD5 sum":resp.headers.get("etag","").strip('"') }
+        meta.update( parse_attrs( resp.headers.get("x-amz-meta-s3cmd-attrs","") ) )
+        metas.append(meta)
 
     if is_list:
         return metas
@@ -216,4 +666,7 @@ def s3_info( remote_path ):
 def s3_stat( remote_path ):
     """ return the modified time and size of an object at remote_path mtime resolution is seconds """
     meta = s3_info(remote_path)
+    if "mtime" not in meta:
+        last_mod = datetime.strptime(meta['Last mod'],"%a, %d %b %Y %H:%M:%S %Z")
+        return (int(last_mod.timestamp()),int(meta["File size"]))
     return (int(meta["mtime"]),int(meta["File size"]))
@@ -7,17 +7,31 @@ import traceback
 import stat
 import time
 import math
-from bkp_core.file_mod import safe_path
+import posixpath
+import shlex
+import hashlib
+from bkp_core.file_mod import safe_path, DirCache
+from bkp_core import bkp_conf
 import threading
 from io import StringIO
 import paramiko
-import socket
+from paramiko.sftp import CMD_OPENDIR, CMD_READDIR, CMD_CLOSE, CMD_REMOVE, CMD_RMDIR, CMD_HANDLE, CMD_NAME
+from collections import deque
 
-sftp_safe_path_lock = threading.Lock()
-thread_local = threading.local()
-transport_lock = threading.Lock()
 host_keys = {}
 
+# the threads of a job share up to ssh_connections transports, tcp connections, to each host, one unless the config says more, and
+# each thread opens its own sftp channel on the transport with the fewest channels, so a job makes ssh_connections connections per host
+# however many threads it runs
+default_connections = 1
+
+# directory listings and removes are pipelined on a thread's session with up to this many requests in flight
+pipeline_depth = 64
+
+# hosts that allow exec channels and have gnu find run find and sha256sum to list, stat and hash whole sets of files in
+# one request, the answer for each host is remembered by the SshSessions, commands are kept under this many bytes
+max_command = 65536
+
 # paramiko.util.log_to_file(os.path.expanduser("~/.bkp/ssh_mod.log"))
 
 def strip_protocol( path ):
@@ -64,86 +78,185 @@ def lookup_hostkey( hostname ):
         hostkey = host_keys[hostname][hostkeytype]
     return ( hostkey, hostkeytype )
 
-
-
-def ssh_transport( hostname, port, username, password, force = False ):
-    """ acquire a transport to use SFTP over """
-    t = None
-    transport_pool = getattr(thread_local, "transport_pool", None)
-    if transport_pool == None:
-        thread_local.transport_pool = {}
-        transport_pool = thread_local.transport_pool
-
-    if (not force) and (( hostname, port, username, password ) in transport_pool):
-        t = transport_pool[( hostname, port, username, password )]
-    else:
-        t = paramiko.Transport((hostname, port ))
-        t.set_keepalive(5)
-        t.connect( username=username, password=password, hostkey= lookup_hostkey( hostname )[0])
-        t.use_compression(True)
-        transport_pool[(hostname,port,username,password)] = t
-    return t
-
-def sftp_open( hostname, port, username, password ):
-    """ get an open SFTP session object for a given hostname, username, password """
-    sftp = None
-    try:
-        transport_lock.acquire()
-        sftp = paramiko.SFTPClient.from_transport(ssh_transport( hostname, port, username, password))
-    except:
-        sftp = paramiko.SFTPClient.from_transport(ssh_transport( hostname, port, username, password, True))
-    finally:
-        transport_lock.release()
-    return sftp
-
-
-def sftp_safe_path( sftp, path ):
-    """ make sure target sub directories exist """
-    try:
-        sftp_safe_path_lock.acquire()
-
-        parts = path.split('/')[1:-1]
-        pkey = "/".join(parts)
-        spath = ''
-        for p in parts:
-            spath = spath + '/' + p
+def sftp_healthy( sftp ):
+    """ return True if an sftp session and the transport under it are still open """
+    channel = sftp.get_channel()
+    return channel != None and not channel.closed and channel.get_transport().is_active()
+
+class SshSessions:
+    """ the transports to each host that all of the threads share and the sftp channel each thread has opened over them, each thread reuses its channel for every call,
+        it also remembers the remote directories that exist as "host:port/path" and which hosts allow exec, each SshBackend has its own so a job's state is its own """
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.transports = {}
+        self.channels = {}
+        self.local = threading.local()
+        self.dir_cache = DirCache()
+        self.exec_hosts = {}
+
+    def transport( self, key, max_connections = default_connections, dead = None ):
+        """ return a transport for key ( hostname, port, username, password ), a new one is connected while there are fewer than max_connections active ones otherwise the one with the fewest channels is shared, dead is a transport that just failed and is closed """
+        with self.lock:
+            if dead:
+                dead.close()
+            pool = [ t for t in self.transports.get(key,[]) if t.is_active() ]
+            self.transports[key] = pool
+            if len(pool) >= max(1,max_connections):
+                return min( pool, key = lambda t: len([ c for c in self.channels.values() if c is t ]) )
+            hostname, port, username, password = key
+            t = paramiko.Transport((hostname, port ))
+            t.set_keepalive(5)
+            t.connect( username=username, password=password, hostkey= lookup_hostkey( hostname )[0])
+            t.use_compression(True)
+            pool.append(t)
+            return t
+
+    def thread_channels( self ):
+        """ return this thread's dictionary of key to open sftp channel """
+        pool = getattr(self.local, "sftp_pool", None)
+        if pool == None:
+            self.local.sftp_pool = pool = {}
+        return pool
+
+    def open( self, key, max_connections = default_connections ):
+        """ get this thread's open SFTP session object for key, returns ( sftp, reused ) the session stays open for the next call and is replaced if it has died """
+        pool = self.thread_channels()
+        sftp = pool.get(key)
+        if sftp and sftp_healthy( sftp ):
+            return ( sftp, True )
+        if sftp:
+            self.drop( key )
+        t = self.transport( key, max_connections )
+        try:
+            sftp = paramiko.SFTPClient.from_transport( t )
+        except:
+            t = self.transport( key, max_connections, t )
+            sftp = paramiko.SFTPClient.from_transport( t )
+        with self.lock:
+            self.channels[sftp] = t
+        pool[key] = sftp
+        return ( sftp, False )
+
+    def drop( self, key ):
+        """ close and forget this thread's session for a host so the next call opens a new one, the transport is left to the other threads unless it has died """
+        sftp = self.thread_channels().pop(key,None)
+        if sftp:
+            sftp.close()
+            with self.lock:
+                self.channels.pop(sftp,None)
+
+    def release_thread( self ):
+        """ close all of this thread's sessions, a worker thread that is done calls this so its channels don't stay open on the shared transports """
+        for key in list(self.thread_channels().keys()):
+            self.drop( key )
+
+    def close( self ):
+        """ close all of the transports and the sessions of all of the threads on them and forget the directories and hosts, threads that use ssh after this connect again """
+        with self.lock:
+            closing = [ t for pool in self.transports.values() for t in pool ]
+            self.transports = {}
+            self.channels = {}
+            self.exec_hosts = {}
+        self.dir_cache.clear()
+        for t in closing:
+            t.close()
+
+    def open_transports( self ):
+        """ return the number of transports that are open """
+        with self.lock:
+            return len([ t for pool in self.transports.values() for t in pool if t.is_active() ])
+
+# used by the calls that aren't given the sessions of a backend
+shared_sessions = SshSessions()
+
+def connections( config ):
+    """ return the most transports to open to a host from the ssh_connections setting in a config """
+    return int(config.get("ssh_connections",default_connections))
+
+def sftp_call( remote_path, get_config, action, retry = True, sessions = None ):
+    """ return action( sftp, path ) run with this thread's session for remote_path, if the call fails because a reused session had died it is reconnected and action is called again if retry is True """
+    sessions = sessions or shared_sessions
+    host, port, path = split_hostpath( remote_path )
+    config = get_config()
+    key = ( host, port, config['ssh_username'], config['ssh_password'] )
+    while True:
+        sftp, reused = sessions.open( key, connections( config ) )
+        try:
+            return action( sftp, path )
+        except Exception:
+            if sftp_healthy( sftp ):
+                raise
+            sessions.drop( key )
+            if not (reused and retry):
+                raise
+            retry = False
+
+def release_thread( sessions = None ):
+    """ close the calling thread's sftp sessions, the transports stay open for the other threads """
+    (sessions or shared_sessions).release_thread()
+
+def close_sessions( sessions = None ):
+    """ close the transports and the sessions of all of the threads, threads that use ssh after this connect again """
+    (sessions or shared_sessions).close()
+
+def sftp_safe_path( sftp, path, host, port, dir_cache ):
+    """ make sure target sub directories exist, directories that are already known to exist in dir_cache cost nothing """
+    prefix = "%s:%d"%(host,port)
+    def parent( key ):
+        return prefix+posixpath.dirname(key[len(prefix):])
+    def make_dir( key ):
+        spath = key[len(prefix):]
+        try:
+            st = sftp.stat( spath )
+        except IOError:
+            if spath != "/":
+                dir_cache.ensure( parent(key), make_dir, parent )
             try:
-                st = sftp.stat( spath )
-            except:
                 sftp.mkdir(spath)
-                st = sftp.stat( spath )
+            except IOError:
+                # someone else may have just made it
+                pass
+            st = sftp.stat( spath )
 
-            if not stat.S_ISDIR( st.st_mode ):
-                raise Exception("sftp_safe_path: path element is not a directory!",spath)
-    finally:
-        sftp_safe_path_lock.release()
+        if not stat.S_ISDIR( st.st_mode ):
+            raise Exception("sftp_safe_path: path element is not a directory!",spath)
 
+    dir_cache.ensure( prefix+posixpath.dirname(path), make_dir, parent )
     return path
 
-def ssh_utime( remote_path, times, get_config = lambda: {} ):
-    """ set the modified time for a remote file using sftp """
-    host, port, path = split_hostpath( remote_path )
-    sftp = sftp_open( host, port, get_config()['ssh_username'], get_config()['ssh_password'] )
+def sftp_cached_write( sftp, path, host, port, dir_cache, write ):
+    """ return write( path ) once the directory of path exists, if a directory dir_cache thought existed was removed behind its back what it knows about the host is forgotten and write is tried once more """
     try:
-        sftp.utime( path, times )
-    finally:
-        sftp.close()
+        return write( sftp_safe_path( sftp, path, host, port, dir_cache ) )
+    except FileNotFoundError:
+        dir_cache.forget( "%s:%d/"%(host,port) )
+        return write( sftp_safe_path( sftp, path, host, port, dir_cache ) )
+
+def ssh_utime( remote_path, times, get_config = lambda: {}, sessions = None ):
+    """ set the modified time for a remote file using sftp """
+    sftp_call( remote_path, get_config, lambda sftp, path: sftp.utime( path, times ), sessions = sessions )
 
 
-def ssh_get( remote_path, local_path, get_config = lambda: {} ):
+def ssh_get( remote_path, local_path, get_config = lambda: {}, sessions = None ):
     """ copy from remote path to local_path using sftp """
-    host, port, path = split_hostpath( remote_path )
-    sftp = sftp_open( host, port, get_config()['ssh_username'], get_config()['ssh_password'] )
-    try:
-        sftp.get( path, safe_path(local_path) )
-    finally:
-        sftp.close()
-
-def ssh_put( local_path, remote_path, get_config = lambda: {}, verbose = False ):
+    sftp_call( remote_path, get_config, lambda sftp, path: sftp.get( path, safe_path(local_path) ), sessions = sessions )
+
+def ssh_get_range( remote_path, local_path, offset, length, get_config = lambda: {}, sessions = None ):
+    """ copy length bytes starting at offset in remote path to local_path using sftp """
+    def get_range( sftp, path ):
+        remaining = length
+        with sftp.open( path, "rb" ) as f, open(safe_path(local_path),"wb") as out:
+            f.seek(offset)
+            while remaining:
+                block = f.read(min(remaining,1024*1024))
+                if not block:
+                    raise Exception("ssh_get_range: File is truncated",remote_path)
+                out.write(block)
+                remaining -= len(block)
+    sftp_call( remote_path, get_config, get_range, sessions = sessions )
+
+def ssh_put( local_path, remote_path, get_config = lambda: {}, verbose = False, sessions = None ):
     """ copy to remote path from local_path using sftp """
-    host, port, path = split_hostpath( remote_path )
-    sftp = sftp_open( host, port, get_config()['ssh_username'], get_config()['ssh_password'] )
-
     def put_progress( bytes_transferred, bytes_remaining ):
         if "last_transferred" not in put_progress.__dict__:
             put_progress.last_transferred = 0
@@ -151,21 +264,121 @@ def ssh_put( local_path, remote_path, get_config = lambda: {}, verbose = False )
             sys.stderr.write("ssh_put: %s %12d %12d\r"%(os.path.basename(local_path),bytes_transferred,bytes_remaining))
             put_progress.last_transferred = bytes_transferred
 
-    try:
+    sessions = sessions or shared_sessions
+    host, port, path = split_hostpath( remote_path )
+    def put( sftp, path ):
         if not verbose:
-            sftp.put( local_path, sftp_safe_path(sftp,path) )
+            sftp_cached_write( sftp, path, host, port, sessions.dir_cache, lambda path: sftp.put( local_path, path ) )
         else:
-            sftp.put( local_path, sftp_safe_path(sftp,path), put_progress )
-
-    finally:
-        sftp.close()
+            sftp_cached_write( sftp, path, host, port, sessions.dir_cache, lambda path: sftp.put( local_path, path, put_progress ) )
+    sftp_call( remote_path, get_config, put, sessions = sessions )
 
 
-def ssh_ls( remote_path, recurse=False, get_config= lambda: {}, verbose=False ):
-    """ list directories and files perhaps recursively using sftp """
+def ssh_append( local_path, remote_path, get_config = lambda: {}, sessions = None ):
+    """ append the contents of local_path to the end of remote path creating it if it doesn't exist using sftp """
+    sessions = sessions or shared_sessions
     host, port, path = split_hostpath( remote_path )
-    sftp = sftp_open( host, port, get_config()['ssh_username'], get_config()['ssh_password'] )
-    try:
+    def append( sftp, path ):
+        def write( path ):
+            with open(local_path,"rb") as f, sftp.open( path, "ab" ) as out:
+                while True:
+                    block = f.read(1024*1024)
+                    if not block:
+                        break
+                    out.write(block)
+        sftp_cached_write( sftp, path, host, port, sessions.dir_cache, write )
+    # a retry could append part of the file twice
+    sftp_call( remote_path, get_config, append, False, sessions )
+
+class SftpPipeline:
+    """ sends sftp requests on one session without waiting for the answers so many of them are in flight at once, callback( t, msg ) is called with each response as it arrives and can send more requests, this uses the same internal paramiko request api as its own listdir_iter and prefetch """
+    def __init__( self, sftp, depth = pipeline_depth ):
+        self.sftp = sftp
+        self.depth = depth
+        self.waiting = deque()
+        self.callbacks = {}
+
+    def send( self, t, args, callback ):
+        """ queue a request of type t with a list of args """
+        self.waiting.append(( t, args, callback ))
+
+    def run( self ):
+        """ send the requests and dispatch the responses until there are none left """
+        while self.waiting or self.callbacks:
+            while self.waiting and len(self.callbacks) < self.depth:
+                t, args, callback = self.waiting.popleft()
+                num = self.sftp._async_request( type(None), t, *args )
+                self.callbacks[num] = callback
+            t, data = self.sftp._read_packet()
+            msg = paramiko.Message(data)
+            num = msg.get_int()
+            with self.sftp._lock:
+                self.sftp._expecting.pop(num,None)
+            callback = self.callbacks.pop(num,None)
+            if callback:
+                callback( t, msg )
+
+    def status( self, msg ):
+        """ return None if a status message is ok or the IOError or EOFError for it """
+        try:
+            self.sftp._convert_status(msg)
+        except (IOError, EOFError) as e:
+            return e
+        return None
+
+def sftp_walk( sftp, path, recurse, on_entry, on_error ):
+    """ list the directory path and if recurse is True the directories under it with all of the listings pipelined, on_entry( dir, attr ) is called with the lstat attributes of each entry and returns True if it is a directory to descend into, on_error( dir, error ) is called for directories that can't be listed """
+    pipeline = SftpPipeline( sftp )
+    def open_dir( dir ):
+        pipeline.send( CMD_OPENDIR, [ dir ], lambda t, msg: opened( dir, t, msg ) )
+    def opened( dir, t, msg ):
+        if t == CMD_HANDLE:
+            handle = msg.get_binary()
+            pipeline.send( CMD_READDIR, [ handle ], lambda t, msg: read( dir, handle, t, msg ) )
+        else:
+            on_error( dir, pipeline.status(msg) )
+    def read( dir, handle, t, msg ):
+        if t == CMD_NAME:
+            for i in range(msg.get_int()):
+                filename = msg.get_text()
+                longname = msg.get_text()
+                attr = paramiko.SFTPAttributes._from_msg( msg, filename, longname )
+                if filename not in [ ".", ".." ] and on_entry( dir, attr ) and recurse:
+                    open_dir( posixpath.join(dir,filename) )
+            pipeline.send( CMD_READDIR, [ handle ], lambda t, msg: read( dir, handle, t, msg ) )
+        else:
+            error = pipeline.status(msg)
+            if not isinstance(error,EOFError):
+                on_error( dir, error )
+            pipeline.send( CMD_CLOSE, [ handle ], None )
+    open_dir( path )
+    pipeline.run()
+
+def ssh_ls( remote_path, recurse=False, get_config= lambda: {}, verbose=False, sessions = None ):
+    """ list directories and files perhaps recursively with one find over an exec channel if the host allows it otherwise using sftp, the sftp listings of all of the directories are pipelined and come with the attributes of their entries """
+    host, port, path = split_hostpath( remote_path )
+    entries = ssh_find( remote_path, recurse, get_config, sessions )
+    if entries != None:
+        stream = StringIO()
+        top = path.rstrip("/") or "/"
+        for type, size, mtime, fp in entries:
+            if fp == top:
+                if type == "d":
+                    continue
+                fp = path
+            else:
+                # don't do hidden or follow links
+                if [ p for p in fp[len(top):].split("/") if p.startswith(".") ] or type == "l":
+                    continue
+                if type == "d":
+                    if not recurse:
+                        print("                           DIR ssh://%s:%s%s/"%(host,port,fp), file=stream)
+                    continue
+            mtime = time.localtime(mtime)
+            print("%04d-%02d-%02d %02d:%02d %9d   ssh://%s:%s%s"%(mtime.tm_year,mtime.tm_mon,mtime.tm_mday,mtime.tm_hour,mtime.tm_min,size,host,port,fp), file=stream)
+        return stream.getvalue()
+
+    def ls( sftp, path ):
         output = ""
         stream = StringIO()
 
@@ -175,89 +388,92 @@ def ssh_ls( remote_path, recurse=False, get_config= lambda: {}, verbose=False ):
             return output
 
         if stat.S_ISDIR( st.st_mode):
-            dirs = []
-            dirs.append( path )
-            while dirs:
-                dir = dirs.pop()
-                if verbose:
-                    print("Processing ", dir, file=sys.stderr)
-                try:
-                    entries = sftp.listdir(dir)
-                except IOError:
-                    continue
+            def on_entry( dir, st ):
+                fp = posixpath.join(dir,st.filename)
+                # don't do hidden
+                if st.filename.startswith("."):
+                    return False
 
-                for entry in entries:
-                    fp = os.path.join(dir,entry)
-                    # don't do hidden
-                    if entry.startswith("."):
-                        continue
+                # don't follow links
+                if stat.S_ISLNK( st.st_mode ):
+                    return False
 
+                if stat.S_ISDIR( st.st_mode ):
                     if verbose:
-                        print("Is dir ?", fp, file=sys.stderr)
-                    try:
-                        st = sftp.lstat(fp)
-                    except IOError:
-                        continue
-
-                    # don't follow links
-                    if stat.S_ISLNK( st.st_mode ):
-                        continue
-
-                    if stat.S_ISDIR( st.st_mode ):
-                        if recurse:
-                            dirs.append( fp )
-                        else:
-                            print("                           DIR ssh://%s:%s%s/"%(host,port,fp), file=stream)
-                    else:
-                        mtime = time.localtime(st.st_mtime)
-                        print("%04d-%02d-%02d %02d:%02d %9d   ssh://%s:%s%s"%(mtime.tm_year,mtime.tm_mon,mtime.tm_mday,mtime.tm_hour,mtime.tm_min,st.st_size,host,port,fp), file=stream)
+                        print("Processing ", fp, file=sys.stderr)
+                    if not recurse:
+                        print("                           DIR ssh://%s:%s%s/"%(host,port,fp), file=stream)
+                    return True
+                else:
+                    mtime = time.localtime(st.st_mtime)
+                    print("%04d-%02d-%02d %02d:%02d %9d   ssh://%s:%s%s"%(mtime.tm_year,mtime.tm_mon,mtime.tm_mday,mtime.tm_hour,mtime.tm_min,st.st_size,host,port,fp), file=stream)
+                    return False
+            def on_error( dir, error ):
+                if verbose:
+                    print("Can't list ", dir, error, file=sys.stderr)
+            sftp_walk( sftp, path, recurse, on_entry, on_error )
         else:
             mtime = time.localtime(st.st_mtime)
             print("%04d-%02d-%02d %02d:%02d %9d   ssh://%s:%s%s"%(mtime.tm_year,mtime.tm_mon,mtime.tm_mday,mtime.tm_hour,mtime.tm_min,st.st_size,host,port,path), file=stream)
 
         output = stream.getvalue()
         stream.close()
-    finally:
-        sftp.close()
-    return output
+        return output
+    return sftp_call( remote_path, get_config, ls, sessions = sessions )
 
-def ssh_del( remote_path, recurse=False, get_config= lambda: {} ):
-    """ remove files or directories perhaps recursively using sftp """
+def ssh_del( remote_path, recurse=False, get_config= lambda: {}, sessions = None ):
+    """ remove files or directories perhaps recursively using sftp, the directories are listed and the files removed with pipelined requests """
+    sessions = sessions or shared_sessions
     host, port, path = split_hostpath( remote_path )
-    sftp = sftp_open( host, port, get_config()['ssh_username'], get_config()['ssh_password'] )
-    try:
+    def delete( sftp, path ):
         try:
-            st = sftp.stat(path)
+            st = sftp.lstat(path)
         except IOError as e:
             if str(e) == "[Errno 2] No such file":
                 return ""
             else:
                 raise
         if stat.S_ISDIR( st.st_mode):
-            dirs = []
-            remove_dirs = []
-            dirs.append( path )
-            remove_dirs.append( path )
-            while dirs:
-                dir = dirs.pop()
-                entries = sftp.listdir(dir)
-                for entry in entries:
-                    fp = os.path.join(dir,entry)
-                    st = sftp.stat(fp)
-                    if stat.S_ISDIR(st.st_mode) and recurse:
-                        dirs.append( fp )
-                        remove_dirs.append(fp)
-                    else:
-                        sftp.remove(fp)
-            while remove_dirs:
-                dir = remove_dirs.pop()
-                sftp.rmdir(dir)
-
+            sessions.dir_cache.forget( "%s:%d%s"%(host,port,path) )
+            files = []
+            remove_dirs = [ ( 0, path ) ]
+            depths = { path : 0 }
+            errors = []
+            def on_entry( dir, st ):
+                fp = posixpath.join(dir,st.filename)
+                if stat.S_ISDIR( st.st_mode ) and recurse:
+                    depths[fp] = depths[dir]+1
+                    remove_dirs.append( ( depths[fp], fp ) )
+                    return True
+                files.append( fp )
+                return False
+            def on_error( dir, error ):
+                errors.append( error )
+            sftp_walk( sftp, path, recurse, on_entry, on_error )
+            if errors:
+                raise errors[0]
+
+            pipeline = SftpPipeline( sftp )
+            def check( t, msg ):
+                error = pipeline.status(msg)
+                if error:
+                    errors.append( error )
+            for fp in files:
+                pipeline.send( CMD_REMOVE, [ fp ], check )
+            pipeline.run()
+            # the directories are removed a level at a time from the deepest up
+            remove_dirs.sort()
+            while remove_dirs and not errors:
+                depth = remove_dirs[-1][0]
+                while remove_dirs and remove_dirs[-1][0] == depth:
+                    pipeline.send( CMD_RMDIR, [ remove_dirs.pop()[1] ], check )
+                pipeline.run()
+            if errors:
+                raise errors[0]
         else:
             sftp.remove(path)
-    finally:
-        sftp.close()
-    return ""
+        return ""
+    return sftp_call( remote_path, get_config, delete, sessions = sessions )
 
 
 def ssh_test( remote_path, verbose = False, get_config= lambda: {} ):
@@ -278,15 +494,146 @@ def ssh_test( remote_path, verbose = False, get_config= lambda: {} ):
             print(traceback.format_exc(), file=sys.stderr)
         return False
 
-def ssh_stat( remote_path, get_config= lambda: {} ):
+def ssh_stat( remote_path, get_config= lambda: {}, sessions = None ):
     """ return tuple (mtime, size) for a file return (-1,-1) if no file mtime resolution is seconds """
-    host, port, path = split_hostpath( remote_path )
-    sftp = sftp_open( host, port, get_config()['ssh_username'], get_config()['ssh_password'] )
-    try:
+    def lstat( sftp, path ):
         st = sftp.lstat(path)
         return (math.floor(st.st_mtime),st.st_size)
+    try:
+        return sftp_call( remote_path, get_config, lstat, sessions = sessions )
     except:
         pass
-    finally:
-        sftp.close()
     return (-1,-1)
+
+def ssh_exec( hostname, port, username, password, command, max_connections = default_connections, sessions = None ):
+    """ run command on the host over an exec channel of a shared transport, returns ( exit status, output bytes ) or None if the server doesn't allow exec """
+    chan = (sessions or shared_sessions).transport( ( hostname, port, username, password ), max_connections ).open_session()
+    try:
+        chan.exec_command( command )
+    except paramiko.SSHException:
+        chan.close()
+        return None
+    try:
+        chan.shutdown_write()
+        output = []
+        while True:
+            block = chan.recv(1024*1024)
+            if not block:
+                break
+            output.append(block)
+        return ( chan.recv_exit_status(), b"".join(output) )
+    finally:
+        chan.close()
+
+def exec_allowed( hostname, port, username, password, get_config, sessions = None ):
+    """ return True if the helper commands can be run on the host, the ssh_exec setting turns this off """
+    sessions = sessions or shared_sessions
+    config = get_config()
+    if not bkp_conf.get_flag( config, "ssh_exec", True ):
+        return False
+    key = ( hostname, port, username )
+    if key not in sessions.exec_hosts:
+        result = ssh_exec( hostname, port, username, password, "find / -maxdepth 0 -printf '' 2>/dev/null", connections(config), sessions )
+        sessions.exec_hosts[key] = (result != None and result[0] == 0)
+    return sessions.exec_hosts[key]
+
+def exec_batches( command, paths, suffix ):
+    """ return commands of the form command path... suffix that each fit in max_command bytes """
+    batches = []
+    args = []
+    length = len(command)+len(suffix)
+    for p in paths:
+        arg = shlex.quote(p)
+        if args and length+len(arg)+1 > max_command:
+            batches.append(" ".join([ command ]+args+[ suffix ]))
+            args = []
+            length = len(command)+len(suffix)
+        args.append(arg)
+        length += len(arg)+1
+    if args:
+        batches.append(" ".join([ command ]+args+[ suffix ]))
+    return batches
+
+def ssh_find( remote_path, recurse=False, get_config= lambda: {}, sessions = None ):
+    """ list remote_path and the files under it, all of them if recurse is True otherwise one level, with one find run over an exec channel, returns a list of ( type, size, mtime, path ) with the find %y type or None if exec isn't allowed """
+    host, port, path = split_hostpath( remote_path )
+    config = get_config()
+    if not exec_allowed( host, port, config['ssh_username'], config['ssh_password'], get_config, sessions ):
+        return None
+    if path != "/":
+        path = path.rstrip("/")
+    command = "find %s %s-printf '%%y %%s %%T@ %%p\\0' 2>/dev/null"%(shlex.quote(path),"" if recurse else "-maxdepth 1 ")
+    result = ssh_exec( host, port, config['ssh_username'], config['ssh_password'], command, connections(config), sessions )
+    if result == None:
+        return None
+    entries = []
+    for record in result[1].split(b"\0")[:-1]:
+        type, size, mtime, fp = record.decode("utf-8","replace").split(" ",3)
+        entries.append(( type, int(size), math.floor(float(mtime)), fp ))
+    return entries
+
+def ssh_stat_many( remote_paths, get_config= lambda: {}, sessions = None ):
+    """ return a dict of remote path to ( mtime, size ) like ssh_stat for paths on one host with as few find runs over an exec channel as fit, each one is stat'ed over sftp if exec isn't allowed """
+    stats = dict([ (p,(-1,-1)) for p in remote_paths ])
+    if not remote_paths:
+        return stats
+    host, port, path = split_hostpath( remote_paths[0] )
+    config = get_config()
+    if exec_allowed( host, port, config['ssh_username'], config['ssh_password'], get_config, sessions ):
+        by_path = dict([ (split_hostpath(p)[2],p) for p in remote_paths ])
+        for command in exec_batches( "find", by_path.keys(), "-maxdepth 0 -printf '%s %T@ %p\\0' 2>/dev/null" ):
+            result = ssh_exec( host, port, config['ssh_username'], config['ssh_password'], command, connections(config), sessions )
+            if result == None:
+                break
+            for record in result[1].split(b"\0")[:-1]:
+                size, mtime, fp = record.decode("utf-8","replace").split(" ",2)
+                if fp in by_path:
+                    stats[by_path[fp]] = ( math.floor(float(mtime)), int(size) )
+        else:
+            return stats
+    for p in remote_paths:
+        stats[p] = ssh_stat( p, get_config, sessions )
+    return stats
+
+def ssh_hash_many( remote_paths, get_config= lambda: {}, sessions = None ):
+    """ return a dict of remote path to sha256 hex digest for the files on one host that exist, computed on the host by sha256sum over an exec channel or if exec isn't allowed by reading the files over sftp """
+    hashes = {}
+    if not remote_paths:
+        return hashes
+    host, port, path = split_hostpath( remote_paths[0] )
+    config = get_config()
+    if exec_allowed( host, port, config['ssh_username'], config['ssh_password'], get_config, sessions ):
+        by_path = dict([ (split_hostpath(p)[2],p) for p in remote_paths ])
+        for command in exec_batches( "sha256sum --", by_path.keys(), "2>/dev/null" ):
+            result = ssh_exec( host, port, config['ssh_username'], config['ssh_password'], command, connections(config), sessions )
+            if result == None:
+                break
+            for line in result[1].decode("utf-8","replace").split("\n"):
+                if not line:
+                    continue
+                digest, fp = line.split(" ",1)
+                fp = fp[1:]
+                # sha256sum escapes names with a newline or backslash in them and marks the line with a leading backslash
+                if digest.startswith("\\"):
+                    digest = digest[1:]
+                    fp = fp.replace("\\n","\n").replace("\\\\","\\")
+                if fp in by_path:
+                    hashes[by_path[fp]] = digest
+        else:
+            return hashes
+    def hash_file( sftp, path ):
+        h = hashlib.sha256()
+        with sftp.open( path, "rb" ) as f:
+            f.prefetch()
+            while True:
+                block = f.read(1024*1024)
+                if not block:
+                    break
+                h.update(block)
+        return h.hexdigest()
+    for p in remote_paths:
+        try:
+            hashes[p] = sftp_call( p, get_config, hash_file, sessions = sessions )
+        except IOError:
+            pass
+    return hashes
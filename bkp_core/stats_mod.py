@@ -0,0 +1,62 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement collection of the statistics reported in the summary of a job """
+import threading
+import sys
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_memory():
+    """ return the peak resident memory of this process in bytes or None if the platform can't tell us """
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes
+    if sys.platform != "darwin":
+        peak = peak * 1024
+    return peak
+
+class JobStats:
+    """ thread safe collection of named statistics for a job, kept in the order they were first recorded """
+    def __init__( self ):
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+
+    def set( self, name, value ):
+        """ set the value of a statistic """
+        with self.stats_lock:
+            self.stats[name] = value
+
+    def add( self, name, value = 1 ):
+        """ add value to a statistic that is a count or a total """
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name,0) + value
+
+    def maximum( self, name, value ):
+        """ keep the largest value seen for a statistic """
+        with self.stats_lock:
+            if name not in self.stats or value > self.stats[name]:
+                self.stats[name] = value
+
+    def get( self, name, default = 0 ):
+        """ get the value of a statistic """
+        with self.stats_lock:
+            return self.stats.get(name,default)
+
+    def record_peak_memory( self ):
+        """ record the peak resident memory of the process in megabytes """
+        peak = peak_memory()
+        if peak != None:
+            self.set("peak_memory_mb", peak / (1024.0*1024.0))
+
+    def summary( self ):
+        """ return the statistics formatted as lines of name = value for the end of a job """
+        lines = []
+        with self.stats_lock:
+            for name, value in self.stats.items():
+                if isinstance(value,float):
+                    lines.append("%s = %.2f"%(name,value))
+                else:
+                    lines.append("%s = %s"%(name,value))
+        return "\n".join(lines)+"\n"
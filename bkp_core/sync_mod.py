@@ -3,18 +3,29 @@
 import sys
 import os
 import re
-import traceback
-import queue
-import threading
 import platform
 import time
 import io
-from bkp_core.fs_mod import fs_get,fs_put,fs_ls,fs_stat,fs_test,fs_utime
+import threading
+import traceback
+from bkp_core import fs_mod
+from bkp_core import bkp_conf
+from bkp_core import dedup_mod
+from bkp_core.fs_mod import fs_get,fs_put
 from bkp_core.util import put_contents
 from bkp_core.logger import Logger
+from bkp_core import transfer_mod
+from bkp_core.exclude_mod import Matcher
+from bkp_core.stats_mod import JobStats
+from bkp_core.index_mod import PathSet
+
+# with verify on the copied files are checked against the remote in batches of this many so an ssh host hashes them with one command
+verify_batch = 256
 
 class WorkerParams:
     """ worker params """
+    __slots__ = ( "from_path", "to_path", "method", "mtime" )
+
     def __init__(self, method, from_path, to_path, mtime = 0.0):
         """ set up the copy from and to paths for the worker """
         self.from_path = from_path
@@ -31,19 +42,25 @@ class SyncJob:
     def init( self, config ):
         """ initialize our internal state for a new run """
         self.config = config
-        self.work_queue = queue.Queue()
+        # the transfer queue is bounded so the scan blocks instead of holding every pending file in memory
+        self.queue_size = int(config.get("queue_size",1000))
+        self.engine = None
         self.machine_path = ""
-        self.errors_count = 0
-        self.worker_thread_pool = []
-        self.processed_files = {}
+        self.fs = None
+        # every file on either side is remembered, in sets on disk so a large tree doesn't hold them all in memory
+        self.processed_files = PathSet()
         self.processed_dirs = {}
         self.pending_markers = []
-        self.worker_stop = False
-        self.remote_processed_files = {}
+        self.remote_processed_files = PathSet()
         if not os.path.exists(os.path.expanduser("~/.sync")):
             os.mkdir(os.path.expanduser("~/.sync"))
         self.remote_processed_files_name = os.path.expanduser("~/.sync/.sync.processed")
-        self.logger = Logger()
+        self.verify = bkp_conf.get_flag(config,"verify")
+        self.verify_lock = threading.Lock()
+        self.verify_pending = []
+        self.matcher = Matcher(config["exclude_dirs"],config["exclude_files"])
+        self.stats = JobStats()
+        self.logger = Logger(self.queue_size)
 
     def set_dryrun( self, dr ):
         """ set the dryrun flag to true to prevent real actions in s3 """
@@ -53,108 +70,115 @@ class SyncJob:
         """ set the verbose flag to true to enable extended output """
         self.verbose = vb
 
-    def process_sync( self ):
-        """ thread body for worker thread, loop processing the queue until killed """
-        start_time = time.time()
-        while not self.worker_stop:
-            try:
-                # every 5 minutes dump a stack trace if verbose
-                if time.time() - start_time > 300:
-                    start_time = time.time()
-                params = self.work_queue.get(True,1)
-                try:
-                    if not self.dryrun:
-                        if self.verbose:
-                            self.logger.log( "Starting transfer: %s to %s"%(params.from_path, params.to_path) )
-                        if params.method == fs_put:
-                            params.method( params.from_path, params.to_path, lambda: self.config, self.verbose)
-                            fs_utime( params.to_path, (params.mtime, params.mtime), lambda: self.config)
-                        else:
-                            params.method( params.from_path, params.to_path, lambda: self.config )
-                            os.utime( params.to_path, (params.mtime, params.mtime))
-                    if self.verbose:
-                        self.logger.log( "Transferred: %s to %s"%(params.from_path, params.to_path) )
-                    self.work_queue.task_done()
-                except:
-                    tb = traceback.format_exc()
-                    self.logger.log( "Failed Transfer: %s to %s error %s"%(params.from_path, params.to_path, tb) )
-                    self.errors_count += 1
-                    self.work_queue.task_done()
-            except queue.Empty:
-                continue
-            except:
-                self.work_queue.task_done()
-                self.logger.log(traceback.format_exc())
-                continue
+    def sync_file( self, params ):
+        """ transfer task that copies one file in the direction it changed and gives the copy the same modified time """
+        if not self.dryrun:
+            if self.verbose:
+                self.logger.log( "Starting transfer: %s to %s"%(params.from_path, params.to_path) )
+            if params.method == fs_put:
+                params.method( params.from_path, params.to_path, lambda: self.config, self.verbose)
+                self.fs.utime( params.to_path, (params.mtime, params.mtime), lambda: self.config)
+            else:
+                params.method( params.from_path, params.to_path, lambda: self.config )
+                os.utime( params.to_path, (params.mtime, params.mtime))
+
+    def sync_done( self, future ):
+        """ called by the transfer engine when a file's transfer is done to log how it went """
+        params = future.args[0]
+        if future.traceback:
+            self.logger.log( "Failed Transfer: %s to %s error %s"%(params.from_path, params.to_path, future.traceback) )
+            self.stats.add("errors")
+        else:
+            if self.verbose:
+                self.logger.log( "Transferred: %s to %s"%(params.from_path, params.to_path) )
+            if self.verify and not self.dryrun:
+                batch = None
+                with self.verify_lock:
+                    self.verify_pending.append( params )
+                    if len(self.verify_pending) >= verify_batch:
+                        batch, self.verify_pending = self.verify_pending, []
+                if batch:
+                    self.verify_files( batch )
+
+    def verify_files( self, batch ):
+        """ check that each copied file in the batch has the same sha256 as the remote copy, hashed where it is, a mismatch or a missing copy is an error """
+        # the remote path is the one written by a put and read by a get
+        paths = [ (p.from_path, p.to_path) if p.method == fs_put else (p.to_path, p.from_path) for p in batch ]
+        try:
+            remote_hashes = self.fs.hash_many( [ remote_path for local_path, remote_path in paths ], lambda: self.config )
+            for local_path, remote_path in paths:
+                if remote_hashes.get(remote_path) != dedup_mod.file_hash( local_path ):
+                    self.logger.log( "Verify failed: %s and %s differ"%(local_path, remote_path) )
+                    self.stats.add("errors")
+                    self.stats.add("verify_failures")
+                else:
+                    self.stats.add("files_verified")
+        except:
+            self.logger.log( "Verify failed: %s"%traceback.format_exc() )
+            self.stats.add("errors")
+            self.stats.add("verify_failures", len(paths))
 
     def start_workers(self):
-        """ start the workers in the pool """
-        num_threads = int(self.config["threads"])
+        """ start the transfer engine that runs the file transfers """
+        self.engine = transfer_mod.make_engine( self.config, self.queue_size, self.logger.log if self.verbose else None ).start()
 
-        while num_threads:
-            t = threading.Thread(target=self.process_sync)
-            t.start()
-            self.worker_thread_pool.append(t)
-            num_threads = num_threads - 1
+    def queue_sync( self, method, from_path, to_path, mtime, size ):
+        """ submit a file to the transfer engine to be copied with method, fs_put or fs_get """
+        self.engine.submit( self.sync_file, WorkerParams( method, from_path, to_path, mtime ), backend=self.fs.scheme, size=size, callback=self.sync_done )
 
     def stop_workers(self):
-        """ stop the workers """
-        self.worker_stop = True
+        """ cancel the transfers that haven't started, the running ones finish on their own """
+        if self.engine:
+            self.engine.cancel()
 
     def wait_for_workers(self):
-        """ wait for the worker queue to be empty """
-        if not self.work_queue.empty():
-            self.work_queue.join()
-        self.stop_workers()
-        for t in self.worker_thread_pool:
-            if t.is_alive():
-                t.join()
-        self.worker_stop = False
-        self.worker_thread_pool = []
-        self.work_queue = queue.Queue()
+        """ wait for the transfer engine to finish everything submitted to it and record its statistics """
+        self.engine.join()
+        self.engine.record_stats( self.stats )
+
+    def excluded_dir( self, dirpath ):
+        """ return the rule that excludes dirpath or any of the directories above it or None, results are cached by the matcher """
+        parent = os.path.dirname(dirpath)
+        if parent and parent != dirpath:
+            e = self.excluded_dir( parent )
+            if e:
+                return e
+        return self.matcher.exclude_dir( dirpath )
 
     def sync_directory( self, path ):
         """ enqueue the files to be synced for a given directory path, apply filters on datetime, pattern, non-hidden files only, recurse visible subdirs """
 
         # save off remote directory recursive listing
-        remote_files = fs_ls(self.machine_path+path,True, lambda: self.config)
+        remote_files = self.fs.ls(self.machine_path+path,True, lambda: self.config)
+
+        # if the directory itself is excluded there is nothing to walk
+        e = self.matcher.exclude_dir( path )
+        if e:
+            if self.verbose:
+                self.logger.log("Excluding dirpath= %s because of e= %s"%(path,e))
+            dirs_to_walk = []
+        else:
+            dirs_to_walk = os.walk(path)
 
-        for (dirpath, dirnames, filenames) in os.walk(path):
+        for (dirpath, dirnames, filenames) in dirs_to_walk:
             if self.verbose:
                 self.logger.log("Scanning dirpath= %s"%(dirpath))
-            # if exclude_dirs is contained in any of the paths then return
-            exclude_dir = False
-            for e in self.config["exclude_dirs"]:
-                if e and re.search(e,dirpath):
-                    exclude_dir = True
-                    break
-            if exclude_dir:
-                if self.verbose:
-                    self.logger.log("Excluding dirpath= %s because of e= %s"%(dirpath,e))
-                continue
 
             # get rid of hidden directories
-            while True:
-                deleted = False
-                didx = 0
-                for d in dirnames:
-                    if d[0] == ".":
-                        if self.verbose:
-                            self.logger.log("Deleting hidden directory = %s"%(d))
-                        del dirnames[didx]
-                        deleted = True
-                        break
-                    didx = didx + 1
-                if not deleted:
-                    break
-
-            # stat the sentinel file .sync to avoid sloshing files around
+            for d in [d for d in dirnames if d[0] == "."]:
+                if self.verbose:
+                    self.logger.log("Deleting hidden directory = %s"%(d))
+                dirnames.remove(d)
+
+            # prune the excluded directories so os.walk never descends into them
+            self.matcher.prune( dirpath, dirnames, self.logger.log if self.verbose else None )
+
+            # the sentinel file .sync is dropped in the remote directory once the copies are done
             sync_marker_path = self.machine_path + os.path.abspath(dirpath)
             sync_marker_node = ".sync."+ platform.node()
-            sync_marker = os.path.join( sync_marker_path, sync_marker_node )
-            sync_mtime,sync_size = fs_stat(sync_marker,lambda: self.config)
 
-            # process files in the directory enqueueing included files for sync
+            # process files in the directory collecting the included files to sync
+            candidates = []
             for f in filenames:
                 # if it is a hidden file skip it
                 if f[0] == ".":
@@ -163,28 +187,36 @@ class SyncJob:
                     continue
 
                 # if it is excluded file skip it
-                if self.config["exclude_files"] and re.match(self.config["exclude_files"],f):
+                e = self.matcher.exclude_file( dirpath, f )
+                if e:
                     if self.verbose:
-                        self.logger.log("Excluding file = %s Because of pattern= %s"%(f,self.config["exclude_files"]))
+                        self.logger.log("Excluding file = %s Because of pattern= %s"%(f,e))
                     continue
 
                 # build the absolute path for the file and it's sync path
                 local_path = os.path.join(os.path.abspath(dirpath),f)
                 remote_path = self.machine_path + local_path
+                candidates.append((local_path,remote_path,os.lstat(local_path)))
+
+            # stat the whole directory at once, a backend that answers from a listing only needs the real remote mtime
+            # when the stored time doesn't already show that the local file is newer
+            local_mtimes = dict([ (remote_path,s.st_mtime) for local_path,remote_path,s in candidates ])
+            remote_stats = self.fs.stat_many( [ remote_path for local_path,remote_path,s in candidates ], lambda: self.config,
+                                              lambda path, mtime, size: local_mtimes[path] - mtime < 1.0 )
 
-                # if the file is in the time range for this sync then queue it for sync
-                s = os.lstat(local_path)
-                mtime, size = fs_stat(remote_path,lambda: self.config)
-                self.processed_files[remote_path] = True
+            # enqueue the files that changed on one side since the last sync
+            for local_path, remote_path, s in candidates:
+                mtime, size = remote_stats[remote_path]
+                self.processed_files.add(remote_path)
 
                 if s.st_mtime < mtime and (mtime - s.st_mtime) >= 1.0:
                     if self.verbose:
                         self.logger.log("Enqueuing get for %s,%s timediff %f"%(remote_path,local_path, mtime - s.st_mtime))
-                    self.work_queue.put(WorkerParams( fs_get, remote_path, local_path, mtime ))
+                    self.queue_sync( fs_get, remote_path, local_path, mtime, size )
                 elif s.st_mtime > mtime and (s.st_mtime - mtime) >= 1.0:
                     if self.verbose:
                         self.logger.log("Enqueuing put for %s,%s timediff %f"%(local_path,remote_path,s.st_mtime - mtime))
-                    self.work_queue.put(WorkerParams( fs_put, local_path, remote_path, s.st_mtime ))
+                    self.queue_sync( fs_put, local_path, remote_path, s.st_mtime, s.st_size )
                 else:
                     if self.verbose:
                         self.logger.log("Not Enqueuing copy work for %s because time is the same or not greater than last sync"%(local_path))
@@ -204,13 +236,14 @@ class SyncJob:
                 lpath = fpath[len(self.machine_path):]
                 ldir,lnode = os.path.split(lpath)
                 fdir,fnode = os.path.split(fpath)
-                # if exclude_dirs is contained in any of the paths then return
-                exclude_dir = False
-                for e in self.config["exclude_dirs"]:
-                    if (e and re.search(e,ldir)) or re.match(".*/\..*",ldir):
-                        exclude_dir = True
-                        break
-                if exclude_dir:
+                # skip anything in a hidden directory
+                if re.match(".*/\..*",ldir):
+                    if self.verbose:
+                        self.logger.log("Excluding hidden dirpath= %s"%(ldir))
+                    continue
+                # if the directory or one of its parents is excluded skip it
+                e = self.excluded_dir( ldir )
+                if e:
                     if self.verbose:
                         self.logger.log("Excluding dirpath= %s because of e= %s"%(ldir,e))
                     continue
@@ -221,9 +254,10 @@ class SyncJob:
                     continue
 
                 # if it is excluded file skip it
-                if self.config["exclude_files"] and re.match(self.config["exclude_files"],lnode):
+                e = self.matcher.exclude_file( ldir, lnode )
+                if e:
                     if self.verbose:
-                        self.logger.log("Excluding file = %s Because of pattern= %s"%(lnode,self.config["exclude_files"]))
+                        self.logger.log("Excluding file = %s Because of pattern= %s"%(lnode,e))
                     continue
 
                 # if it was processed in the past don't fetch it just mark it as processed
@@ -231,12 +265,12 @@ class SyncJob:
                 if not fpath in self.remote_processed_files:
                     if self.verbose:
                         self.logger.log("Enqueuing get for %s,%s"%(fpath,lpath))
-                    mtime, size = fs_stat(fpath,lambda: self.config)
-                    self.work_queue.put(WorkerParams( fs_get, fpath, lpath, mtime))
+                    mtime, size = self.fs.stat(fpath,lambda: self.config)
+                    self.queue_sync( fs_get, fpath, lpath, mtime, size )
                 else:
                     if self.verbose:
                         self.logger.log("Not enqueuing get for %s becase it was deleted on client"%(fpath))
-                self.processed_files[fpath] = True
+                self.processed_files.add(fpath)
                 if not fdir in self.processed_dirs:
                     self.processed_dirs[fdir] = True
                     self.pending_markers.append((fdir,".sync."+platform.node()))
@@ -245,6 +279,8 @@ class SyncJob:
     def synchronize(self):
         """ driver to perform syncrhonize """
 
+        # the job has backends of its own, closing them when it is done doesn't touch any other job's
+        self.backends = fs_mod.Backends().use()
         try:
             # initialize our internal state for a new run
             self.init( self.config )
@@ -252,14 +288,23 @@ class SyncJob:
             # the sync target a given machine will be target
             self.machine_path = self.config["target"]
 
+            # the backend for the target is resolved once and shared by all of the workers
+            self.fs = fs_mod.get_backend( self.machine_path )
+
             # if there is no connection to the target then exit
-            if not fs_test( self.machine_path, self.verbose, lambda: self.config ):
+            if not self.fs.test( self.machine_path, self.verbose, lambda: self.config ):
+                self.backends.done()
                 return 0
 
+            # only a backend that hashes files where they are can check the copies without reading them back
+            if self.verify and not self.fs.has(fs_mod.REMOTE_HASH):
+                self.logger.log( "Verify is not supported for %s, the copies won't be checked"%self.machine_path )
+                self.verify = False
+
             # get the remote processed files so we can check for deletes
             if os.path.exists(self.remote_processed_files_name):
                 for line in open(self.remote_processed_files_name):
-                    self.remote_processed_files[line.strip()] = True
+                    self.remote_processed_files.add(line.strip())
 
             # start the logger thread
             self.logger.start_logger()
@@ -274,6 +319,11 @@ class SyncJob:
             # wait for queue to empty
             self.wait_for_workers()
 
+            # check the copies that didn't fill a whole batch
+            if self.verify_pending:
+                self.verify_files( self.verify_pending )
+                self.verify_pending = []
+
             # drop all our sync markers after any copies complete
             for sync_marker_path,sync_marker_node in self.pending_markers:
                 put_contents(sync_marker_path,sync_marker_node, "syncrhonized %s"%time.ctime(),self.dryrun,lambda: self.config, self.verbose)
@@ -281,19 +331,30 @@ class SyncJob:
             # write out the processed files
             if not self.dryrun:
                 processed_out = open(self.remote_processed_files_name,"w")
-                for fpath in self.processed_files.keys():
+                for fpath in self.processed_files:
                     print(fpath, file=processed_out)
                 processed_out.close()
 
+            # log the job summary
+            if self.verbose:
+                self.stats.record_peak_memory()
+                self.logger.log(self.stats.summary())
+
             # wait for the logger to finish
             self.logger.wait_for_logger()
+            self.backends.done()
+            self.processed_files.close()
+            self.remote_processed_files.close()
 
         except:
             self.stop_workers()
             self.logger.stop_logger()
+            self.backends.done()
+            self.processed_files.close()
+            self.remote_processed_files.close()
             raise
 
-        if self.errors_count:
+        if self.stats.get("errors"):
             return 1
         else:
             return 0
@@ -0,0 +1,318 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement the engine that runs the file transfers of a job on a pool of threads for the bkp, rstr and sync tools """
+import time
+import threading
+import traceback
+import concurrent.futures
+from bkp_core import fs_mod
+from bkp_core import bkp_conf
+from bkp_core.queue_mod import WorkQueue, Closed, Stopped
+
+# with adaptive_threads on the transfers that finish in each window of this many seconds decide the number of threads for the next one
+adapt_seconds = 2.0
+# a window with fewer finished transfers than this doesn't say enough about the throughput to change anything
+adapt_min_samples = 4
+# the throughput has to fall by more than this fraction from the last window to count as a slowdown
+adapt_tolerance = 0.1
+# the number of threads is multiplied by these when a window had errors or was slower, otherwise it goes up by one while work is waiting
+error_decrease = 0.5
+slowdown_decrease = 0.75
+
+class TransferFuture(concurrent.futures.Future):
+    """ the future for one transfer, besides its result it has the bytes it moved, the traceback if it failed and when it was queued, started and finished """
+    def __init__( self, fn, args, backend = "", size = 0 ):
+        """ takes the function to run and its arguments, the scheme of the backend it uses and its size in bytes or a function that returns it """
+        concurrent.futures.Future.__init__( self )
+        self.fn = fn
+        self.args = args
+        self.backend = backend
+        self.size = size
+        self.bytes = 0
+        self.traceback = None
+        self.queued_time = time.time()
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+    def wait_seconds( self ):
+        """ return how long the transfer waited before it started, 0.0 if it hasn't """
+        if not self.start_time:
+            return 0.0
+        return self.start_time - self.queued_time
+
+    def seconds( self ):
+        """ return how long the transfer ran, 0.0 if it hasn't finished """
+        if not self.end_time:
+            return 0.0
+        return self.end_time - self.start_time
+
+class AimdController:
+    """ additive increase multiplicative decrease control of the number of transfers that run at once, like tcp does for its window """
+    def __init__( self, threads, min_threads, max_threads ):
+        """ takes the number of threads to start with and the bounds to keep it in """
+        self.min_threads = max(1,min_threads)
+        self.max_threads = max(self.min_threads,max_threads)
+        self.threads = min(max(threads,self.min_threads),self.max_threads)
+        self.last_rate = None
+        self.history = [ (0.0, self.threads, "start") ]
+
+    def adjust( self, elapsed, completed, failed, nbytes, seconds, backlog ):
+        """ take what finished in the last window of seconds and whether work was waiting and return the number of threads to run, elapsed is the time since the start """
+        if completed + failed < adapt_min_samples or seconds <= 0.0:
+            return self.threads
+        # bytes per second unless nothing was moved, a dryrun for example, then transfers per second
+        rate = (nbytes if nbytes else completed) / seconds
+        threads = self.threads
+        reason = ""
+        if failed:
+            threads = int(threads * error_decrease)
+            reason = "errors"
+        elif self.last_rate != None and rate < self.last_rate * (1.0 - adapt_tolerance):
+            threads = int(threads * slowdown_decrease)
+            reason = "slower"
+        elif backlog:
+            threads = threads + 1
+            reason = "faster"
+        self.last_rate = rate
+        threads = min(max(threads,self.min_threads),self.max_threads)
+        if threads != self.threads:
+            self.threads = threads
+            self.history.append( (elapsed, threads, reason) )
+        return self.threads
+
+    def summary( self ):
+        """ return the changes in the number of threads as seconds:threads pairs """
+        return " ".join([ "%.0fs:%d"%(elapsed,threads) for elapsed, threads, reason in self.history ])
+
+def backend_limits( config ):
+    """ return a dictionary of scheme to the most transfers that may use that backend at once from the {scheme}_threads settings in a config """
+    limits = {}
+    for scheme in fs_mod.backend_classes:
+        key = scheme+"_threads"
+        if key in config and int(config[key]) > 0:
+            limits[scheme] = int(config[key])
+    return limits
+
+def make_engine( config, queue_size = 0, log = None ):
+    """ return a TransferEngine for a job's config, threads is the number of threads or the number to start with when adaptive_threads is on """
+    threads = int(config["threads"])
+    controller = None
+    if bkp_conf.get_flag(config,"adaptive_threads"):
+        controller = AimdController( threads, int(config.get("min_threads",1)), int(config.get("max_threads",threads*4)) )
+    return TransferEngine( threads, queue_size, backend_limits(config), controller, log )
+
+class TransferEngine:
+    """ runs transfers on a pool of threads and returns a TransferFuture for each one, the counts are kept under a lock so they are exact """
+    def __init__( self, threads, queue_size = 0, limits = {}, controller = None, log = None ):
+        """ takes the number of threads, the most transfers that can be waiting before submit blocks, 0 for no limit, a dictionary of scheme to the most transfers
+            that can use that backend at once, an optional AimdController that picks the number of threads as it goes and a function to log its changes with """
+        self.controller = controller
+        self.log = log
+        # with a controller workers are started and retired as it changes the number it picks, only the live ones take work off the queue so work
+        # left waiting on it means every live worker was busy
+        self.threads = controller.max_threads if controller else threads
+        self.active = controller.threads if controller else threads
+        self.live = 0
+        self.retiring = 0
+        self.workers_lock = threading.Lock()
+        self.adapter = None
+        self.stopping = threading.Event()
+        self.queue = WorkQueue(queue_size)
+        self.limits = dict(limits)
+        self.semaphores = dict([ (scheme,threading.BoundedSemaphore(limit)) for scheme, limit in self.limits.items() ])
+        self.workers = []
+        self.cancelling = False
+        self.counts_lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self.window = [ 0, 0, 0 ]
+        self.start_time = 0.0
+        self.end_time = 0.0
+
+    def start( self ):
+        """ start the worker threads, returns self """
+        self.start_time = time.time()
+        self.resize( self.active )
+        if self.controller:
+            self.adapter = fs_mod.thread( self.adapt )
+            self.adapter.start()
+        return self
+
+    def resize( self, active ):
+        """ start or retire worker threads so active of them are left, a busy worker retires when it is done with the transfer it is running """
+        with self.workers_lock:
+            self.active = active
+            more = active - (self.live - self.retiring)
+            if more < 0:
+                self.retiring -= more
+            else:
+                # workers that haven't retired yet are kept instead of starting new ones
+                unretire = min(self.retiring,more)
+                self.retiring -= unretire
+                for i in range(0,more - unretire):
+                    # the workers use the backends of the job that started the engine
+                    t = fs_mod.thread( self.worker )
+                    t.start()
+                    self.workers.append(t)
+                    self.live += 1
+        if more < 0:
+            # idle workers are blocked on the queue, wake them to retire now
+            self.queue.wake()
+
+    def submit( self, fn, *args, backend = "", size = 0, callback = None ):
+        """ queue fn(*args) to run on a worker thread and return its TransferFuture, backend is the scheme of the file system it uses, size is its byte count
+            or a function called once it succeeds that returns it, callback is called with the future when it is done, blocks while the queue is full """
+        future = TransferFuture( fn, args, backend, size )
+        if callback:
+            future.add_done_callback( callback )
+        with self.counts_lock:
+            self.submitted += 1
+        if not self.cancelling:
+            try:
+                self.queue.put( future )
+                return future
+            except Closed:
+                pass
+        # the engine was cancelled or joined, maybe while we waited on a full queue, so nothing would ever run it
+        self.finish_cancelled( future )
+        return future
+
+    def worker( self ):
+        """ thread body for the worker threads, runs transfers until the queue is closed and empty or the worker is retired """
+        while True:
+            try:
+                future = self.queue.get( stop = self.retire )
+            except Stopped:
+                break
+            except Closed:
+                with self.workers_lock:
+                    self.live -= 1
+                break
+            if self.cancelling:
+                self.finish_cancelled( future )
+            else:
+                self.run( future )
+        fs_mod.release_thread()
+
+    def retire( self ):
+        """ return True and count the calling worker as gone if there are workers to retire """
+        with self.workers_lock:
+            if not self.retiring:
+                return False
+            self.retiring -= 1
+            self.live -= 1
+            return True
+
+    def finish_cancelled( self, future ):
+        """ cancel a future that won't be run """
+        future.cancel()
+        future.set_running_or_notify_cancel()
+        with self.counts_lock:
+            self.cancelled += 1
+
+    def run( self, future ):
+        """ run one transfer and complete its future """
+        if not future.set_running_or_notify_cancel():
+            with self.counts_lock:
+                self.cancelled += 1
+            return
+        # a worker waits here when its backend already has as many transfers running as it is allowed
+        semaphore = self.semaphores.get(future.backend)
+        if semaphore:
+            semaphore.acquire()
+        future.start_time = time.time()
+        try:
+            result = future.fn( *future.args )
+            future.bytes = future.size() if callable(future.size) else future.size
+        except Exception as e:
+            future.end_time = time.time()
+            future.traceback = traceback.format_exc()
+            if semaphore:
+                semaphore.release()
+            with self.counts_lock:
+                self.failed += 1
+                self.window[1] += 1
+                self.busy_seconds += future.seconds()
+            future.set_exception( e )
+            return
+        future.end_time = time.time()
+        if semaphore:
+            semaphore.release()
+        with self.counts_lock:
+            self.completed += 1
+            self.bytes += future.bytes
+            self.window[0] += 1
+            self.window[2] += future.bytes
+            self.busy_seconds += future.seconds()
+        future.set_result( result )
+
+    def adapt( self ):
+        """ thread body for the controller thread, every adapt_seconds it gives the controller the last window and lets the number of threads it picks run """
+        last = time.time()
+        while not self.stopping.wait(adapt_seconds):
+            now = time.time()
+            with self.counts_lock:
+                completed, failed, nbytes = self.window
+                self.window = [ 0, 0, 0 ]
+            active = self.controller.adjust( now - self.start_time, completed, failed, nbytes, now - last, not self.queue.empty() )
+            last = now
+            if active != self.active:
+                if self.log:
+                    self.log( "transfer threads %d -> %d %s at %.1f %s per second"%(self.active, active, self.controller.history[-1][2], self.controller.last_rate, "bytes" if nbytes else "transfers") )
+                self.resize( active )
+
+    def cancel( self ):
+        """ cancel every transfer that hasn't started, the workers exit as soon as the running ones finish, use join to wait for them """
+        self.cancelling = True
+        self.queue.close()
+
+    def join( self ):
+        """ wait for every submitted transfer to be done and the workers to exit, nothing more can be submitted after this """
+        self.queue.close()
+        # the controller can still start workers while the queue drains
+        self.join_workers()
+        self.stopping.set()
+        if self.adapter:
+            self.adapter.join()
+            self.adapter = None
+        self.join_workers()
+        if not self.end_time:
+            self.end_time = time.time()
+
+    def join_workers( self ):
+        """ wait for the worker threads to exit including any started while waiting """
+        while True:
+            with self.workers_lock:
+                workers = [ t for t in self.workers if t.is_alive() ]
+                self.workers = workers
+            if not workers:
+                return
+            for t in workers:
+                t.join()
+
+    def pending( self ):
+        """ return the number of transfers that are queued or running """
+        with self.counts_lock:
+            return self.submitted - self.completed - self.failed - self.cancelled
+
+    def record_stats( self, stats ):
+        """ record the transfer counts and timings in a job's JobStats """
+        with self.counts_lock:
+            stats.set("transfers_completed", self.completed)
+            stats.set("transfers_failed", self.failed)
+            if self.cancelled:
+                stats.set("transfers_cancelled", self.cancelled)
+            stats.set("transfer_bytes", self.bytes)
+            stats.set("transfer_busy_seconds", self.busy_seconds)
+            elapsed = (self.end_time or time.time()) - self.start_time
+            if self.start_time and elapsed > 0.0:
+                stats.set("transfer_mb_per_sec", self.bytes / (1024.0*1024.0) / elapsed)
+        if self.controller:
+            used = [ threads for elapsed, threads, reason in self.controller.history ]
+            stats.set("threads_min_used", min(used))
+            stats.set("threads_max_used", max(used))
+            stats.set("threads_final", self.controller.threads)
+            stats.set("concurrency_history", self.controller.summary())
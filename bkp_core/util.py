@@ -61,12 +61,15 @@ def mail_error( error, log_file=None, verbose = False, get_config=lambda: {} ):
     return mail_log( error, log_file, True, verbose, get_config=get_config )
 
 def mail_log( log, log_file=None, is_error = False, verbose = False, get_config=lambda: {} ):
-    """ e-mail a log file to the log e-mail account """
+    """ e-mail a log file to the log e-mail account, if both log and log_file are given log is sent ahead of the log file """
     tries = 3
     log_text = ""
     while tries:
         try:
-            if log != None:
+            if log != None and log_file != None:
+                log_text = re.sub("^smtp_.*$|^ssh_.*$","",log_file.read(),flags=re.M)
+                msg = MIMEText(log+"\n"+log_text[:2*pow(2,20)])
+            elif log != None:
                 msg = MIMEText(log)
             elif log_file != None:
                 log_text = re.sub("^smtp_.*$|^ssh_.*$","",log_file.read(),flags=re.M)
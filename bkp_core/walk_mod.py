@@ -0,0 +1,99 @@
+# Copyright 2013-2014 James P Goodwin bkp@jlgoodwin.com
+""" module to implement a parallel directory tree walker built on os.scandir for the bkp tool """
+import os
+import sys
+import time
+import queue
+import threading
+
+class TreeWalker:
+    """ walk directory trees with a pool of threads calling process_dir( dirpath, dirs, files ) for each directory, dirs and files are lists of os.DirEntry and entries removed from dirs are not descended into like os.walk """
+    def __init__( self, num_threads = 1 ):
+        """ constructor takes the number of threads to scan directories with """
+        self.num_threads = max(1,num_threads)
+        self.dirs_scanned = 0
+        self.files_scanned = 0
+        self.scan_time = 0.0
+        self.counts_lock = threading.Lock()
+
+    def scan_dir( self, dirpath, process_dir ):
+        """ scan one directory, call process_dir with its entries and return the paths of the subdirectories to descend into """
+        try:
+            with os.scandir(dirpath) as it:
+                entries = [e for e in it]
+        except OSError:
+            # like os.walk we skip directories we can't read
+            return []
+
+        dirs = []
+        files = []
+        for e in entries:
+            try:
+                is_dir = e.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append(e)
+            else:
+                files.append(e)
+
+        process_dir( dirpath, dirs, files )
+
+        with self.counts_lock:
+            self.dirs_scanned += 1
+            self.files_scanned += len(files)
+
+        # don't follow links to directories
+        return [d.path for d in dirs if not d.is_symlink()]
+
+    def walk( self, path, process_dir ):
+        """ walk the tree rooted at path calling process_dir for every directory, returns when the whole tree has been processed """
+        start_time = time.time()
+        try:
+            if self.num_threads == 1:
+                dirs = [path]
+                while dirs:
+                    dirs.extend(reversed(self.scan_dir( dirs.pop(), process_dir )))
+                return
+
+            dir_queue = queue.Queue()
+            errors = []
+
+            def scan_worker():
+                """ thread body that scans directories off of the queue until it gets a None """
+                while True:
+                    dirpath = dir_queue.get()
+                    try:
+                        if dirpath == None:
+                            return
+                        if not errors:
+                            for d in self.scan_dir( dirpath, process_dir ):
+                                dir_queue.put(d)
+                    except:
+                        errors.append(sys.exc_info()[1])
+                    finally:
+                        dir_queue.task_done()
+
+            scan_threads = []
+            for i in range(self.num_threads):
+                t = threading.Thread(target=scan_worker)
+                t.start()
+                scan_threads.append(t)
+
+            dir_queue.put(path)
+            dir_queue.join()
+            for t in scan_threads:
+                dir_queue.put(None)
+            for t in scan_threads:
+                t.join()
+
+            if errors:
+                raise errors[0]
+        finally:
+            self.scan_time += time.time() - start_time
+
+    def scan_rate( self ):
+        """ return the rate in files per second that files have been scanned at """
+        if self.scan_time > 0.0:
+            return self.files_scanned / self.scan_time
+        return 0.0
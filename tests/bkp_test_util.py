@@ -1,7 +1,20 @@
 from bkp_core import fs_mod
+from bkp_core import s3_mod
 import pytest
 import os
 import shutil
+import re
+import socket
+import time
+import email.utils
+import hashlib
+import base64
+import threading
+import http.server
+import urllib.parse
+import xml.sax.saxutils
+import paramiko
+import subprocess
 
 @pytest.fixture(scope="function")
 def fs_testdir(request,testdir):
@@ -175,3 +188,376 @@ def sync_testdir(request,testdir):
             "remote_files" : remote_file_names,
             "remote_files_stats" : remote_files_stats,
             "testdir" : testdir }
+
+class S3StubHandler(http.server.BaseHTTPRequestHandler):
+    """ minimal path style s3 stand in that keeps objects in memory """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        return
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+        with self.server.stub_lock:
+            self.server.connections += 1
+
+    def split_path(self):
+        parsed = urllib.parse.urlparse(self.path)
+        parts = urllib.parse.unquote(parsed.path).lstrip("/").split("/",1)
+        return (parts[0], parts[1] if len(parts) > 1 else "", urllib.parse.parse_qs(parsed.query,keep_blank_values=True))
+
+    def reply(self, status, body = b"", headers = {}):
+        self.send_response(status)
+        for k,v in headers.items():
+            self.send_header(k,v)
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def object_headers(self, obj):
+        headers = { "Last-Modified" : email.utils.formatdate(obj["time"],usegmt=True), "ETag" : '"%s"'%hashlib.md5(obj["data"]).hexdigest() }
+        if obj["attrs"]:
+            headers["x-amz-meta-s3cmd-attrs"] = obj["attrs"]
+        return headers
+
+    def do_PUT(self):
+        bucket, key, query = self.split_path()
+        assert self.headers.get("Authorization","").startswith("AWS4-HMAC-SHA256")
+        data = self.rfile.read(int(self.headers.get("Content-Length","0")))
+        if "uploadId" in query:
+            upload = self.server.uploads.get(query["uploadId"][0])
+            if not upload:
+                self.reply(404)
+                return
+            if self.server.fail_parts:
+                self.server.fail_parts -= 1
+                self.reply(500)
+                return
+            upload["parts"][int(query["partNumber"][0])] = data
+            self.server.part_puts += 1
+            self.reply(200,b"",{ "ETag" : '"%s"'%hashlib.md5(data).hexdigest() })
+            return
+        if self.headers.get("x-amz-copy-source"):
+            src = urllib.parse.unquote(self.headers["x-amz-copy-source"]).lstrip("/").split("/",1)
+            obj = dict(self.server.objects[(src[0],src[1])])
+        else:
+            obj = { "data" : data, "attrs" : self.headers.get("x-amz-meta-s3cmd-attrs") }
+        obj["time"] = time.time()
+        self.server.objects[(bucket,key)] = obj
+        self.reply(200)
+
+    def list_objects(self, bucket, query):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        prefix = query.get("prefix",[""])[0]
+        delimiter = query.get("delimiter",[""])[0]
+        token = query.get("continuation-token",[""])[0]
+        # each item is an object key or a common prefix, the token is the last item of the page before
+        items = []
+        for (b,k),obj in sorted(self.server.objects.items()):
+            if b != bucket or not k.startswith(prefix):
+                continue
+            if delimiter and delimiter in k[len(prefix):]:
+                item = (prefix+k[len(prefix):].split(delimiter)[0]+delimiter,None)
+            else:
+                item = (k,obj)
+            if item[0] > token and (not items or items[-1][0] != item[0]):
+                items.append(item)
+        page = items[:self.server.page_size]
+        body = "<ListBucketResult><IsTruncated>%s</IsTruncated>"%("true" if len(items) > len(page) else "false")
+        if len(items) > len(page):
+            body += "<NextContinuationToken>%s</NextContinuationToken>"%xml.sax.saxutils.escape(page[-1][0])
+        for k,obj in page:
+            if obj:
+                body += "<Contents><Key>%s</Key><Size>%d</Size><LastModified>%s</LastModified></Contents>"%(xml.sax.saxutils.escape(k),len(obj["data"]),time.strftime("%Y-%m-%dT%H:%M:%S.000Z",time.gmtime(obj["time"])))
+            else:
+                body += "<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>"%xml.sax.saxutils.escape(k)
+        body += "</ListBucketResult>"
+        self.reply(200,body.encode("utf-8"))
+
+    def do_GET(self):
+        bucket, key, query = self.split_path()
+        if not key and "list-type" in query:
+            with self.server.stub_lock:
+                self.server.lists += 1
+                self.server.lists_running += 1
+                self.server.lists_peak = max(self.server.lists_peak,self.server.lists_running)
+            try:
+                self.list_objects(bucket, query)
+            finally:
+                with self.server.stub_lock:
+                    self.server.lists_running -= 1
+            return
+        if "uploadId" in query:
+            upload = self.server.uploads.get(query["uploadId"][0])
+            if not upload:
+                self.reply(404)
+                return
+            parts = "".join(["<Part><PartNumber>%d</PartNumber><ETag>\"%s\"</ETag></Part>"%(n,hashlib.md5(d).hexdigest()) for n,d in sorted(upload["parts"].items())])
+            self.reply(200,("<ListPartsResult><IsTruncated>false</IsTruncated>%s</ListPartsResult>"%parts).encode("utf-8"))
+            return
+        obj = self.server.objects.get((bucket,key))
+        if not obj:
+            self.reply(404)
+            return
+        data = obj["data"]
+        if self.headers.get("Range"):
+            start, end = self.headers["Range"][6:].split("-")
+            if int(start) >= len(data):
+                self.reply(416)
+                return
+            headers = self.object_headers(obj)
+            headers["Content-Range"] = "bytes %d-%d/%d"%(int(start),min(int(end),len(data)-1),len(data))
+            self.server.range_gets += 1
+            self.reply(206,data[int(start):int(end)+1],headers)
+        else:
+            self.reply(200,data,self.object_headers(obj))
+
+    def do_HEAD(self):
+        bucket, key, query = self.split_path()
+        self.server.heads += 1
+        if not key:
+            self.reply(200)
+            return
+        obj = self.server.objects.get((bucket,key))
+        if not obj:
+            self.reply(404)
+            return
+        headers = self.object_headers(obj)
+        self.send_response(200)
+        for k,v in headers.items():
+            self.send_header(k,v)
+        self.send_header("Content-Length",str(len(obj["data"])))
+        self.end_headers()
+
+    def do_POST(self):
+        bucket, key, query = self.split_path()
+        data = self.rfile.read(int(self.headers.get("Content-Length","0")))
+        if "delete" in query:
+            assert self.headers.get("Content-MD5") == base64.b64encode(hashlib.md5(data).digest()).decode("ascii")
+            keys = [ xml.sax.saxutils.unescape(k) for k in re.findall(r"<Key>(.*?)</Key>",data.decode("utf-8")) ]
+            assert len(keys) <= 1000
+            with self.server.stub_lock:
+                self.server.batch_deletes += 1
+            for k in keys:
+                self.server.objects.pop((bucket,k),None)
+            self.reply(200,b"<DeleteResult></DeleteResult>")
+            return
+        if "uploads" in query:
+            upload_id = "upload%d"%len(self.server.uploads)
+            self.server.uploads[upload_id] = { "attrs" : self.headers.get("x-amz-meta-s3cmd-attrs"), "parts" : {} }
+            self.reply(200,("<InitiateMultipartUploadResult><UploadId>%s</UploadId></InitiateMultipartUploadResult>"%upload_id).encode("utf-8"))
+            return
+        upload = self.server.uploads.pop(query["uploadId"][0])
+        numbers = [ int(n) for n in re.findall(r"<PartNumber>(\d+)</PartNumber>",data.decode("utf-8")) ]
+        self.server.objects[(bucket,key)] = { "data" : b"".join([ upload["parts"][n] for n in numbers ]), "attrs" : upload["attrs"], "time" : time.time() }
+        self.reply(200,b"<CompleteMultipartUploadResult></CompleteMultipartUploadResult>")
+
+    def do_DELETE(self):
+        bucket, key, query = self.split_path()
+        if "uploadId" in query:
+            self.server.uploads.pop(query["uploadId"][0],None)
+            self.reply(204)
+            return
+        with self.server.stub_lock:
+            self.server.deletes += 1
+        self.server.objects.pop((bucket,key),None)
+        self.reply(204)
+
+@pytest.fixture(scope="function")
+def s3_stub(request,testdir):
+    """ run an s3 stand in on localhost and point ~/.s3cfg at it """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1",0),S3StubHandler)
+    server.daemon_threads = True
+    server.objects = {}
+    server.uploads = {}
+    server.connections = 0
+    server.part_puts = 0
+    server.range_gets = 0
+    server.fail_parts = 0
+    server.heads = 0
+    server.lists = 0
+    server.lists_running = 0
+    server.lists_peak = 0
+    server.deletes = 0
+    server.batch_deletes = 0
+    server.latency = 0
+    server.page_size = 1000
+    server.stub_lock = threading.Lock()
+    host = "127.0.0.1:%d"%server.server_address[1]
+    with open(os.path.join(str(testdir.tmpdir),".s3cfg"),"w") as cfg:
+        cfg.write("[default]\naccess_key = stub\nsecret_key = stub\nhost_base = %s\nhost_bucket = %s\nuse_https = False\n"%(host,host))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    def stop_s3_stub():
+        fs_mod.close_backends()
+        s3_mod.close_clients()
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    request.addfinalizer(stop_s3_stub)
+
+    return server
+
+class SshStubServer(paramiko.ServerInterface):
+    """ ssh server side that takes the password stub and runs exec requests locally if they are allowed """
+    def __init__(self, stub):
+        self.stub = stub
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL if password == "stub" else paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if not self.stub.allow_exec:
+            return False
+        with self.stub.stub_lock:
+            self.stub.execs += 1
+        def run():
+            result = subprocess.run(command.decode("utf-8"),shell=True,stdout=subprocess.PIPE)
+            channel.sendall(result.stdout)
+            channel.send_exit_status(result.returncode)
+            channel.close()
+        threading.Thread(target=run,daemon=True).start()
+        return True
+
+class SftpStubHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+class SftpStub(paramiko.SFTPServerInterface):
+    """ sftp stand in that serves the local file system and counts the requests it gets """
+    def __init__(self, server, stub, *args, **kwargs):
+        paramiko.SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.stub = stub
+
+    def session_started(self):
+        with self.stub.stub_lock:
+            self.stub.channels += 1
+
+    def count(self, op):
+        if self.stub.latency:
+            time.sleep(self.stub.latency)
+        with self.stub.stub_lock:
+            self.stub.ops[op] = self.stub.ops.get(op,0) + 1
+
+    def call(self, op, f):
+        self.count(op)
+        try:
+            return f()
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path):
+        def list_folder():
+            entries = []
+            for name in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path,name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        return self.call("list_folder",list_folder)
+
+    def stat(self, path):
+        return self.call("stat",lambda: paramiko.SFTPAttributes.from_stat(os.stat(path)))
+
+    def lstat(self, path):
+        return self.call("lstat",lambda: paramiko.SFTPAttributes.from_stat(os.lstat(path)))
+
+    def open(self, path, flags, attr):
+        def open_file():
+            fd = os.open(path,flags,0o644)
+            if flags & (os.O_WRONLY|os.O_RDWR):
+                mode = "ab" if flags & os.O_APPEND else ("r+b" if flags & os.O_RDWR else "wb")
+            else:
+                mode = "rb"
+            f = os.fdopen(fd,mode)
+            handle = SftpStubHandle(flags)
+            handle.filename = path
+            handle.readfile = f
+            handle.writefile = f
+            return handle
+        return self.call("open",open_file)
+
+    def remove(self, path):
+        return self.call("remove",lambda: os.remove(path) or paramiko.SFTP_OK)
+
+    def rename(self, oldpath, newpath):
+        return self.call("rename",lambda: os.rename(oldpath,newpath) or paramiko.SFTP_OK)
+
+    def mkdir(self, path, attr):
+        return self.call("mkdir",lambda: os.mkdir(path) or paramiko.SFTP_OK)
+
+    def rmdir(self, path):
+        return self.call("rmdir",lambda: os.rmdir(path) or paramiko.SFTP_OK)
+
+    def chattr(self, path, attr):
+        def chattr():
+            if attr.st_atime != None and attr.st_mtime != None:
+                os.utime(path,(attr.st_atime,attr.st_mtime))
+            return paramiko.SFTP_OK
+        return self.call("chattr",chattr)
+
+@pytest.fixture(scope="function")
+def ssh_stub(request,testdir):
+    """ run an ssh server with an sftp stand in on localhost, the remote paths are the local paths """
+    listener = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+    listener.bind(("127.0.0.1",0))
+    listener.listen(16)
+    stub = type("SshStub",(),{})()
+    stub.host_key = paramiko.ECDSAKey.generate()
+    stub.transports = []
+    stub.connections = 0
+    stub.channels = 0
+    stub.ops = {}
+    stub.latency = 0
+    stub.allow_exec = False
+    stub.execs = 0
+    stub.stub_lock = threading.Lock()
+    stub.base = "ssh://127.0.0.1:%d"%listener.getsockname()[1]
+    stub.config = { "ssh_username" : "stub", "ssh_password" : "stub" }
+
+    def serve():
+        while True:
+            try:
+                sock, addr = listener.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+            t = paramiko.Transport(sock)
+            t.add_server_key(stub.host_key)
+            t.set_subsystem_handler("sftp",paramiko.SFTPServer,SftpStub,stub)
+            with stub.stub_lock:
+                stub.connections += 1
+                stub.transports.append(t)
+            t.start_server(server=SshStubServer(stub))
+    thread = threading.Thread(target=serve,daemon=True)
+    thread.start()
+
+    def stop_ssh_stub():
+        fs_mod.close_backends()
+        try:
+            listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        listener.close()
+        for t in stub.transports:
+            t.close()
+        thread.join()
+
+    request.addfinalizer(stop_ssh_stub)
+
+    return stub
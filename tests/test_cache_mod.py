@@ -0,0 +1,57 @@
+from bkp_core import cache_mod
+from bkp_core import manifest_mod
+from bkp_core import bkp_mod
+import os
+import time
+
+def test_cache_mod_catalog_cache(testdir):
+    """ test suite for the CatalogCache covering get, put, prune and least recently used eviction """
+    cache = cache_mod.CatalogCache(1024*1024, str(testdir.tmpdir.join("cache")))
+    records = [ ("/home/f%d.txt"%i, "file:///bucket/f%d.txt"%i, "transferred", "na", 1.0*i, i, "") for i in range(100) ]
+
+    assert(cache.get("file:///bucket/bkp/machine", "2020.01.01.00.00.00") == None)
+    cache.put("file:///bucket/bkp/machine", "2020.01.01.00.00.00", records)
+    cache.put("file:///bucket/bkp/machine", "2020.01.02.00.00.00", records[:10])
+    assert(cache.get("file:///bucket/bkp/machine", "2020.01.01.00.00.00") == sorted(records))
+    assert(cache.get("file:///bucket/bkp/other", "2020.01.01.00.00.00") == None)
+
+    cache.prune("file:///bucket/bkp/machine", ["2020.01.02.00.00.00"])
+    assert(cache.get("file:///bucket/bkp/machine", "2020.01.01.00.00.00") == None)
+    assert(cache.get("file:///bucket/bkp/machine", "2020.01.02.00.00.00") == sorted(records[:10]))
+
+    size = os.path.getsize(cache.cache_file("file:///bucket/bkp/machine", "2020.01.02.00.00.00"))
+    small = cache_mod.CatalogCache(size*3, str(testdir.tmpdir.join("small")))
+    for i in range(3):
+        small.put("m", "t%d"%i, records[:10])
+        os.utime(small.cache_file("m","t%d"%i), (time.time()-100+i,time.time()-100+i))
+    assert(small.get("m","t0") != None)
+    small.put("m", "t3", records[:10])
+    assert(small.get("m","t1") == None)
+    assert(small.get("m","t0") != None)
+    assert(small.get("m","t3") != None)
+
+def test_cache_mod_backup_entries(testdir):
+    """ test that the file list of a finished backup is only fetched from the remote once """
+    machine_path = "file://"+str(testdir.tmpdir)+"/bucket/bkp/machine"
+    config = { "bucket": "file://"+str(testdir.tmpdir)+"/bucket" }
+    records = [ ("/home/a.txt", machine_path+"/2020.01.01.00.00.00/home/a.txt", "transferred", "na", 1.0, 2, "") ]
+    manifest_mod.put_manifest(machine_path, "2020.01.01.00.00.00", records)
+
+    fetched = []
+    get_manifest = manifest_mod.get_manifest
+    def counting_get_manifest( *args, **kwargs ):
+        fetched.append(args[1])
+        return get_manifest( *args, **kwargs )
+    manifest_mod.get_manifest = counting_get_manifest
+    try:
+        backups = bkp_mod.get_backups(machine_path, config)
+        assert([ b.timestamp for b in backups ] == ["2020.01.01.00.00.00"])
+        for i in range(2):
+            assert([ r for r in bkp_mod.get_backup_entries(backups[0], machine_path, config) ] == records)
+        assert(fetched == ["2020.01.01.00.00.00"])
+
+        config["cache_size"] = "0"
+        assert([ r for r in bkp_mod.get_backup_entries(backups[0], machine_path, config) ] == records)
+        assert(len(fetched) == 2)
+    finally:
+        manifest_mod.get_manifest = get_manifest
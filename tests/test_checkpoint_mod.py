@@ -0,0 +1,56 @@
+import os
+from bkp_test_util import s3_stub
+from bkp_core import checkpoint_mod
+from bkp_core import fs_mod
+from bkp_core import util
+
+def grow_log( local_log, start, count ):
+    """ add count lines to a local log """
+    with open(local_log,"a") as f:
+        for i in range(start,start+count):
+            print("/home/file_%d.txt;remote_%d;transferred;na"%(i,i), file=f)
+
+def check_checkpoints( local_log, remote_log ):
+    """ checkpoint a growing log and check that only the new part is sent each time, returns the checkpointer """
+    fs = fs_mod.get_backend(remote_log)
+    checkpointer = checkpoint_mod.LogCheckpointer(fs,local_log,remote_log)
+    sent = 0
+    for i in range(0,4):
+        grow_log( local_log, i*100, 100 )
+        checkpointer.checkpoint()
+        assert(checkpointer.bytes_sent == os.path.getsize(local_log))
+    checkpointer.checkpoint()
+    assert(checkpointer.bytes_sent == os.path.getsize(local_log))
+
+    # a restarted backup picks up where the checkpoints left off
+    restarted = checkpoint_mod.LogCheckpointer(fs,local_log,remote_log).resume()
+    assert(restarted.offset == os.path.getsize(local_log))
+    grow_log( local_log, 400, 50 )
+    restarted.checkpoint()
+    assert(restarted.bytes_sent == os.path.getsize(local_log) - checkpointer.offset)
+    return restarted
+
+def test_checkpoint_mod_append(testdir):
+    """ test checkpoints that append to the remote log """
+    local_log = os.path.join(str(testdir.tmpdir),"bkp.2020.01.01.00.00.00.log")
+    remote_dir = "file://"+str(testdir.tmpdir)+"/bucket/bkp"
+    remote_log = remote_dir+"/bkp.2020.01.01.00.00.00.log"
+    checkpointer = check_checkpoints( local_log, remote_log )
+    assert(util.get_contents(remote_dir,"bkp.2020.01.01.00.00.00.log") == open(local_log).read())
+    grow_log( local_log, 450, 10 )
+    checkpointer.finish()
+    assert(util.get_contents(remote_dir,"bkp.2020.01.01.00.00.00.log") == open(local_log).read())
+    assert(checkpoint_mod.segment_paths(remote_log) == [])
+
+def test_checkpoint_mod_segments(s3_stub,testdir):
+    """ test checkpoints that are numbered segments on a backend that can't append """
+    local_log = os.path.join(str(testdir.tmpdir),"bkp.2020.01.01.00.00.00.log")
+    remote_log = "s3://bucket/bkp/m/2020.01.01.00.00.00/bkp/bkp.2020.01.01.00.00.00.log"
+    checkpointer = check_checkpoints( local_log, remote_log )
+    assert([ s[0] for s in checkpoint_mod.segment_paths(remote_log) ] == [0,1,2,3,4])
+    assert(fs_mod.fs_stat(remote_log) == (-1,-1))
+    assert(checkpoint_mod.get_segments(remote_log) == open(local_log).read())
+    grow_log( local_log, 450, 10 )
+    checkpointer.finish()
+    assert(checkpoint_mod.segment_paths(remote_log) == [])
+    assert(util.get_contents("s3://bucket/bkp/m/2020.01.01.00.00.00/bkp","bkp.2020.01.01.00.00.00.log") == open(local_log).read())
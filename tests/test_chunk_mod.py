@@ -0,0 +1,85 @@
+from bkp_core import chunk_mod
+from bkp_core.stats_mod import JobStats
+import hashlib
+import random
+import io
+
+def make_content( seed, size ):
+    """ return size bytes of pseudo random lines of text """
+    r = random.Random(seed)
+    lines = []
+    total = 0
+    while total < size:
+        l = ("%x "%r.getrandbits(256))*r.randint(1,4)+"\n"
+        lines.append(l)
+        total += len(l)
+    return "".join(lines).encode()
+
+def test_chunk_mod_boundaries():
+    """ test that chunks are bounded and that an insert only changes the chunks around it """
+    content = make_content(1, 6*1024*1024)
+    chunks = list(chunk_mod.chunks(io.BytesIO(content)))
+    assert(b"".join(chunks) == content)
+    assert(len(chunks) > 2)
+    for c in chunks[:-1]:
+        assert(chunk_mod.min_chunk_size <= len(c) <= chunk_mod.max_chunk_size)
+
+    edited = content[:1000] + b"an inserted line\n" + content[1000:]
+    edited_chunks = list(chunk_mod.chunks(io.BytesIO(edited)))
+    assert(b"".join(edited_chunks) == edited)
+    assert(edited_chunks[1:] == chunks[1:])
+
+    assert(list(chunk_mod.chunks(io.BytesIO(b""))) == [])
+    assert(list(chunk_mod.chunks(io.BytesIO(b"small"))) == [b"small"])
+    # the hash of a run of one byte never changes and never has a boundary so the chunks are cut at the max
+    uniform = b"x" * (chunk_mod.max_chunk_size + 10)
+    assert([len(c) for c in chunk_mod.chunks(io.BytesIO(uniform))] == [chunk_mod.max_chunk_size, 10])
+
+    # binary data without any line breaks is cut at content defined boundaries too
+    r = random.Random(3)
+    binary = bytes(r.getrandbits(8) for i in range(0,6*1024*1024)).replace(b"\n",b"")
+    chunks = list(chunk_mod.chunks(io.BytesIO(binary)))
+    assert(b"".join(chunks) == binary)
+    assert(len(chunks) > 2)
+    assert(all([ len(c) < chunk_mod.max_chunk_size for c in chunks ]))
+    edited = binary[:1000] + b"\x00\x01\x02" + binary[1000:]
+    assert(list(chunk_mod.chunks(io.BytesIO(edited)))[1:] == chunks[1:])
+
+def test_chunk_mod_scan(monkeypatch):
+    """ test that the numpy scan cuts at the same boundaries as the byte at a time one, across scan blocks and where there is no boundary """
+    content = make_content(2, 3*1024*1024) + random.Random(3).getrandbits(8*1024*1024).to_bytes(1024*1024,"big")
+    chunks = [ len(c) for c in chunk_mod.chunks(io.BytesIO(content)) ]
+    if chunk_mod.numpy:
+        view = memoryview(content)
+        ranges = [ (0, 100), (10, 70000), (chunk_mod.min_chunk_size, len(content)), (len(content)-300000, len(content)) ]
+        cuts = [ chunk_mod.find_boundary_python( view, start, end ) for start, end in ranges ]
+        assert(-1 in cuts and any([ cut > chunk_mod.min_chunk_size + chunk_mod.scan_size for cut in cuts ]))
+        assert([ chunk_mod.find_boundary_numpy( view, start, end ) for start, end in ranges ] == cuts)
+    monkeypatch.setattr(chunk_mod,"numpy",None)
+    assert([ len(c) for c in chunk_mod.chunks(io.BytesIO(content)) ] == chunks)
+
+def test_chunk_mod_put_get(testdir):
+    """ test storing a file as chunks in a file:// bucket and reassembling it """
+    bucket = "file://"+str(testdir.tmpdir.mkdir("bucket"))
+    content = make_content(2, 3*1024*1024)
+    f = testdir.tmpdir.join("big.txt")
+    f.write_binary(content)
+
+    stats = JobStats()
+    digest = chunk_mod.put_chunked(str(f), bucket+"/bkp/big.txt.chunks", bucket, stats=stats)
+    assert(digest == hashlib.sha256(content).hexdigest())
+    assert(stats.get("chunks") > 1)
+    assert(stats.get("chunks_stored") == stats.get("chunks"))
+    assert(stats.get("chunk_bytes_stored") == len(content))
+
+    f.write_binary(content + b"appended line\n")
+    stats = JobStats()
+    chunk_mod.put_chunked(str(f), bucket+"/bkp/big.txt.2.chunks", bucket, stats=stats)
+    assert(stats.get("chunks_stored") == 1)
+
+    restored = str(testdir.tmpdir.join("restored","big.txt"))
+    chunk_mod.get_chunked(bucket+"/bkp/big.txt.2.chunks", restored, bucket)
+    assert(open(restored,"rb").read() == content + b"appended line\n")
+
+    assert(chunk_mod.chunk_path(bucket, digest) == bucket+"/chunks/"+digest[:2]+"/"+digest)
+    assert(chunk_mod.chunk_path(bucket, digest).startswith(chunk_mod.chunks_prefix(bucket)))
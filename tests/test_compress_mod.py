@@ -0,0 +1,67 @@
+from bkp_core import compress_mod
+from bkp_core import fs_mod
+import os
+
+def test_compress_mod(testdir):
+    """ test suite for compressing files before they are stored and decompressing them when they are fetched """
+    text = b"a line of very compressible text in a file\n" * 10000
+    f = testdir.tmpdir.join("text.txt")
+    f.write_binary(text)
+    rnd = testdir.tmpdir.join("random.dat")
+    rnd.write_binary(os.urandom(200000))
+    jpg = testdir.tmpdir.join("photo.jpg")
+    jpg.write_binary(text)
+    small = testdir.tmpdir.join("small.txt")
+    small.write_binary(b"tiny")
+    marked = testdir.tmpdir.join("marked.bin")
+    marked.write_binary(compress_mod.magic + b"g" + b"not really compressed")
+
+    assert(compress_mod.should_compress(str(f)))
+    assert(not compress_mod.should_compress(str(rnd)))
+    assert(not compress_mod.should_compress(str(jpg)))
+    assert(not compress_mod.should_compress(str(small)))
+    assert(not compress_mod.should_compress(str(marked)))
+    assert(compress_mod.logged_codec("compressed=gzip") == "gzip")
+    assert(compress_mod.logged_codec("12,34,compressed=zstd") == "zstd")
+    assert(compress_mod.logged_codec("sha256=abc") == None)
+    assert(compress_mod.entropy(b"aaaa") == 0.0)
+    assert(compress_mod.get_codec("False") == None)
+    assert(compress_mod.get_codec("gzip") == "gzip")
+    assert(compress_mod.get_codec("zstd") == ("zstd" if compress_mod.zstd_available() else "gzip"))
+
+    bucket = testdir.tmpdir.mkdir("bucket")
+    for codec in [ "gzip", compress_mod.get_codec("zstd") ]:
+        for source in [ f, marked ]:
+            t_file_name = compress_mod.compress_file(str(source), codec)
+            try:
+                assert(compress_mod.is_compressed(t_file_name) == codec)
+                fs_mod.fs_put(t_file_name, "file://"+str(bucket)+"/"+source.basename)
+            finally:
+                os.remove(t_file_name)
+            if source == f:
+                assert(os.path.getsize(str(bucket.join(source.basename))) < len(text)/10)
+            restored = str(testdir.tmpdir.join("restored",codec,source.basename))
+            fs_mod.fs_get("file://"+str(bucket)+"/"+source.basename, restored, codec=codec)
+            assert(open(restored,"rb").read() == source.read_binary())
+            # without the codec from the log the file comes back exactly as it was stored
+            fs_mod.fs_get("file://"+str(bucket)+"/"+source.basename, restored)
+            assert(open(restored,"rb").read() == open(str(bucket.join(source.basename)),"rb").read())
+
+    # a user file that starts with the marker is stored and fetched as is
+    compressed = compress_mod.compress_file(str(f), "gzip")
+    try:
+        fs_mod.fs_put(compressed, "file://"+str(bucket)+"/user.bkz")
+        fs_mod.fs_get("file://"+str(bucket)+"/user.bkz", str(testdir.tmpdir.join("restored","user.bkz")))
+        assert(open(str(testdir.tmpdir.join("restored","user.bkz")),"rb").read() == open(compressed,"rb").read())
+    finally:
+        os.remove(compressed)
+    try:
+        compress_mod.decompress_file(str(marked),"zstd")
+        assert(False)
+    except Exception:
+        pass
+
+    fs_mod.fs_put(str(rnd), "file://"+str(bucket)+"/random.dat")
+    restored = str(testdir.tmpdir.join("restored","random.dat"))
+    fs_mod.fs_get("file://"+str(bucket)+"/random.dat", restored)
+    assert(open(restored,"rb").read() == rnd.read_binary())
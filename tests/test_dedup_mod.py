@@ -0,0 +1,24 @@
+from bkp_core import dedup_mod
+import hashlib
+import os
+
+def test_dedup_mod(testdir):
+    """ test suite for the content addressed storage helpers """
+    content = b"the same content on every machine\n" * 100000
+    f = testdir.tmpdir.join("content.bin")
+    f.write_binary(content)
+    digest = hashlib.sha256(content).hexdigest()
+
+    assert(dedup_mod.file_hash(str(f)) == digest)
+
+    t_file_name, t_digest, t_size = dedup_mod.copy_and_hash(str(f))
+    try:
+        assert(t_digest == digest)
+        assert(t_size == len(content))
+        assert(open(t_file_name,"rb").read() == content)
+    finally:
+        os.remove(t_file_name)
+
+    object_path = dedup_mod.object_path("file:///bucket", digest)
+    assert(object_path == "file:///bucket/objects/"+digest[:2]+"/"+digest)
+    assert(object_path.startswith(dedup_mod.objects_prefix("file:///bucket")))
@@ -0,0 +1,38 @@
+from bkp_core.exclude_mod import Matcher, compile_patterns, match_any
+from bkp_core.walk_mod import TreeWalker
+import os
+
+def test_exclude_mod_matcher(testdir):
+    """ test suite for the exclusion Matcher covering exclude_dirs, exclude_files and .bkpignore files """
+    top = str(testdir.tmpdir.mkdir("top"))
+    for d in ["keep/sub","james/Downloads/deep/deeper","proj/build/out","proj/src"]:
+        os.makedirs(os.path.join(top,d))
+    open(os.path.join(top,"proj",".bkpignore"),"w").write("# build output\nbuild$\n.*\\.tmp$\n")
+
+    matcher = Matcher(["james/Downloads",""], r".*\.pyc$")
+    assert(matcher.exclude_dir(os.path.join(top,"james/Downloads")) == "james/Downloads")
+    assert(matcher.exclude_dir(os.path.join(top,"keep/sub")) == None)
+    assert(matcher.exclude_dir(os.path.join(top,"proj/build")) == "build$")
+    assert(matcher.exclude_dir(os.path.join(top,"proj/src")) == None)
+    assert(matcher.exclude_file(os.path.join(top,"keep"),"a.pyc") == r".*\.pyc$")
+    assert(matcher.exclude_file(os.path.join(top,"proj/src"),"a.tmp") == r".*\.tmp$")
+    assert(matcher.exclude_file(os.path.join(top,"keep"),"a.tmp") == None)
+
+    dirnames = ["sub","Downloads","other"]
+    Matcher(["james/Downloads"]).prune(os.path.join(top,"james"),dirnames)
+    assert(dirnames == ["sub","other"])
+
+    scanned = []
+    def process_dir( dirpath, dirs, files ):
+        scanned.append(os.path.relpath(dirpath,top))
+        matcher.prune( dirpath, dirs )
+    TreeWalker(1).walk(top, process_dir)
+    assert(sorted(scanned) == sorted([".","keep","keep/sub","james","proj","proj/src"]))
+
+def test_exclude_mod_patterns():
+    """ test the compiled pattern list helpers used by rstr """
+    patterns = compile_patterns([r".*/local_2\.txt","",r"/home/.*\.jpg$"])
+    assert(len(patterns) == 2)
+    assert(match_any(patterns,"/tmp/local_2.txt") == r".*/local_2\.txt")
+    assert(match_any(patterns,"/home/me/a.jpg") == r"/home/.*\.jpg$")
+    assert(match_any(patterns,"/home/me/a.png") == None)
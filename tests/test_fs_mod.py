@@ -5,6 +5,8 @@ from io import StringIO
 import time
 import re
 import math
+import threading
+import shutil
 
 def test_fs_mod_ssh(fs_testdir):
     """ test suite for the fs_mod module covering sftp functionality """
@@ -160,3 +162,125 @@ def test_fs_mod_file(fs_testdir):
         elif file_name in fs_testdir["local_files"]:
             local_count += 1
     assert(remote_count == 5 and local_count == 0)
+
+def test_fs_mod_backends(testdir):
+    """ test suite for the backend registry covering resolution, capabilities, lifecycle and the function shims """
+    assert(fs_mod.get_scheme("s3://bucket/a") == "s3")
+    assert(fs_mod.get_scheme("ssh://host:22/a") == "ssh")
+    assert(fs_mod.get_scheme("file:///tmp/a") == "file")
+    assert(fs_mod.get_scheme("/tmp/a://b") == "file")
+
+    backend = fs_mod.get_backend("file:///tmp/a")
+    assert(backend.is_open)
+    assert(fs_mod.get_backend("/tmp/b") is backend)
+    assert(backend.has(fs_mod.RANGED_READ) and backend.has(fs_mod.SERVER_COPY) and backend.has(fs_mod.APPEND))
+    assert(not fs_mod.get_backend("s3://bucket/a").has(fs_mod.APPEND))
+    fs_mod.close_backends()
+    assert(not backend.is_open)
+    assert(fs_mod.get_backend("file:///tmp/a") is not backend)
+
+    try:
+        fs_mod.get_backend("nope://host/a")
+        assert(False)
+    except Exception as e:
+        assert("Unknown remote file system" in str(e))
+
+    src = testdir.tmpdir.join("src.txt")
+    src.write("hello\n")
+    remote = "file://"+str(testdir.tmpdir.join("remote","a.txt"))
+    fs_mod.get_backend(remote).append(str(src), remote)
+    fs_mod.get_backend(remote).append(str(src), remote)
+    fs_mod.get_backend(remote).copy(remote, remote+".copy")
+    assert(open(str(testdir.tmpdir.join("remote","a.txt.copy"))).read() == "hello\nhello\n")
+
+    class MemoryBackend(fs_mod.Backend):
+        """ backend that keeps files in a dict """
+        scheme = "mem"
+        def open( self ):
+            self.files = {}
+            return fs_mod.Backend.open(self)
+        def put( self, local_path, remote_path, get_config = lambda: {}, verbose = False ):
+            self.files[remote_path] = open(local_path,"rb").read()
+        def get_file( self, remote_path, local_path, get_config = lambda: {} ):
+            open(local_path,"wb").write(self.files[remote_path])
+        def stat( self, remote_path, get_config = lambda: {} ):
+            if remote_path in self.files:
+                return (0,len(self.files[remote_path]))
+            return (-1,-1)
+
+    fs_mod.register_backend("mem", MemoryBackend)
+    try:
+        fs_mod.fs_put(str(src), "mem://a")
+        assert(fs_mod.fs_stat("mem://a") == (0,6))
+        assert(fs_mod.fs_stat("mem://b") == (-1,-1))
+        fs_mod.fs_get("mem://a", str(testdir.tmpdir.join("got.txt")))
+        assert(testdir.tmpdir.join("got.txt").read() == "hello\n")
+        assert(fs_mod.fs_test("mem://a"))
+        # what the backend doesn't implement says so
+        try:
+            fs_mod.fs_ls("mem://")
+            assert(False)
+        except Exception as e:
+            assert(e.args == ("ls: Listing is not supported","mem://"))
+    finally:
+        fs_mod.close_backends()
+        del fs_mod.backend_classes["mem"]
+
+def test_fs_mod_job_backends(testdir):
+    """ test that a job's backends are used by its thread and the threads it starts and that closing them leaves other jobs' backends and caches alone """
+    remote = "file://"+str(testdir.tmpdir.join("remote"))
+    src = testdir.tmpdir.join("src.txt")
+    src.write("hello\n")
+    outside = fs_mod.get_backend(remote)
+    fs_mod.fs_put(str(src), remote+"/outside/a.txt")
+    assert(outside.dir_cache.known)
+
+    job = fs_mod.Backends().use()
+    try:
+        backend = fs_mod.get_backend(remote)
+        assert(backend is not outside and job.get(remote) is backend)
+        seen = []
+        def worker():
+            seen.append(fs_mod.get_backend(remote))
+            fs_mod.fs_put(str(src), remote+"/job/a.txt")
+        t = fs_mod.thread(worker)
+        t.start()
+        t.join()
+        assert(seen == [ backend ] and backend.dir_cache.known)
+        # a plain thread doesn't use the job's backends
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        assert(seen[1] is outside)
+    finally:
+        job.done()
+    assert(not backend.is_open and not backend.dir_cache.known)
+    assert(outside.is_open and outside.dir_cache.known)
+    assert(fs_mod.get_backend(remote) is outside)
+    fs_mod.close_backends()
+    assert(not outside.dir_cache.known)
+
+def test_fs_mod_dir_cache(testdir):
+    """ test that only the backends cache the directories they write to and that a cached directory removed behind their back is made again """
+    src = testdir.tmpdir.join("src.txt")
+    src.write("hello\n")
+    target = os.path.join(str(testdir.tmpdir),"remote","a","b")
+    backend = fs_mod.get_backend("file://"+target)
+    for name in [ "x.txt", "y.txt" ]:
+        fs_mod.fs_put(str(src), "file://"+target+"/"+name)
+        fs_mod.get_backend(target).append(str(src), target+"/log.txt")
+    assert(os.path.abspath(target) in backend.dir_cache.known)
+    shutil.rmtree(os.path.join(str(testdir.tmpdir),"remote"))
+    fs_mod.fs_put(str(src), "file://"+target+"/x.txt")
+    fs_mod.get_backend(target).append(str(src), target+"/log.txt")
+    fs_mod.get_backend(target).copy(target+"/x.txt", target+"/z.txt")
+    assert(sorted(os.listdir(target)) == [ "log.txt", "x.txt", "z.txt" ])
+
+    # local files that are fetched always check their directory
+    got = os.path.join(str(testdir.tmpdir),"got","a.txt")
+    fs_mod.fs_get("file://"+target+"/x.txt", got)
+    shutil.rmtree(os.path.join(str(testdir.tmpdir),"got"))
+    fs_mod.fs_get_range("file://"+target+"/x.txt", got, 0, 5)
+    assert(open(got).read() == "hello")
+    assert(not [ d for d in backend.dir_cache.known if "/got" in d ])
+    fs_mod.close_backends()
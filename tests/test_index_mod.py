@@ -0,0 +1,106 @@
+from bkp_core import bkp_mod
+from bkp_core import bkp_conf
+from bkp_core import index_mod
+from bkp_core import util
+import threading
+from io import StringIO
+
+def test_index_mod_file_index(testdir):
+    """ test suite for the FileIndex class covering adding, querying and removing backups """
+    file_index = index_mod.FileIndex("file:///backups/bkp/machine").open()
+    assert(not file_index.is_built())
+
+    file_index.add_backup("2020.01.01.00.00.00", 100.0, [("/home/a.txt","transferred",10.0,5),("/home/b.txt","error",11.0,6)])
+    file_index.add_backup("2020.01.02.00.00.00", 200.0, [("/home/a.txt","transferred",20.0,7)])
+    file_index.set_next(200.0)
+
+    assert(file_index.is_built())
+    assert(file_index.get_next() == 200.0)
+    assert("/home/a.txt" in file_index)
+    assert("/home/b.txt" not in file_index)
+    assert(file_index.get_versions("/home/a.txt") == [(100.0,10.0,5),(200.0,20.0,7)])
+    assert(file_index.get_timestamps() == set(["2020.01.01.00.00.00","2020.01.02.00.00.00"]))
+
+    other_index = index_mod.FileIndex("file:///backups/bkp/other").open()
+    assert("/home/a.txt" not in other_index)
+    other_index.close()
+
+    file_index.remove_backup("2020.01.02.00.00.00")
+    assert(file_index.get_backedup_files() == { "/home/a.txt" : [100.0] })
+    file_index.clear()
+    assert(not file_index.is_built())
+    file_index.close()
+
+def test_index_mod_update_index(testdir):
+    """ test that update_index only reads the remote logs for backups missing from the index """
+    machine_path = "file://"+str(testdir.tmpdir)+"/bucket/bkp/machine"
+    config = { "bucket": "file://"+str(testdir.tmpdir)+"/bucket", "dirs": ["/home"], "exclude_files": "", "exclude_dirs": [""],
+               "log_email": "", "error_email": "", "threads": "1", "ssh_username": "", "ssh_password": "",
+               "start_time": "0.0", "end_time": "0.0" }
+
+    def make_backup( timestamp, files ):
+        log = StringIO()
+        bkp_conf.save_config(config, log, True)
+        for f in files:
+            print("%s;%s;transferred;na"%(f,machine_path+"/"+timestamp+f), file=log)
+        util.put_contents(machine_path+"/"+timestamp+"/bkp", "bkp."+timestamp+".log", log.getvalue(), False, lambda: config)
+
+    make_backup("2020.01.01.00.00.00", ["/home/a.txt","/home/b.txt"])
+    util.put_contents(machine_path, "next", 1.0, False, lambda: config)
+
+    file_index = index_mod.FileIndex(machine_path).open()
+    bkp_mod.update_index(machine_path, config, file_index)
+    assert(file_index.get_next() == 1.0)
+    assert(sorted(file_index.get_backedup_files().keys()) == ["/home/a.txt","/home/b.txt"])
+
+    make_backup("2020.01.02.00.00.00", ["/home/c.txt"])
+    fetched = []
+    get_contents = bkp_mod.get_contents
+    def counting_get_contents( path, name, verbose = False, get_config = lambda: {} ):
+        fetched.append(name)
+        return get_contents( path, name, verbose, get_config )
+    bkp_mod.get_contents = counting_get_contents
+    try:
+        bkp_mod.update_index(machine_path, config, file_index)
+    finally:
+        bkp_mod.get_contents = get_contents
+    assert(fetched == ["next","2020.01.02.00.00.00/bkp/bkp.2020.01.02.00.00.00.log"])
+    assert("/home/c.txt" in file_index)
+    file_index.close()
+
+def test_index_mod_path_set(testdir):
+    """ test that a PathSet adds each path once and iterates them in order past its batch size """
+    paths = index_mod.PathSet([ "/b", "/a" ])
+    assert(paths.add("/c") and not paths.add("/a"))
+    assert("/a" in paths and "/d" not in paths)
+    for i in range(0,2500):
+        paths.add("/f%05d"%i)
+    assert(len(paths) == 2503)
+    assert(list(paths) == sorted([ "/a", "/b", "/c" ]+[ "/f%05d"%i for i in range(0,2500) ]))
+    paths.close()
+
+def test_index_mod_claim_object(testdir):
+    """ test that only one thread stores an object at a time, the others wait for it and then find it stored or store it themselves if it wasn't """
+    file_index = index_mod.FileIndex("file:///backups/bkp/machine").open()
+    assert(file_index.claim_object("/objects/a"))
+    stored = []
+    def worker():
+        if file_index.claim_object("/objects/a"):
+            stored.append("again")
+            file_index.release_object("/objects/a")
+    waiters = [ threading.Thread(target=worker) for i in range(0,4) ]
+    for w in waiters:
+        w.start()
+    file_index.add_object("/objects/a", 10)
+    file_index.release_object("/objects/a")
+    for w in waiters:
+        w.join()
+    assert(stored == [])
+    assert(not file_index.claim_object("/objects/a"))
+
+    # an object that failed to be stored is stored by the next thread that claims it
+    assert(file_index.claim_object("/objects/b"))
+    file_index.release_object("/objects/b")
+    assert(file_index.claim_object("/objects/b"))
+    file_index.release_object("/objects/b")
+    file_index.close()
@@ -0,0 +1,62 @@
+import os
+import threading
+from bkp_core import logger
+from bkp_core.logger import Logger, LogWriter
+
+def test_logger_writer(testdir,monkeypatch):
+    """ test the buffered log writer flushes on size, age and checkpoints """
+    monkeypatch.setattr(logger,"flush_bytes",1000)
+    monkeypatch.setattr(logger,"flush_seconds",0.0)
+    log_path = os.path.join(str(testdir.tmpdir),"test.log")
+    writer = LogWriter(log_path)
+    for i in range(0,50):
+        writer.write("line %04d"%i)
+    # each line is 10 bytes so only the first 100 lines fill the buffer
+    assert(not os.path.exists(log_path))
+    assert(writer.due())
+    writer.flush()
+    assert(open(log_path).read() == "".join(["line %04d\n"%i for i in range(0,50)]))
+    for i in range(50,250):
+        writer.write("line %04d"%i)
+    assert(writer.flushes == 3)
+    writer.write("last")
+    writer.checkpoint()
+    assert(writer.syncs == 1)
+    writer.close()
+    assert(open(log_path).read() == "".join(["line %04d\n"%i for i in range(0,250)])+"last\n")
+    assert(writer.lines == 251)
+
+def test_logger_stats(testdir):
+    """ test that the logger reports its peak queue depth and the cpu time of its thread """
+    log_path = os.path.join(str(testdir.tmpdir),"test.log")
+    log = Logger()
+    for i in range(0,100):
+        log.log("line %d"%i)
+    assert(log.peak_queue == 100)
+    def perform_log():
+        writer = LogWriter(log_path)
+        while not log.stopped():
+            line = log.get()
+            if line:
+                writer.write(line)
+        writer.close()
+    log.start_logger(perform_log)
+    log.wait_for_logger()
+    assert(len(open(log_path).read().split("\n")) == 101)
+    assert(log.cpu_seconds > 0.0)
+
+def test_logger_stopped(testdir):
+    """ test that logging to a full queue after the logger is stopped drops the message instead of blocking forever """
+    log = Logger(2)
+    log.log("first")
+    log.log("second")
+    logged = []
+    def late_log():
+        log.log("blocked")
+        logged.append(True)
+    t = threading.Thread(target=late_log)
+    t.start()
+    log.stop_logger()
+    t.join()
+    log.log("after")
+    assert(logged == [ True ] and log.logger_queue.qsize() == 2)
@@ -0,0 +1,40 @@
+from bkp_core import manifest_mod
+import io
+
+def test_manifest_mod(testdir):
+    """ test suite for writing, streaming, searching and merging backup manifests """
+    records = []
+    for i in range(3000):
+        records.append(("/home/f%05d.txt"%i, "file:///bucket/f%05d.txt"%i, "transferred", "na", 1000.0+i, i, ""))
+    records.append(("/home/deduped.txt", "file:///bucket/objects/ab/abcd", "deduped", "sha256=abcd", None, None, "abcd"))
+    records.append(("/home/error.txt", "file:///bucket/error.txt", "error", "Traceback/line 1/line 2", 5.0, 6, ""))
+    records.append(("/home/café.txt", "file:///bucket/café.txt", "packed", "100,20", 7.0, 20, ""))
+
+    f = io.BytesIO()
+    manifest_mod.write_manifest(f, reversed(records))
+    f.seek(0)
+    read = [ r for r in manifest_mod.read_manifest(f) ]
+    assert(len(read) == len(records))
+    assert(read == sorted(read, key=lambda r: r[0]))
+    by_path = dict([ (r[0],r) for r in read ])
+    assert(by_path["/home/f00042.txt"] == records[42])
+    assert(by_path["/home/deduped.txt"] == records[3000])
+    assert(by_path["/home/error.txt"][3] == "")
+    assert(by_path["/home/café.txt"] == records[3002])
+
+    index = manifest_mod.read_index(f)
+    assert(len(index) == 3)
+    assert(manifest_mod.find(f, "/home/f02500.txt", index) == records[2500])
+    assert(manifest_mod.find(f, "/home/deduped.txt") == records[3000])
+    assert(manifest_mod.find(f, "/home/missing.txt", index) == None)
+    assert(manifest_mod.find(f, "/a", index) == None)
+
+    other = [ ("/home/f00001.txt", "file:///other", "transferred", "na", 1.0, 1, ""), ("/zzz", "file:///zzz", "transferred", "na", 1.0, 1, "") ]
+    merged = [ r[0] for r in manifest_mod.merge([ iter(read), iter(other) ]) ]
+    assert(merged == sorted(merged))
+    assert(len(merged) == len(read)+2)
+
+    machine_path = "file://"+str(testdir.tmpdir)+"/bucket/bkp/machine"
+    assert(manifest_mod.get_manifest(machine_path, "2020.01.01.00.00.00") == None)
+    manifest_mod.put_manifest(machine_path, "2020.01.01.00.00.00", records[:10])
+    assert(manifest_mod.get_manifest(machine_path, "2020.01.01.00.00.00") == records[:10])
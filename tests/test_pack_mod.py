@@ -0,0 +1,114 @@
+from bkp_test_util import s3_stub
+from bkp_core import pack_mod
+from bkp_core import fs_mod
+import os
+import threading
+
+def test_pack_mod(testdir):
+    """ test suite for packing small files and reading them back with ranged and cached reads """
+    src = testdir.tmpdir.mkdir("src")
+    files = []
+    for i in range(20):
+        f = src.join("f%d.txt"%i)
+        f.write_binary(("file %d\n"%i).encode()*(i*50+1))
+        files.append(str(f))
+
+    pack_dir = "file://"+str(testdir.tmpdir.join("bucket","packs"))
+    writer = pack_mod.PackWriter(pack_dir, 512, "gzip")
+    packs = []
+    for f in files:
+        full = writer.add(f)
+        if full:
+            packs.append(full)
+    last = writer.close()
+    assert(last != None)
+    packs.append(last)
+    assert(writer.close() == None)
+    assert(len(packs) > 1)
+    assert(sorted([ m[0] for p in packs for m in p.members ]) == sorted(files))
+
+    for p in packs:
+        p.store()
+        assert(not os.path.exists(p.local_path))
+        assert(fs_mod.fs_stat(p.remote_path)[1] == p.size)
+
+    reader = pack_mod.PackReader()
+    for p in packs:
+        for local_path, offset, length, codec in p.members:
+            target = str(testdir.tmpdir.join("restored",os.path.basename(local_path)))
+            reader.get(p.remote_path, target, offset, length, codec)
+            assert(open(target,"rb").read() == open(local_path,"rb").read())
+
+            # fall back to caching the whole pack like we do for s3
+            cached = reader.cached_pack(p.remote_path)
+            with open(cached,"rb") as f:
+                f.seek(offset)
+                assert(len(f.read(length)) == length)
+    reader.close()
+    assert(reader.cache_dir == None)
+
+
+def test_pack_mod_threads(testdir,monkeypatch):
+    """ test that files are read and compressed outside the pack lock and that threads adding at once get every file in at the right offsets """
+    src = testdir.tmpdir.mkdir("src")
+    files = []
+    for i in range(200):
+        f = src.join("f%d.txt"%i)
+        f.write_binary(("file %d\n"%i).encode()*(i+1))
+        files.append(str(f))
+    writer = pack_mod.PackWriter("file://"+str(testdir.tmpdir.join("bucket","packs")), 4096, "gzip")
+    locked = []
+    read_member = pack_mod.read_member
+    def checked_read( local_path, compress = None ):
+        locked.append(writer.pack_lock.locked())
+        return read_member( local_path, compress )
+    monkeypatch.setattr(pack_mod,"read_member",checked_read)
+    packs = []
+    assert(writer.add(files[0]) == None)
+    assert(locked == [ False ])
+
+    packs_lock = threading.Lock()
+    def adder(part):
+        for f in part:
+            full = writer.add(f)
+            if full:
+                with packs_lock:
+                    packs.append(full)
+    threads = [ threading.Thread(target=adder,args=(files[1+i::4],)) for i in range(4) ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    packs.append(writer.close())
+    assert(sorted([ m[0] for p in packs for m in p.members ]) == sorted(files))
+    reader = pack_mod.PackReader()
+    for p in packs:
+        assert(sum([ m[2] for m in p.members ]) == p.size)
+        p.store()
+        for local_path, offset, length, codec in p.members:
+            target = str(testdir.tmpdir.join("restored",os.path.basename(local_path)))
+            reader.get(p.remote_path, target, offset, length, codec)
+            assert(open(target,"rb").read() == open(local_path,"rb").read())
+    reader.close()
+
+def test_pack_mod_empty(s3_stub,testdir):
+    """ test that an empty member of a pack on S3 is restored without a ranged get """
+    src = testdir.tmpdir.mkdir("src")
+    hello = src.join("hello.txt")
+    hello.write_binary(b"hello")
+    empty = src.join("empty.txt")
+    empty.write_binary(b"")
+    writer = pack_mod.PackWriter("s3://bucket/packs", 1024)
+    writer.add(str(hello))
+    writer.add(str(empty))
+    pack = writer.close()
+    pack.store()
+    reader = pack_mod.PackReader()
+    restored = {}
+    for local_path, offset, length, codec in pack.members:
+        target = str(testdir.tmpdir.join("restored",os.path.basename(local_path)))
+        reader.get(pack.remote_path, target, offset, length, codec)
+        restored[os.path.basename(local_path)] = open(target,"rb").read()
+    reader.close()
+    assert(restored == { "hello.txt" : b"hello", "empty.txt" : b"" })
+    assert(s3_stub.range_gets == 1)
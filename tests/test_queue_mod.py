@@ -0,0 +1,151 @@
+import os
+import time
+import queue
+import threading
+from bkp_core import sync_mod
+from bkp_core.logger import Logger
+from bkp_core.queue_mod import WorkQueue, Closed, Stopped
+
+def test_queue_mod_close(testdir):
+    """ test that closing a work queue wakes the readers right away after they drain it """
+    q = WorkQueue(10)
+    results = []
+    def reader():
+        while True:
+            try:
+                results.append(q.get())
+            except Closed:
+                results.append("closed")
+                return
+    readers = [ threading.Thread(target=reader) for i in range(0,4) ]
+    for r in readers:
+        r.start()
+    for i in range(0,20):
+        q.put(i)
+    q.close()
+    for r in readers:
+        r.join()
+    assert(sorted([ r for r in results if r != "closed" ]) == list(range(0,20)))
+    assert(results.count("closed") == 4)
+
+    q = WorkQueue()
+    start = time.time()
+    try:
+        q.get(True,0.05)
+        assert(False)
+    except queue.Empty:
+        pass
+    assert(time.time() - start >= 0.05)
+    try:
+        q.get(False)
+        assert(False)
+    except queue.Empty:
+        pass
+    q.put("last")
+    q.close()
+    assert(q.get() == "last")
+    try:
+        q.get()
+        assert(False)
+    except Closed:
+        pass
+
+def test_queue_mod_closed_put(testdir):
+    """ test that a closed queue takes nothing more and that closing it wakes a writer blocked on it being full """
+    q = WorkQueue(1)
+    q.put("first")
+    try:
+        q.put("second",True,0.01)
+        assert(False)
+    except queue.Full:
+        pass
+    results = []
+    def writer():
+        try:
+            q.put("blocked")
+            results.append("put")
+        except Closed:
+            results.append("closed")
+    w = threading.Thread(target=writer)
+    w.start()
+    q.close()
+    w.join()
+    assert(results == [ "closed" ])
+    try:
+        q.put("late",False)
+        assert(False)
+    except Closed:
+        pass
+    assert(q.get() == "first")
+    try:
+        q.get()
+        assert(False)
+    except Closed:
+        pass
+
+def test_queue_mod_stop(testdir):
+    """ test that a reader stops without taking anything once its stop function says so and that wake makes blocked readers check it """
+    q = WorkQueue()
+    q.put("kept")
+    try:
+        q.get(stop=lambda: True)
+        assert(False)
+    except Stopped:
+        pass
+    assert(q.get(stop=lambda: False) == "kept")
+
+    stop = threading.Event()
+    results = []
+    def reader():
+        try:
+            results.append(q.get(stop=stop.is_set))
+        except Stopped:
+            results.append("stopped")
+    r = threading.Thread(target=reader)
+    r.start()
+    stop.set()
+    q.wake()
+    r.join()
+    assert(results == [ "stopped" ])
+
+def test_queue_mod_no_polling(testdir,monkeypatch):
+    """ test that the logger and the workers of a sync job block on their queues until something comes in or the queue is closed instead of polling them """
+    monkeypatch.setenv("HOME",str(testdir.tmpdir))
+    gets = []
+    puts = []
+    get = WorkQueue.get
+    put = WorkQueue.put
+    def counted_get( self, block = True, timeout = None, stop = None ):
+        gets.append(timeout)
+        return get( self, block, timeout, stop )
+    def counted_put( self, item, block = True, timeout = None ):
+        puts.append(item)
+        return put( self, item, block, timeout )
+    monkeypatch.setattr(WorkQueue,"get",counted_get)
+    monkeypatch.setattr(WorkQueue,"put",counted_put)
+
+    log = Logger()
+    log.start_logger()
+    for i in range(0,3):
+        log.log("line %d"%i)
+    log.wait_for_logger()
+    # each get returned a line except maybe the last one that found the queue closed
+    assert(gets == [ None ]*len(gets))
+    assert(3 <= len(gets) <= 4)
+
+    del gets[:]
+    del puts[:]
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    target = "file://"+os.path.join(str(testdir.tmpdir),"target")
+    for d in range(0,3):
+        os.makedirs(os.path.join(local_path,"d%d"%d))
+        for f in range(0,5):
+            open(os.path.join(local_path,"d%d"%d,"f%d.txt"%f),"w").write("file %d %d"%(d,f))
+    os.makedirs(os.path.join(str(testdir.tmpdir),"target")+local_path)
+    sync_config = { "target" : target, "dirs" : [local_path], "exclude_files" : "", "exclude_dirs" : [], "threads" : "8" }
+    assert(not sync_mod.SyncJob( sync_config ).synchronize())
+    assert(os.path.exists(os.path.join(str(testdir.tmpdir),"target")+os.path.join(local_path,"d2","f4.txt")))
+    # the 8 workers and the logger each got what was put on their queues and one Closed
+    assert(gets == [ None ]*len(gets))
+    assert(len(puts) >= 15 and len(gets) <= len(puts) + 8 + 1)
+
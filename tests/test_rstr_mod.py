@@ -3,12 +3,15 @@ from bkp_core import rstr_mod
 from bkp_core import bkp_conf
 from bkp_core import fs_mod
 from bkp_core import util
+from bkp_core import manifest_mod
+from bkp_core import file_mod
 from bkp_test_util import bkp_testdir
 import platform
 import os
 import time
 from io import StringIO
 import math
+import random
 
 def do_restore_test(t_dir,test_basepath):
     """ worker function to perform restore tests on various targets based on the setting of the base_path """
@@ -127,3 +130,164 @@ def test_rstr_mod_ssh(bkp_testdir):
 def test_rstr_mod_s3(bkp_testdir):
     """ test suite for the rstr_mod module covering s3 system functionality """
     do_restore_test(bkp_testdir, bkp_testdir["s3_basepath"])
+
+def do_mode_test( testdir, monkeypatch, options, check_entries ):
+    """ back up a tree to a file:// bucket with options added to the config, call check_entries with the records of the backup and restore all of it """
+    monkeypatch.setenv("HOME",str(testdir.tmpdir))
+    monkeypatch.setattr(bkp_mod,"mail_log",lambda *args, **kwargs: None)
+    monkeypatch.setattr(bkp_mod,"mail_error",lambda *args, **kwargs: None)
+    os.makedirs(os.path.join(str(testdir.tmpdir),".bkp"))
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    rnd = random.Random(42)
+    contents = {}
+    for d in range(0,3):
+        for f in range(0,10):
+            contents[os.path.join(local_path,"d%d"%d,"f%d.txt"%f)] = ("line %d %d\n"%(d,f)).encode()*(f*20+1)
+    contents[os.path.join(local_path,"copy.txt")] = contents[os.path.join(local_path,"d0","f1.txt")]
+    contents[os.path.join(local_path,"empty.txt")] = b""
+    contents[os.path.join(local_path,"big.txt")] = b"".join([ ("big line %d\n"%i).encode() for i in range(0,30000) ])
+    contents[os.path.join(local_path,"big.bin")] = bytes(rnd.getrandbits(8) for i in range(0,200000))
+    for path, data in contents.items():
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        open(path,"wb").write(data)
+
+    bkp_config = { "bucket" : "file://"+os.path.join(str(testdir.tmpdir),"bucket"), "dirs" : [local_path], "exclude_files" : "", "exclude_dirs" : [],
+                   "log_email" : "", "error_email" : "", "ssh_username" : "", "ssh_password" : "", "threads" : "5", "cache_size" : "0" }
+    bkp_config.update(options)
+    assert(not bkp_mod.BackupJob(dict(bkp_config)).backup())
+    machine_path = bkp_config["bucket"]+"/bkp/"+platform.node()
+    backups = bkp_mod.get_backups( machine_path, bkp_config )
+    assert(len(backups) == 1)
+    entries = dict([ (r[0],r) for r in bkp_mod.get_backup_entries( backups[0], machine_path, bkp_config ) ])
+    assert(sorted(entries.keys()) == sorted(contents.keys()))
+    check_entries( entries, backups[0], machine_path, bkp_config )
+
+    restore_target = os.path.join(str(testdir.tmpdir),"restore_target")
+    rstr_job = rstr_mod.RestoreJob( dict(bkp_config) )
+    assert(not rstr_job.restore( restore_path=restore_target, restore_pats = [r".*"] ))
+    assert(not rstr_job.stats.get("errors"))
+    for path, data in contents.items():
+        restored_file = restore_target+path
+        assert(open(restored_file,"rb").read() == data)
+        assert(os.stat(restored_file).st_mtime == backups[0].time)
+    return entries
+
+def test_rstr_mod_plain(testdir,monkeypatch):
+    """ test a backup and restore through a file:// bucket with every file stored as it is """
+    def check( entries, bk, machine_path, config ):
+        assert(set([ r[2] for r in entries.values() ]) == set([ "transferred" ]))
+        assert(set([ r[3] for r in entries.values() ]) == set([ "na" ]))
+    do_mode_test(testdir, monkeypatch, {}, check)
+
+def test_rstr_mod_dedup(testdir,monkeypatch):
+    """ test a backup and restore through a file:// bucket with dedup on, files with the same content share one object """
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    def check( entries, bk, machine_path, config ):
+        copies = [ entries[os.path.join(local_path,"copy.txt")], entries[os.path.join(local_path,"d0","f1.txt")] ]
+        assert(copies[0][1] == copies[1][1] and "/objects/" in copies[0][1])
+        assert(sorted([ r[2] for r in copies ]) == [ "deduped", "transferred" ])
+        assert(set([ r[2] for r in entries.values() ]) == set([ "deduped", "transferred" ]))
+        assert(all([ r[3].startswith("sha256=") for r in entries.values() ]))
+    do_mode_test(testdir, monkeypatch, { "dedup" : "True" }, check)
+
+def test_rstr_mod_chunks(testdir,monkeypatch):
+    """ test a backup and restore through a file:// bucket with the big files stored as content defined chunks """
+    def check( entries, bk, machine_path, config ):
+        chunked = sorted([ os.path.basename(r[0]) for r in entries.values() if r[2] == "chunked" ])
+        assert(chunked == [ "big.bin", "big.txt" ])
+        assert(all([ r[1].endswith(".chunks") for r in entries.values() if r[2] == "chunked" ]))
+    do_mode_test(testdir, monkeypatch, { "chunk_min_size" : "100000" }, check)
+
+def test_rstr_mod_compress(testdir,monkeypatch):
+    """ test a backup and restore through a file:// bucket with compression, only the files whose entries say so are decompressed """
+    def check( entries, bk, machine_path, config ):
+        compressed = [ os.path.basename(r[0]) for r in entries.values() if r[3] == "compressed=gzip" ]
+        assert("big.txt" in compressed and "big.bin" not in compressed and "empty.txt" not in compressed)
+        assert(entries[os.path.join(config["dirs"][0],"big.bin")][3] == "na")
+    do_mode_test(testdir, monkeypatch, { "compress" : "gzip" }, check)
+
+def test_rstr_mod_packs(testdir,monkeypatch):
+    """ test a backup and restore through a file:// bucket with the small files packed and compressed in pack files """
+    def check( entries, bk, machine_path, config ):
+        packed = [ r for r in entries.values() if r[2] == "packed" ]
+        assert(len(packed) == len([ r for r in entries.values() if 0 < os.path.getsize(r[0]) < 4096 ]))
+        assert(len(set([ r[1] for r in packed ])) > 1)
+        assert(any([ r[3].endswith(",compressed=gzip") for r in packed ]))
+        assert(entries[os.path.join(config["dirs"][0],"big.bin")][2] == "transferred")
+    do_mode_test(testdir, monkeypatch, { "pack_threshold" : "4096", "pack_size" : "2048", "compress" : "gzip" }, check)
+
+def test_rstr_mod_manifests(testdir,monkeypatch):
+    """ test that a backup's manifest records every file with its mtime and size and that a restore works from the manifest or the log alone """
+    def check( entries, bk, machine_path, config ):
+        for local_path, remote_path, status, msg, mtime, size, digest in entries.values():
+            assert(status in [ "transferred", "packed" ])
+            assert(size == os.path.getsize(local_path) and mtime == os.stat(local_path).st_mtime)
+        log_path = machine_path+"/"+bk.timestamp+"/bkp/bkp."+bk.timestamp+".log"
+        manifest_path = machine_path+"/"+manifest_mod.manifest_name(bk.timestamp)
+        # without the manifest the entries come from the log
+        os.rename(file_mod.strip_protocol(manifest_path), file_mod.strip_protocol(manifest_path)+".save")
+        from_log = dict([ (r[0],r) for r in bkp_mod.get_backup_entries( bk, machine_path, config ) ])
+        # the log has the mtime and size each file was scanned with too
+        assert(from_log == entries)
+        # and the restore only has the manifest to go on
+        os.rename(file_mod.strip_protocol(manifest_path)+".save", file_mod.strip_protocol(manifest_path))
+        os.remove(file_mod.strip_protocol(log_path))
+    do_mode_test(testdir, monkeypatch, { "pack_threshold" : "1024" }, check)
+
+def test_rstr_mod_scanned(testdir,monkeypatch):
+    """ test that the manifest has the mtime and size a file was scanned with even if it changes before the backup finishes """
+    monkeypatch.setenv("HOME",str(testdir.tmpdir))
+    monkeypatch.setattr(bkp_mod,"mail_log",lambda *args, **kwargs: None)
+    monkeypatch.setattr(bkp_mod,"mail_error",lambda *args, **kwargs: None)
+    os.makedirs(os.path.join(str(testdir.tmpdir),".bkp"))
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    os.makedirs(local_path)
+    scanned = {}
+    for f in range(0,5):
+        path = os.path.join(local_path,"f%d.txt"%f)
+        open(path,"w").write("file %d\n"%f)
+        scanned[path] = (os.stat(path).st_mtime, os.path.getsize(path))
+    put_file = bkp_mod.BackupJob.put_file
+    def changing_put( self, params ):
+        put_file( self, params )
+        open(params.from_path,"a").write("changed after the copy\n")
+        os.utime(params.from_path,(1500000000,1500000000))
+    monkeypatch.setattr(bkp_mod.BackupJob,"put_file",changing_put)
+
+    bkp_config = { "bucket" : "file://"+os.path.join(str(testdir.tmpdir),"bucket"), "dirs" : [local_path], "exclude_files" : "", "exclude_dirs" : [],
+                   "log_email" : "", "error_email" : "", "ssh_username" : "", "ssh_password" : "", "threads" : "2", "cache_size" : "0" }
+    assert(not bkp_mod.BackupJob(dict(bkp_config)).backup())
+    machine_path = bkp_config["bucket"]+"/bkp/"+platform.node()
+    backups = bkp_mod.get_backups( machine_path, bkp_config )
+    records = manifest_mod.get_manifest( machine_path, backups[0].timestamp, False, lambda: bkp_config )
+    assert(dict([ (r[0],(r[4],r[5])) for r in records ]) == scanned)
+    assert(set([ r[3] for r in records ]) == set([ "na" ]))
+
+def test_rstr_mod_versions(testdir,monkeypatch):
+    """ test that a restore picks the newest version of each file as of the asof time across several backups """
+    monkeypatch.setenv("HOME",str(testdir.tmpdir))
+    monkeypatch.setattr(bkp_mod,"mail_log",lambda *args, **kwargs: None)
+    monkeypatch.setattr(bkp_mod,"mail_error",lambda *args, **kwargs: None)
+    os.makedirs(os.path.join(str(testdir.tmpdir),".bkp"))
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    os.makedirs(local_path)
+    for f in range(0,4):
+        open(os.path.join(local_path,"f%d.txt"%f),"w").write("first %d\n"%f)
+    bkp_config = { "bucket" : "file://"+os.path.join(str(testdir.tmpdir),"bucket"), "dirs" : [local_path], "exclude_files" : "", "exclude_dirs" : [],
+                   "log_email" : "", "error_email" : "", "ssh_username" : "", "ssh_password" : "", "threads" : "2", "cache_size" : "0" }
+    assert(not bkp_mod.BackupJob(dict(bkp_config)).backup())
+    # the backups are named by the second they start in
+    time.sleep(1.1)
+    for f in range(0,2):
+        open(os.path.join(local_path,"f%d.txt"%f),"w").write("second %d\n"%f)
+    assert(not bkp_mod.BackupJob(dict(bkp_config)).backup())
+    machine_path = bkp_config["bucket"]+"/bkp/"+platform.node()
+    backups = sorted(bkp_mod.get_backups( machine_path, bkp_config ), key=lambda bk: bk.time)
+    assert(len(backups) == 2)
+
+    for asof, expected in [ ("", [ "second 0\n", "second 1\n", "first 2\n", "first 3\n" ]), (backups[0].timestamp, [ "first %d\n"%f for f in range(0,4) ]) ]:
+        restore_target = os.path.join(str(testdir.tmpdir),"restore_"+(asof or "now"))
+        rstr_job = rstr_mod.RestoreJob( dict(bkp_config) )
+        assert(not rstr_job.restore( restore_path=restore_target, asof=asof, restore_pats = [r".*"] ))
+        assert(rstr_job.stats.get("files_restored") == 4)
+        assert([ open(restore_target+os.path.join(local_path,"f%d.txt"%f)).read() for f in range(0,4) ] == expected)
@@ -0,0 +1,190 @@
+import os
+from bkp_test_util import ssh_stub
+from bkp_core import ssh_mod
+from bkp_core import fs_mod
+from bkp_core import dedup_mod
+import threading
+import shutil
+
+def test_ssh_mod_sessions(ssh_stub,testdir):
+    """ test that the threads share one connection with an sftp session each that is kept open and reconnected when it dies against a local sftp stand in """
+    get_config = lambda: ssh_stub.config
+    local_files = []
+    for i in range(0,10):
+        args = { "ssh_local_%d"%(i):"\n".join(["ssh_local_%d test line %d"%(i,j) for j in range(0,200)])}
+        local_files.append(testdir.makefile(".txt",**args))
+        os.utime(str(local_files[-1]),(1500000000+i,1500000000+i))
+
+    remote_base = ssh_stub.base+str(testdir.tmpdir)+"/remote"
+    for f in local_files:
+        fs_mod.fs_put(str(f),remote_base+"/"+f.basename,get_config)
+        fs_mod.fs_utime(remote_base+"/"+f.basename,(1500000000,1500000000),get_config)
+    for f in local_files:
+        assert(fs_mod.fs_stat(remote_base+"/"+f.basename,get_config) == (1500000000,os.path.getsize(str(f))))
+    assert(fs_mod.fs_stat(remote_base+"/missing.txt",get_config) == (-1,-1))
+    got_path = os.path.join(str(testdir.tmpdir),"got","ssh_got.txt")
+    fs_mod.fs_get(remote_base+"/"+local_files[3].basename,got_path,get_config)
+    assert(open(got_path,"rb").read() == open(str(local_files[3]),"rb").read())
+    assert(len(fs_mod.fs_ls(remote_base,False,get_config).strip().split("\n")) == 10)
+    # one connection and one sftp channel for all of the calls on this thread
+    assert(ssh_stub.connections == 1)
+    assert(ssh_stub.channels == 1)
+
+    # each worker thread has its own session on the one shared connection and closes it when it is done
+    def worker(f):
+        for j in range(0,5):
+            fs_mod.fs_put(str(f),remote_base+"/threads/%d_%s"%(j,f.basename),get_config)
+        fs_mod.release_thread()
+    threads = [threading.Thread(target=worker,args=(f,)) for f in local_files[:4]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(ssh_stub.channels == 5)
+    assert(ssh_stub.connections == 1)
+    sessions = fs_mod.get_backend(remote_base).sessions
+    assert(len(sessions.channels) == 1)
+    assert(len(fs_mod.fs_ls(remote_base+"/threads",False,get_config).strip().split("\n")) == 20)
+
+    # ssh_connections spreads the threads over that many connections
+    ssh_mod.close_sessions(sessions)
+    more_config = dict(ssh_stub.config,ssh_connections="2")
+    get_config = lambda: more_config
+    threads = [threading.Thread(target=worker,args=(f,)) for f in local_files[:6]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(ssh_stub.connections == 3)
+    assert(sessions.open_transports() == 2)
+
+    # a session the server has dropped is reconnected and the call retried
+    for t in ssh_stub.transports:
+        t.close()
+    assert(fs_mod.fs_stat(remote_base+"/"+local_files[0].basename,get_config) == (1500000000,os.path.getsize(str(local_files[0]))))
+    assert(ssh_stub.connections == 4)
+
+    fs_mod.fs_del(remote_base,True,get_config)
+    assert(not os.path.exists(str(testdir.tmpdir)+"/remote"))
+    fs_mod.close_backends()
+    assert(sessions.open_transports() == 0)
+
+def test_ssh_mod_dir_cache(ssh_stub,testdir):
+    """ test that the directories made or checked for uploads are remembered and only checked once by all of the threads """
+    get_config = lambda: ssh_stub.config
+    local_file = testdir.makefile(".txt",ssh_deep="\n".join(["ssh_deep test line %d"%j for j in range(0,200)]))
+    remote_base = ssh_stub.base+str(testdir.tmpdir)+"/remote/a/b/c/d/e"
+
+    def worker(i):
+        for j in range(0,10):
+            fs_mod.fs_put(str(local_file),remote_base+"/f/%d_%d.txt"%(i,j),get_config)
+    threads = [threading.Thread(target=worker,args=(i,)) for i in range(0,4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert(len(os.listdir(str(testdir.tmpdir)+"/remote/a/b/c/d/e/f")) == 40)
+    # remote, a, b, c, d, e and f are made once and their parents are only stat'ed until one of them is found
+    assert(ssh_stub.ops["mkdir"] == 7)
+    checks = ssh_stub.ops["stat"]
+    fs_mod.fs_put(str(local_file),remote_base+"/f/again.txt",get_config)
+    fs_mod.fs_put(str(local_file),remote_base+"/again.txt",get_config)
+    # sftp put stats each file it uploads to confirm its size, the directories cost nothing
+    assert(ssh_stub.ops["stat"] == checks+2)
+
+    # a deleted directory is forgotten and made again
+    fs_mod.fs_del(ssh_stub.base+str(testdir.tmpdir)+"/remote/a/b",True,get_config)
+    fs_mod.fs_put(str(local_file),remote_base+"/f/again.txt",get_config)
+    assert(ssh_stub.ops["mkdir"] == 12)
+    # a directory removed behind the cache's back is made again
+    shutil.rmtree(str(testdir.tmpdir)+"/remote/a/b")
+    fs_mod.fs_put(str(local_file),remote_base+"/f/again.txt",get_config)
+    assert(os.path.exists(str(testdir.tmpdir)+"/remote/a/b/c/d/e/f/again.txt"))
+    assert(ssh_stub.ops["mkdir"] == 17)
+    dir_cache = fs_mod.get_backend(remote_base).sessions.dir_cache
+    assert(dir_cache.known)
+    fs_mod.close_backends()
+    assert(not dir_cache.known)
+
+def test_ssh_mod_pipelined_ls(ssh_stub,testdir):
+    """ test that listings get the attributes of the entries with the directory and deletes don't stat each file """
+    get_config = lambda: ssh_stub.config
+    root = os.path.join(str(testdir.tmpdir),"tree")
+    expected = set()
+    for d in range(0,5):
+        os.makedirs(os.path.join(root,"d%d"%d,"sub"))
+        for f in range(0,50):
+            for sub in [ "", "sub" ]:
+                fp = os.path.join(root,"d%d"%d,sub,"f%02d.txt"%f)
+                with open(fp,"w") as out:
+                    out.write("x"*f)
+                expected.add((ssh_stub.base+fp,f))
+    with open(os.path.join(root,".hidden"),"w") as out:
+        out.write("hidden")
+    os.symlink(os.path.join(root,"d0"),os.path.join(root,"link"))
+
+    lines = fs_mod.fs_ls(ssh_stub.base+root,True,get_config).strip().split("\n")
+    assert(set([ (l.split()[-1],int(l.split()[-2])) for l in lines ]) == expected)
+    assert(ssh_stub.ops["lstat"] == 1)
+    assert(ssh_stub.ops["list_folder"] == 11)
+
+    lines = fs_mod.fs_ls(ssh_stub.base+root+"/d1",False,get_config).strip().split("\n")
+    assert(len(lines) == 51)
+    assert(lines.count("                           DIR %s%s/d1/sub/"%(ssh_stub.base,root)) == 1)
+
+    ssh_stub.ops = {}
+    fs_mod.fs_del(ssh_stub.base+root,True,get_config)
+    assert(not os.path.exists(root))
+    assert(ssh_stub.ops.get("stat",0) + ssh_stub.ops.get("lstat",0) == 1)
+    assert(ssh_stub.ops["remove"] == 502)
+    assert(ssh_stub.ops["rmdir"] == 11)
+
+def test_ssh_mod_exec(ssh_stub,testdir):
+    """ test listing, bulk stat and hashing with find and sha256sum over an exec channel and the sftp fallback """
+    root = os.path.join(str(testdir.tmpdir),"tree")
+    paths = []
+    for d in [ "a", "a/b c", "a/.hidden", "d" ]:
+        os.makedirs(os.path.join(root,d))
+        for f in [ "f1.txt", "with space.txt", "back\\slash.txt", ".dot" ]:
+            paths.append(os.path.join(root,d,f))
+            with open(paths[-1],"w") as out:
+                out.write(d+f)
+            os.utime(paths[-1],(1500000000+len(paths),1500000000+len(paths)))
+    os.symlink(os.path.join(root,"d"),os.path.join(root,"link"))
+
+    def listings(config):
+        get_config = lambda: config
+        return [ sorted(fs_mod.fs_ls(ssh_stub.base+p,recurse,get_config).split("\n")) for p in [ root, root+"/", root+"/a", paths[0], root+"/missing" ] for recurse in [ False, True ] ]
+
+    sftp_listings = listings(ssh_stub.config)
+    ssh_stub.allow_exec = True
+    sftp_config = dict(ssh_stub.config,ssh_exec="False")
+    assert(listings(sftp_config) == sftp_listings)
+    assert(ssh_stub.execs == 0)
+    fs_mod.close_backends()
+    ssh_stub.ops = {}
+    assert(listings(ssh_stub.config) == sftp_listings)
+    assert(ssh_stub.execs == 11)
+    assert(not ssh_stub.ops)
+
+    get_config = lambda: ssh_stub.config
+    remote_paths = [ ssh_stub.base+p for p in paths ]+[ ssh_stub.base+root+"/missing" ]
+    stats = fs_mod.fs_stat_many(remote_paths,get_config)
+    assert(ssh_stub.execs == 12)
+    assert(stats == dict([ (p,fs_mod.fs_stat(p,lambda: sftp_config)) for p in remote_paths ]))
+    assert(stats[ssh_stub.base+root+"/missing"] == (-1,-1))
+
+    hashes = fs_mod.fs_hash_many(remote_paths,get_config)
+    assert(ssh_stub.execs == 13)
+    expected = dict([ (ssh_stub.base+p,dedup_mod.file_hash(p)) for p in paths ])
+    assert(hashes == expected)
+    assert(fs_mod.fs_hash_many(remote_paths,lambda: sftp_config) == expected)
+    assert(ssh_stub.execs == 13)
+    assert(fs_mod.fs_hash_many(paths+[ root+"/missing" ]) == dict([ (p,dedup_mod.file_hash(p)) for p in paths ]))
+
+    # a server that doesn't allow exec is found out once and sftp is used
+    fs_mod.close_backends()
+    ssh_stub.allow_exec = False
+    assert(listings(ssh_stub.config) == sftp_listings)
+    assert(fs_mod.fs_stat_many(remote_paths,get_config) == stats)
+    assert(ssh_stub.execs == 13)
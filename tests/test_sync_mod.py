@@ -86,3 +86,44 @@ def do_sync_mod_test( t_dir, test_basepath ):
         elif cases == 3:
             local_path,remote_path = get_paths( "remote_3.txt" )
             fs_mod.fs_del(remote_path,False,lambda: sync_config)
+
+def test_sync_mod_verify(testdir,monkeypatch):
+    """ test that verify checks the copies in both directions in batches and counts a copy that differs as an error """
+    monkeypatch.setenv("HOME",str(testdir.tmpdir))
+    monkeypatch.setattr(sync_mod,"verify_batch",4)
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    target_path = os.path.join(str(testdir.tmpdir),"target")
+    os.makedirs(local_path)
+    os.makedirs(target_path+local_path)
+    for f in range(0,10):
+        open(os.path.join(local_path,"f%02d.txt"%f),"w").write("local %d"%f)
+    for f in range(0,3):
+        open(os.path.join(target_path+local_path,"r%02d.txt"%f),"w").write("remote %d"%f)
+    fs_put = sync_mod.fs_put
+    def corrupting_put( local, remote, get_config = lambda: {}, verbose = False ):
+        fs_put( local, remote, get_config, verbose )
+        if local.endswith("f07.txt"):
+            open(fs_mod.file_mod.strip_protocol(remote),"a").write("corrupted")
+    monkeypatch.setattr(sync_mod,"fs_put",corrupting_put)
+    hashed = []
+    hash_many = fs_mod.FileBackend.hash_many
+    def counted_hash_many( self, remote_paths, get_config = lambda: {} ):
+        hashed.append(len(remote_paths))
+        return hash_many( self, remote_paths, get_config )
+    monkeypatch.setattr(fs_mod.FileBackend,"hash_many",counted_hash_many)
+    sync_config = { "target" : "file://"+target_path, "dirs" : [local_path], "exclude_files" : "", "exclude_dirs" : [], "threads" : "4", "verify" : "True" }
+    job = sync_mod.SyncJob( sync_config )
+    assert(job.synchronize() == 1)
+    assert(job.stats.get("files_verified") == 12)
+    assert(job.stats.get("verify_failures") == 1)
+    assert(job.stats.get("errors") == 1)
+    assert(sorted(hashed) == [ 1, 4, 4, 4 ])
+
+    # with verify off nothing is hashed
+    del hashed[:]
+    sync_config["verify"] = "False"
+    open(os.path.join(local_path,"f07.txt"),"w").write("changed")
+    os.utime(os.path.join(local_path,"f07.txt"),(time.time()+10,time.time()+10))
+    job = sync_mod.SyncJob( sync_config )
+    assert(job.synchronize() == 0)
+    assert(not job.stats.get("files_verified") and not hashed)
@@ -0,0 +1,265 @@
+import os
+import time
+import threading
+import concurrent.futures
+from bkp_core import sync_mod
+from bkp_core.stats_mod import JobStats
+from bkp_core import transfer_mod
+from bkp_core.transfer_mod import TransferEngine, AimdController, backend_limits, make_engine
+
+def test_transfer_mod_futures(testdir):
+    """ test that the engine returns futures with results, byte counts, timings and tracebacks and counts them exactly """
+    engine = TransferEngine(8,10).start()
+    done = []
+    def transfer( n ):
+        time.sleep(0.001)
+        if n % 10 == 0:
+            raise Exception("failed %d"%n)
+        return n*2
+    futures = [ engine.submit( transfer, n, size=n, callback=done.append ) for n in range(0,500) ]
+    engine.join()
+    assert(len(done) == 500)
+    for n, f in enumerate(futures):
+        assert(f.done())
+        if n % 10 == 0:
+            assert(isinstance(f.exception(),Exception))
+            assert("failed %d"%n in f.traceback)
+            assert(f.bytes == 0)
+        else:
+            assert(f.result() == n*2)
+            assert(f.bytes == n)
+            assert(f.seconds() >= 0.001)
+            assert(f.wait_seconds() >= 0.0)
+    assert(engine.submitted == 500)
+    assert(engine.failed == 50)
+    assert(engine.completed == 450)
+    assert(engine.bytes == sum([ n for n in range(0,500) if n % 10 ]))
+    assert(engine.pending() == 0)
+    stats = JobStats()
+    engine.record_stats(stats)
+    assert(stats.get("transfers_failed") == 50)
+    assert(stats.get("transfer_bytes") == engine.bytes)
+
+    # a size function is called after the transfer to get its byte count
+    engine = TransferEngine(1).start()
+    f = engine.submit( lambda: "ok", size=lambda: 42 )
+    engine.join()
+    assert(f.result() == "ok" and f.bytes == 42)
+
+def test_transfer_mod_cancel(testdir):
+    """ test that cancelling the engine cancels the transfers that haven't started and lets the running ones finish """
+    engine = TransferEngine(2).start()
+    started = threading.Semaphore(0)
+    release = threading.Event()
+    def slow():
+        started.release()
+        release.wait()
+        return "finished"
+    # both workers are busy so none of the quick ones can start before they are cancelled
+    running = [ engine.submit( slow ) for i in range(0,2) ]
+    started.acquire()
+    started.acquire()
+    queued = [ engine.submit( lambda: "ran" ) for i in range(0,100) ]
+    queued[50].cancel()
+    engine.cancel()
+    release.set()
+    engine.join()
+    assert([ f.result() for f in running ] == [ "finished", "finished" ])
+    assert(queued[50].cancelled())
+    assert(engine.completed == 2 and engine.cancelled == 100)
+    assert(all([ f.cancelled() for f in queued ]))
+    after = engine.submit( lambda: "late" )
+    assert(after.cancelled())
+    concurrent.futures.wait(queued)
+
+def test_transfer_mod_cancel_blocked(testdir):
+    """ test that a submit blocked on a full queue when the engine is cancelled gets a cancelled future instead of one nothing will run """
+    engine = TransferEngine(1,1).start()
+    started = threading.Event()
+    release = threading.Event()
+    def slow():
+        started.set()
+        release.wait()
+    running = engine.submit( slow )
+    started.wait()
+    waiting = engine.submit( lambda: "waiting" )
+    blocked = []
+    submitter = threading.Thread(target=lambda: blocked.append(engine.submit( lambda: "blocked" )))
+    submitter.start()
+    wait_for( lambda: engine.submitted == 3 )
+    engine.cancel()
+    submitter.join()
+    release.set()
+    engine.join()
+    assert(running.done() and waiting.cancelled() and blocked[0].cancelled())
+    assert(engine.pending() == 0)
+    after = engine.submit( lambda: "late" )
+    assert(after.cancelled() and engine.pending() == 0)
+
+def test_transfer_mod_limits(testdir):
+    """ test that a backend never has more transfers running than its limit """
+    assert(backend_limits({ "threads" : "10", "ssh_threads" : "2", "s3_threads" : "0" }) == { "ssh" : 2 })
+    engine = TransferEngine(8,0,{ "ssh" : 2 }).start()
+    running = { "ssh" : 0, "file" : 0 }
+    peak = { "ssh" : 0, "file" : 0 }
+    lock = threading.Lock()
+    def transfer( backend ):
+        with lock:
+            running[backend] += 1
+            peak[backend] = max(peak[backend],running[backend])
+        time.sleep(0.005)
+        with lock:
+            running[backend] -= 1
+    for i in range(0,40):
+        for backend in [ "ssh", "file" ]:
+            engine.submit( transfer, backend, backend=backend )
+    engine.join()
+    assert(peak["ssh"] == 2)
+    assert(peak["file"] > 2)
+    assert(engine.completed == 80)
+
+def test_transfer_mod_sync(testdir,monkeypatch):
+    """ test that a sync job reports its transfers from the engine and counts failures """
+    monkeypatch.setenv("HOME",str(testdir.tmpdir))
+    local_path = os.path.join(str(testdir.tmpdir),"local")
+    target_path = os.path.join(str(testdir.tmpdir),"target")
+    os.makedirs(local_path)
+    for f in range(0,20):
+        open(os.path.join(local_path,"f%02d.txt"%f),"w").write("x"*f)
+    os.makedirs(target_path+local_path)
+    fs_put = sync_mod.fs_put
+    def failing_put( local, remote, get_config = lambda: {}, verbose = False ):
+        if local.endswith("f05.txt"):
+            raise Exception("put failed")
+        return fs_put( local, remote, get_config, verbose )
+    monkeypatch.setattr(sync_mod,"fs_put",failing_put)
+    sync_config = { "target" : "file://"+target_path, "dirs" : [local_path], "exclude_files" : "", "exclude_dirs" : [], "threads" : "4", "file_threads" : "2" }
+    job = sync_mod.SyncJob( sync_config )
+    assert(job.synchronize() == 1)
+    assert(job.stats.get("errors") == 1)
+    assert(job.stats.get("transfers_failed") == 1)
+    assert(job.stats.get("transfers_completed") == 19)
+    assert(job.stats.get("transfer_bytes") == sum(range(0,20)) - 5)
+    assert(open(os.path.join(target_path+local_path,"f19.txt")).read() == "x"*19)
+
+def wait_for( condition ):
+    """ wait up to 5 seconds for condition() to be True """
+    deadline = time.time() + 5.0
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+    assert(condition())
+
+def test_transfer_mod_resize(testdir):
+    """ test that workers are started and retired as the number of threads changes and that only the live ones take work off the queue """
+    engine = TransferEngine(2).start()
+    assert(engine.live == 2 and len(engine.workers) == 2)
+    release = threading.Event()
+    started = []
+    def blocked():
+        started.append(1)
+        release.wait()
+    for i in range(0,6):
+        engine.submit( blocked )
+    wait_for( lambda: len(started) == 2 )
+    # what the busy workers couldn't take is still waiting so the backlog is real
+    assert(engine.queue.qsize() == 4)
+    engine.resize(4)
+    wait_for( lambda: len(started) == 4 )
+    assert(engine.live == 4 and engine.queue.qsize() == 2)
+    # the busy workers retire as they finish
+    engine.resize(1)
+    release.set()
+    engine.join()
+    assert(engine.completed == 6 and engine.live == 0)
+
+    # idle workers retire right away and the rest run one at a time
+    engine = TransferEngine(4).start()
+    engine.resize(1)
+    wait_for( lambda: engine.live == 1 )
+    running = [0]
+    peak = [0]
+    lock = threading.Lock()
+    def transfer():
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0],running[0])
+        time.sleep(0.001)
+        with lock:
+            running[0] -= 1
+    for i in range(0,20):
+        engine.submit( transfer )
+    engine.join()
+    assert(peak[0] == 1 and engine.completed == 20)
+
+def test_transfer_mod_aimd(testdir):
+    """ test the additive increase multiplicative decrease decisions of the controller """
+    c = AimdController(4,2,8)
+    # too few transfers in the window to say anything
+    assert(c.adjust(2.0,3,0,3000,2.0,True) == 4)
+    assert(c.adjust(4.0,10,0,10000,2.0,True) == 5)
+    assert(c.adjust(6.0,10,0,10000,2.0,True) == 6)
+    # nothing was waiting so more threads wouldn't have helped
+    assert(c.adjust(8.0,10,0,10000,2.0,False) == 6)
+    # within the tolerance of the last window is not a slowdown
+    assert(c.adjust(10.0,10,0,9500,2.0,True) == 7)
+    assert(c.adjust(12.0,10,0,5000,2.0,True) == 5)
+    assert(c.adjust(14.0,10,1,5000,2.0,True) == 2)
+    assert(c.adjust(16.0,10,1,5000,2.0,True) == 2)
+    for i in range(0,10):
+        c.adjust(18.0+i,10,0,5000,1.0,True)
+    assert(c.threads == 8)
+    assert(c.summary() == "0s:4 4s:5 6s:6 10s:7 12s:5 14s:2 18s:3 19s:4 20s:5 21s:6 22s:7 23s:8")
+    assert(AimdController(20,1,10).threads == 10)
+
+def test_transfer_mod_adaptive(testdir,monkeypatch):
+    """ test that an adaptive engine finds its way up to a backend that slows down past 6 transfers at once and backs off from errors """
+    monkeypatch.setattr(transfer_mod,"adapt_seconds",0.1)
+    running = [0]
+    peak = [0]
+    live = [0]
+    lock = threading.Lock()
+    def transfer( fail_over ):
+        with lock:
+            running[0] += 1
+            n = running[0]
+            peak[0] = max(peak[0],n)
+            live[0] = max(live[0],engine.live)
+        try:
+            if n > fail_over:
+                raise Exception("too many connections")
+            time.sleep(0.005 * max(1.0,(n/6.0)**2))
+        finally:
+            with lock:
+                running[0] -= 1
+    messages = []
+    engine = TransferEngine(1,0,{},AimdController(1,1,32),messages.append).start()
+    for i in range(0,1500):
+        engine.submit( transfer, 1000, size=1000 )
+    engine.join()
+    stats = JobStats()
+    engine.record_stats(stats)
+    assert(engine.completed == 1500)
+    assert(stats.get("threads_max_used") >= 6)
+    assert(stats.get("threads_max_used") < 32)
+    assert(peak[0] <= stats.get("threads_max_used"))
+    # only the threads the controller picked were ever started
+    assert(live[0] <= stats.get("threads_max_used"))
+    assert(stats.get("concurrency_history").startswith("0s:1 "))
+    assert(messages and messages[0].startswith("transfer threads 1 -> 2 faster"))
+
+    # a backend that refuses more than 3 connections keeps the threads down
+    engine = TransferEngine(8,0,{},AimdController(8,1,16)).start()
+    assert(len(engine.workers) == 8)
+    for i in range(0,1500):
+        engine.submit( transfer, 3 )
+    engine.join()
+    assert(engine.failed > 0)
+    assert(engine.controller.threads <= 4)
+    assert(min([ t for e, t, r in engine.controller.history ]) <= 4)
+
+def test_transfer_mod_make_engine(testdir):
+    """ test that the config picks a fixed or an adaptive engine """
+    engine = make_engine({ "threads" : "5", "ssh_threads" : "2" },10)
+    assert(engine.threads == 5 and engine.active == 5 and not engine.controller and engine.limits == { "ssh" : 2 })
+    engine = make_engine({ "threads" : "5", "adaptive_threads" : "True", "max_threads" : "12" },10)
+    assert(engine.threads == 12 and engine.active == 5 and engine.controller.min_threads == 1)
@@ -0,0 +1,40 @@
+from bkp_core.walk_mod import TreeWalker
+import os
+import threading
+
+def walk_tree( top, num_threads ):
+    """ walk top with a TreeWalker pruning hidden directories and return the set of files seen and the walker """
+    seen = set()
+    seen_lock = threading.Lock()
+    def process_dir( dirpath, dirs, files ):
+        for d in [d for d in dirs if d.name.startswith(".")]:
+            dirs.remove(d)
+        with seen_lock:
+            for f in files:
+                seen.add(os.path.join(dirpath,f.name))
+    walker = TreeWalker(num_threads)
+    walker.walk(top, process_dir)
+    return (seen, walker)
+
+def test_walk_mod(testdir):
+    """ test that the parallel walker visits the same files as os.walk and prunes like it """
+    top = str(testdir.tmpdir.mkdir("top"))
+    expected = set()
+    for i in range(0,4):
+        for j in range(0,3):
+            d = os.path.join(top,"dir_%d"%i,"sub_%d"%j)
+            os.makedirs(d)
+            for k in range(0,5):
+                f = os.path.join(d,"file_%d.txt"%k)
+                open(f,"w").write("file %d %d %d"%(i,j,k))
+                expected.add(f)
+    os.makedirs(os.path.join(top,".hidden"))
+    open(os.path.join(top,".hidden","hidden.txt"),"w").write("hidden")
+    os.symlink(os.path.join(top,"dir_0"),os.path.join(top,"link_to_dir_0"))
+
+    for num_threads in [1,4]:
+        seen, walker = walk_tree(top, num_threads)
+        assert(seen == expected)
+        assert(walker.files_scanned == len(expected))
+        assert(walker.dirs_scanned == 1+4+4*3)
+        assert(walker.scan_rate() > 0.0)